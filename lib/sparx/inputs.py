@@ -158,6 +158,14 @@ class ClassNewFile(Generic):
 
     __doc__ = "Filename of a new (non-existing) file"
 
+class ClassOutFile(Generic):
+    def __call__(self, arg):
+        '''Return arg as a string: whether the file may already exist is
+        checked by the task'''
+        return arg
+
+    __doc__ = "Filename of an output file (new, or existing when a task resumes)"
+
 class ClassOldFile(Generic):
     def __call__(self, arg):
         if not exists(arg):
@@ -349,6 +357,9 @@ class Type:
     # NewFile type
     NewFile = ClassNewFile("NewFile")
 
+    # OutFile type
+    OutFile = ClassOutFile("OutFile")
+
     # OldFile type
     OldFile = ClassOldFile("OldFile")
 
@@ -248,23 +248,40 @@ class Task_AMC(Task):
         self.keys = [
             Key("source", Type.OldFile, None, "Name of input source model (HDF5 file)"),
             Key("pops", Type.OldFile, Type.Optional, "Name of initial population file (HDF5 file)"),
-            Key("out", Type.NewFile, None, "Name of output file (HDF5 file)"),
+            Key("out", Type.OutFile, None, "Name of output file (HDF5 file), which must not exist unless restart is given"),
             Key("overlap", Type.Velo, '0kms^-1', "overlapping calculation (for hyperfine splitting)"),
             Key("lte", Type.Bool, "True", "Whether to start convergence from LTE conditions"),
+            Key("lvg", Type.Bool, "False", "Start convergence from LVG (Sobolev escape probability) pops, iterated from the LTE or ground state pops"),
             Key("trace", Type.Integer, 0, "Write out the temporary result in every n stetp of iteration"),
+            Key("trace_pops", Type.Bool, "False", "Trace files contain only the POPS table of all zones (in the order of the zones solved by amc) instead of the whole model"),
             #Key("tolerance", Type.Fraction, "5e-3", "Convergence criterion for fixed rays stage"),
             Key("snr", Type.Float, "20", "Upper limit of Monte Carlo noise level"),
             Key("minpop", Type.Fraction, "1e-6", "Minimum pops to test for convergence"),
             Key("nrays", Type.PosInt, "1000", "Number of initial rays per zone"),
-            Key("maxiter", Type.PosInt, "1000", "Maximum number of iterations for solving detailed balance"),
+            Key("maxiter", Type.PosInt, "1000", "Deprecated and ignored: detailed balance is solved once per iteration (kept so that old input files still work)"),
             # esc 09Sep29: It seems it would be best for raniter to be set to at least 5 to
             #              prevent false convergence (just an empirical guess)
             Key("fixiter", Type.PosInt, "5", "Minimum number of iterations for fixed rays stage"),
             Key("raniter", Type.PosInt, "5", "Minimum number of iterations for random rays stage"),
             Key("qmc", Type.Bool, "True", "Quasi-Monte-Carlo method"),
+            Key("crng", Type.Bool, "False", "Counter-based (Philox) random rays, reproducible for any number of threads and processes (disables qmc)"),
+            Key("seed", Type.Index, "0", "Seed of the random rays, 0 to seed from the clock"),
+            Key("adaptive_rays", Type.Bool, "False", "Set the number of rays of unconverged zones in the random rays stage from their Monte Carlo noise, instead of quadrupling it"),
             Key("ali", Type.Bool, "False", "Lambda iteration only / Three-staged Monte-Carlo convergent automation"),
+            Key("alo", Type.Bool, "False", "Accelerated lambda iteration with a local (diagonal) approximate lambda operator"),
             Key("dat", Type.Bool, "False", "1-D level populations ascii file ouput"),
             Key("sor", Type.Float, "1.0", "successive and over-relaxation method"),
+            Key("profile_tol", Type.Fraction, "6.25e-6", "Max. error of the tabulated Gaussian line profile (peak 1), 0 to evaluate exp() exactly"),
+            Key("coll_tres", Type.Fraction, "0", "Relative T_k resolution for sharing interpolated collisional rate coeffs between zones, 0 to share only between zones of equal T_k"),
+            Key("freeze", Type.Index, "0", "Skip zones of the fixed rays stage that have converged for n consecutive iterations, 0 to disable"),
+            Key("freeze_check", Type.PosInt, "5", "Recompute skipped (frozen) zones every n iterations"),
+            Key("ng", Type.Bool, "False", "Ng acceleration of level populations in the fixed rays stage"),
+            Key("ng_order", Type.PosInt, "3", "Number of previous iterations used by Ng acceleration"),
+            Key("checkpoint", Type.Index, "0", "Write a checkpoint file (<out>.ckpt) every n iterations, 0 to disable"),
+            Key("checkpoint_time", Type.Time, "0s", "Write a checkpoint file at least this often (e.g. '30m'), 0 to disable"),
+            Key("restart", Type.OldFile, Type.Optional, "Checkpoint file to resume an interrupted calculation from (rerun the interrupted command with restart=<out>.ckpt); out is overwritten and telemetry records are appended"),
+            Key("raycache", Type.Index, "0", "Memory limit (MB) for caching ray segments in the fixed rays stage, 0 to disable"),
+            Key("telemetry", Type.OutFile, Type.Optional, "File to write per-iteration performance counters (rays, segments, time per thread, MPI sync time, peak memory) to, as JSON lines"),
         ]
 
         # C function to call
@@ -275,6 +292,13 @@ class Task_AMC(Task):
     def main(self):
         class obs:
             task = 'amc'
+
+        # Output files of an interrupted run may be reused when resuming
+        # from its checkpoint
+        if INP_DICT["restart"] is None:
+            for name in INP_DICT["out"], INP_DICT["telemetry"]:
+                if name is not None:
+                    Type.NewFile(name)
         return
 
 install_task(Task_AMC("task_amc"))
@@ -338,6 +362,17 @@ radiation_keys = [
         ),
     Key("tau", Type.NewFile, Type.Optional,
         "Name of output tau cube (Miriad image dataset)"
+        ),
+    Key("adaptive", Type.Fraction, "0",
+        "Refine pixels outside subres boxes that differ from a neighbouring pixel by more than this fraction of the image peak, 0 to disable"
+        ),
+    Key("adaptive_depth", Type.PosInt, "3",
+        "Max. levels of adaptive sub-pixel refinement (up to 4^n rays per pixel)"
+        ),
+    Key("views",
+        Type.Custom([[Type.Angle, Type.Angle, Type.Angle, Type.Length]]),
+        Type.Optional,
+        "Views rendered from the same model instead of rotate and dist, as [[rotate_x, rotate_y, rotate_z, dist], ...]: images of view k are written to <out>_view<k>"
         )
 ]
 
@@ -371,6 +406,9 @@ line_keys = [
             ),
     Key("lte", Type.Bool, "False",
             "Init model to LTE pops of Molec"
+            ),
+    Key("profile_tol", Type.Fraction, "6.25e-6",
+            "Max. error of the tabulated Gaussian line profile (peak 1), 0 to evaluate exp() exactly"
             )
 ]
 
@@ -451,7 +489,11 @@ class Task_LineObs(Task):
         self.expl = "Generates synthetic line images"
 
         # Keys
-        self.keys = postprocess_keys + observer_keys + telsim_keys + radiation_keys + line_keys
+        self.keys = postprocess_keys + observer_keys + telsim_keys + radiation_keys + line_keys + [
+            Key("lines", Type.Custom([Type.Index]), Type.Optional,
+                "More lines imaged from the same rays as line: the image (and tau cube) of line n is written to <out>_<n> (<tau>_<n>)"
+                )
+        ]
 
         # C function to call
         self.cfunc = _sparx.task_telsim
@@ -460,6 +502,22 @@ class Task_LineObs(Task):
     ## Task procedures
     ##
     def main(self):
+        # All lines are imaged from one set of rays: the images of the
+        # extra lines must not exist yet, just like out and tau (the FITS
+        # image is written to <name>.fits)
+        lines = [INP_DICT["line"]]
+        outs = [INP_DICT["out"]]
+        taus = [INP_DICT["tau"]]
+        for n in INP_DICT["lines"] or []:
+            if n not in lines:
+                lines.append(n)
+                outs.append("%s_%d" % (INP_DICT["out"], n))
+                taus.append(None if INP_DICT["tau"] is None else "%s_%d" % (INP_DICT["tau"], n))
+        for name in outs[1:] + taus[1:]:
+            if name is not None:
+                Type.NewFile(name)
+                Type.NewFile(name + ".fits")
+
         # Create 'obs' class used by C code (consider changing this
         # eventually)
         class obs:
@@ -467,6 +525,9 @@ class Task_LineObs(Task):
             task='line'
             line = INP_DICT["line"]
             overlap_vel = INP_DICT["overlap"]
+        obs.lines = lines
+        obs.outs = outs
+        obs.taus = taus
 
         INP_DICT["obs"] = obs
         return
@@ -807,7 +807,7 @@ void FITSoutput( MirFile *fp, MirImg *image, MirImg *StokesQ, MirImg *StokesU, c
         int status = 0;
         fitsfile *fptr;       /* pointer to the FITS file; defined in fitsio.h */
 
-        char FileName[32];
+        char FileName[BUFSIZ];
         sprintf(FileName,"%s.fits", fp->name);
 
         /* createing new FITS file  */
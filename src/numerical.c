@@ -1,7 +1,9 @@
 #include <stdlib.h>
+#include <stdint.h>
 #include <math.h>
 #include <float.h>
 #include <assert.h>
+#include <pthread.h>
 #include <gsl/gsl_spline.h>
 #include <gsl/gsl_linalg.h>
 #include <gsl/gsl_cblas.h>
@@ -269,6 +271,85 @@ void Num_LUDecompSolve(double *A, size_t N, const double *b, double *x)
 
 /*----------------------------------------------------------------------------*/
 
+size_t Num_LUDecompSolveBatch(double *A, size_t N, size_t nbatch, double *b, int *singular)
+/* Solve the nbatch linear systems A_k x_k = b_k, where A_k are N by N
+ * matrices stored one after another in A and b_k vectors of length N
+ * stored one after another in b, by LU decomposition with partial pivoting
+ * (Gaussian elimination). A is destroyed and b is overwritten with x.
+ *
+ * This is meant for many small systems, where the allocation and element
+ * access overhead of one Num_LUDecompSolve() call per system exceeds the
+ * actual work. Systems with a zero pivot are flagged in singular[k] (if
+ * not NULL) and their b_k is left undefined. Returns the number of
+ * singular systems.
+ */
+{
+	size_t nsingular = 0;
+
+	#define AA(i, j) (a[(j) + N * (i)])
+
+	for(size_t k = 0; k < nbatch; k++) {
+		double *a = &A[k * N * N], *x = &b[k * N];
+		int sing = 0;
+
+		/* Forward elimination */
+		for(size_t col = 0; col < N && !sing; col++) {
+			/* Find pivot */
+			size_t piv = col;
+			for(size_t i = col + 1; i < N; i++) {
+				if(fabs(AA(i, col)) > fabs(AA(piv, col)))
+					piv = i;
+			}
+			if(AA(piv, col) == 0.0) {
+				sing = 1;
+				break;
+			}
+
+			/* Swap rows */
+			if(piv != col) {
+				for(size_t j = col; j < N; j++) {
+					double tmp = AA(col, j);
+					AA(col, j) = AA(piv, j);
+					AA(piv, j) = tmp;
+				}
+				double tmp = x[col];
+				x[col] = x[piv];
+				x[piv] = tmp;
+			}
+
+			/* Eliminate below pivot */
+			for(size_t i = col + 1; i < N; i++) {
+				double f = AA(i, col) / AA(col, col);
+				if(f == 0.0)
+					continue;
+				for(size_t j = col + 1; j < N; j++)
+					AA(i, j) -= f * AA(col, j);
+				x[i] -= f * x[col];
+			}
+		}
+
+		/* Back substitution */
+		if(!sing) {
+			for(size_t i = N; i-- > 0;) {
+				double sum = x[i];
+				for(size_t j = i + 1; j < N; j++)
+					sum -= AA(i, j) * x[j];
+				x[i] = sum / AA(i, i);
+			}
+		}
+
+		if(singular)
+			singular[k] = sing;
+		nsingular += (size_t)sing;
+	}
+
+	#undef AA
+
+	return nsingular;
+}
+
+/*----------------------------------------------------------------------------*/
+
 void Num_EigenSolver(double *A, size_t N, double *eigen_value)
 {
         gsl_vector *eval = gsl_vector_alloc (N);
@@ -528,56 +609,163 @@ void NumFFT_Swap2d(double *arr, size_t idim, size_t jdim)
 
 /*----------------------------------------------------------------------------*/
 
+/* Table of exp(-u^2) used by Num_GaussNormal(): gau_fac points per width
+ * up to gau_n points, followed by one zero. gau_tol = 0 means exp() is
+ * evaluated exactly instead. */
+static double *gau_table = NULL, gau_fac = 0, gau_tol = -1.0;
+static size_t gau_n = 0;
+static pthread_once_t gau_once = PTHREAD_ONCE_INIT;
+
+static void GaussNormalTable(double tol);
+static void GaussNormalInit(void);
+
+/*----------------------------------------------------------------------------*/
+
+void Num_SetGaussNormalTol(double tol)
+/* Set the accuracy of Num_GaussNormal() and Num_GaussNormalN(): the
+ * absolute error of the normalized profile (peak 1) is at most tol.
+ *
+ * Linear interpolation of exp(-u^2) with spacing h has an error of at most
+ * h^2/4 since |d^2/du^2 exp(-u^2)| <= 2, and cutting the table off at
+ * u_max widths has an error of exp(-u_max^2); u_max is rounded up to whole
+ * widths. tol = 0 selects exact evaluation with exp(), and the default
+ * Num_GAUSSTOL gives the original table of 200 points per width up to 4
+ * widths.
+ *
+ * The table is shared by all threads, so this must be called before the
+ * threads using it are started (tasks call it while reading their
+ * inputs), never while they are running.
+ */
+{
+	Deb_ASSERT(tol >= 0.0 && tol <= 1.0);
+
+	/* Build the default table first so that it can not replace this one
+	 * later */
+	pthread_once(&gau_once, GaussNormalInit);
+
+	if(tol != gau_tol)
+		GaussNormalTable(tol);
+
+	return;
+}
+
+/*----------------------------------------------------------------------------*/
+
+static void GaussNormalInit(void)
+/* Build the default table: run once, by whichever thread gets there first,
+ * while the others wait for it */
+{
+	GaussNormalTable(Num_GAUSSTOL);
+
+	return;
+}
+
+/*----------------------------------------------------------------------------*/
+
+static void GaussNormalTable(double tol)
+/* Replace the table with one of accuracy tol, which is built completely
+ * before it is published */
+{
+	double *table = NULL, fac = 0;
+	size_t n = 0;
+
+	if(tol > 0.0) {
+		/* The small offset keeps round numbers from being pushed to the
+		 * next integer by rounding errors */
+		fac = ceil(0.5 / sqrt(tol) - 1.0e-6);
+		size_t maxwidth = (size_t)ceil(sqrt(-log(tol)) - 1.0e-6);
+		n = (size_t)fac * Num_MAX(maxwidth, 1) + 1;
+
+		table = Mem_CALLOC(n + 1, table);
+		for(size_t i = 0; i < n; i++) {
+			table[i] = exp(-(double)(i * i) / (fac * fac));
+		}
+		table[n] = 0.0;
+	}
+
+	free(gau_table);
+	gau_table = table;
+	gau_fac = fac;
+	gau_n = n;
+	gau_tol = tol;
+
+	return;
+}
+
+/*----------------------------------------------------------------------------*/
+
 double Num_GaussNormal(double x, double width)
 /* Return Gauss normal at x, with width=sqrt(2)*sigma of the Gaussian.
  *
  * Since exp(x) *can overflow* for x = +\-(large number), indexing
  * a static array of precalculated gaussian normals not only saves time
- * but also prevents overflow of floating point numbers.
- *
- * MAXGAU = total number of data points -- must be odd numbered so that
- * the central data point is zero.
- * MAXWIDTH = maximum number of widths to trace Gaussian.
- * fac = number of data points per width.
+ * but also prevents overflow of floating point numbers. The accuracy of
+ * the table is set with Num_SetGaussNormalTol().
  */
-#define MAXGAU 801
-#define MAXWIDTH 4
 {
-	static const double fac = (MAXGAU - 1.0) / MAXWIDTH;
-	static int init = 0;
-	static double gaunormal[MAXGAU];
-	size_t i, igau;
-
+	size_t igau;
 	double xp, alpha, beta;
 
-	/* If init==0, init gaunormal */
-	if(!init) {
-		for(i = 0; i < MAXGAU; i++) {
-			gaunormal[i] = exp(-(double)(i * i) / (fac * fac));
-		}
-		init = 1;
-	}
+	/* Build default table if no accuracy has been set */
+	pthread_once(&gau_once, GaussNormalInit);
+
 	if (!(width > 0.0)) printf("width=%g\n",width);
-	/* Find position of x in Gaussian normal */
 	Deb_ASSERT(width > 0.0); /* Just in case */
+
+	if(gau_tol == 0.0)
+		return exp(-(x * x) / (width * width));
+
+	/* Find position of x in Gaussian normal */
 	//igau = (size_t)round(fac * fabs(x) / width);
-        xp = fac * fabs(x) / width;
+	xp = gau_fac * fabs(x) / width;
 	igau = (size_t)xp;
 
 	beta =  xp-(double)igau;
 	alpha = 1.0-beta;
-	/* If igau is >= MAXGAU, it is greater than 4*width, so return 0.
-	 * Otherwise return Gaussian normal at igau. */
-	if(igau >= MAXGAU-1)
-	//if(xp >= MAXWIDTH)
+	/* If igau is >= gau_n - 1, it is beyond the end of the table, so
+	 * return 0. Otherwise return Gaussian normal at igau. */
+	if(igau >= gau_n-1)
 		return 0.0;
 	else
-		//return gaunormal[igau];
-		return alpha*gaunormal[igau] + beta*gaunormal[igau+1];
-		//return;
+		return alpha*gau_table[igau] + beta*gau_table[igau+1];
+}
+
+/*----------------------------------------------------------------------------*/
+
+void Num_GaussNormalN(double x0, double dx, size_t n, double width, double scale, double *g)
+/* Add scale * Num_GaussNormal(x0 + i * dx, width) to g[i] for i = 0 ... n-1,
+ * e.g. for all channels of a spectrum. The loop has no branches so that it
+ * can be vectorized by the compiler. */
+{
+	/* Build default table if no accuracy has been set */
+	pthread_once(&gau_once, GaussNormalInit);
+
+	Deb_ASSERT(width > 0.0); /* Just in case */
+
+	if(gau_tol == 0.0) {
+		double w2 = width * width;
+		for(size_t i = 0; i < n; i++) {
+			double x = x0 + (double)i * dx;
+			g[i] += scale * exp(-(x * x) / w2);
+		}
+		return;
+	}
+
+	const double *table = gau_table;
+	const size_t nlast = gau_n - 1;
+	const double fac = gau_fac / width, xmax = (double)nlast;
+
+	for(size_t i = 0; i < n; i++) {
+		double xp = fac * fabs(x0 + (double)i * dx);
+		xp = xp < xmax ? xp : xmax;
+		size_t igau = (size_t)xp;
+		double beta = xp - (double)igau;
+		double value = (1.0 - beta) * table[igau] + beta * table[igau + 1];
+		g[i] += scale * (igau < nlast ? value : 0.0);
+	}
+
+	return;
 }
-#undef MAXGAU
-#undef MAXWIDTH
 
 /*----------------------------------------------------------------------------*/
 
@@ -672,3 +860,121 @@ void Num_QRanDir3D(const double *QRN, double *cost, double *sint, double *phi)
 
 
 
+
+/*----------------------------------------------------------------------------*/
+
+/* Philox4x32-10 counter-based generator (Salmon et al. 2011) as a GSL
+ * rng type: each output block of 4 numbers is a bijection of a 128-bit
+ * counter under a 64-bit key, so any stream can be reached without
+ * generating the numbers before it. The key is the seed, ctr[0] counts
+ * the blocks of a stream and ctr[1..3] identify the stream, see
+ * Num_PhiloxSetStream(). */
+
+typedef struct {
+	uint32_t key[2], ctr[4], out[4];
+	unsigned int idx;
+} philox_state_t;
+
+#define PHILOX_M0 0xD2511F53U
+#define PHILOX_M1 0xCD9E8D57U
+#define PHILOX_W0 0x9E3779B9U
+#define PHILOX_W1 0xBB67AE85U
+
+void Num_Philox4x32(const uint32_t ctr[4], const uint32_t key[2], uint32_t out[4])
+/* One Philox4x32-10 block: out is the bijection of ctr under key */
+{
+	uint32_t c0 = ctr[0], c1 = ctr[1], c2 = ctr[2], c3 = ctr[3],
+		k0 = key[0], k1 = key[1];
+
+	for(int round = 0; round < 10; round++) {
+		uint64_t p0 = (uint64_t)PHILOX_M0 * c0, p1 = (uint64_t)PHILOX_M1 * c2;
+		uint32_t n0 = (uint32_t)(p1 >> 32) ^ c1 ^ k0, n2 = (uint32_t)(p0 >> 32) ^ c3 ^ k1;
+
+		c1 = (uint32_t)p1;
+		c3 = (uint32_t)p0;
+		c0 = n0;
+		c2 = n2;
+		k0 += PHILOX_W0;
+		k1 += PHILOX_W1;
+	}
+	out[0] = c0;
+	out[1] = c1;
+	out[2] = c2;
+	out[3] = c3;
+
+	return;
+}
+
+static void philox_block(philox_state_t *s)
+{
+	Num_Philox4x32(s->ctr, s->key, s->out);
+
+	/* Next block of the stream */
+	s->ctr[0] += 1;
+	s->idx = 0;
+
+	return;
+}
+
+#undef PHILOX_M0
+#undef PHILOX_M1
+#undef PHILOX_W0
+#undef PHILOX_W1
+
+static unsigned long int philox_get(void *vstate)
+{
+	philox_state_t *s = vstate;
+
+	if(s->idx >= 4)
+		philox_block(s);
+
+	return s->out[s->idx++];
+}
+
+static double philox_get_double(void *vstate)
+{
+	return (double)philox_get(vstate) / 4294967296.0;
+}
+
+static void philox_set(void *vstate, unsigned long int seed)
+{
+	philox_state_t *s = vstate;
+
+	s->key[0] = (uint32_t)seed;
+	s->key[1] = (uint32_t)((uint64_t)seed >> 32);
+	s->ctr[0] = s->ctr[1] = s->ctr[2] = s->ctr[3] = 0;
+	s->idx = 4;
+
+	return;
+}
+
+static const gsl_rng_type philox_type = {
+	"philox4x32",
+	0xffffffffUL,
+	0,
+	sizeof(philox_state_t),
+	&philox_set,
+	&philox_get,
+	&philox_get_double
+};
+
+const gsl_rng_type *Num_rng_philox = &philox_type;
+
+/*----------------------------------------------------------------------------*/
+
+void Num_PhiloxSetStream(gsl_rng *rng, unsigned long seed, uint32_t s1, uint32_t s2, uint32_t s3)
+/* Restart the Num_rng_philox generator rng at the beginning of stream
+ * (s1, s2, s3) of seed: the numbers depend only on these arguments, not
+ * on what rng was used for before */
+{
+	Deb_ASSERT(rng->type == Num_rng_philox);
+
+	philox_state_t *s = rng->state;
+
+	philox_set(s, seed);
+	s->ctr[1] = s1;
+	s->ctr[2] = s2;
+	s->ctr[3] = s3;
+
+	return;
+}
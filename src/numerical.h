@@ -1,6 +1,7 @@
 #ifndef __NUMERICAL_H__
 #define __NUMERICAL_H__
 
+#include <stdint.h>
 #include <gsl/gsl_rng.h>
 
 /* The numerical.c/.h interface should provide basic mathematical
@@ -12,6 +13,9 @@
 #define Num_TWOPI  6.283185307179586
 #define Num_HALFPI 1.5707963267948966
 
+/* Default accuracy of Num_GaussNormal(), see Num_SetGaussNormalTol() */
+#define Num_GAUSSTOL 6.25e-6
+
 #define Num_MAX(a, b)\
 	((a) > (b) ? (a) : (b))
 
@@ -37,6 +41,7 @@ double Num_InterpPoly2d(double x1, double x2, const double *x1a, const double *x
 void Num_QRDecompSolve(double *A, size_t M, size_t N, const double *b, double *x);
 void Num_SVDecompSolve(double *A, size_t M, size_t N, const double *b, double *x);
 void Num_LUDecompSolve(double *A, size_t N, const double *b, double *x);
+size_t Num_LUDecompSolveBatch(double *A, size_t N, size_t nbatch, double *b, int *singular);
 
 void Num_EigenSolver(double *A, size_t N, double *eigen_value);
 
@@ -45,9 +50,16 @@ void Num_QuadraticRoots(double a, double b, double c, double *x1, double *x2);
 void NumFFT_Xform2d(double *arr, size_t idim, size_t jdim, double *real, double *imag);
 void NumFFT_Swap1d(double *arr, size_t n);
 void NumFFT_Swap2d(double *arr, size_t idim, size_t jdim);
+void Num_SetGaussNormalTol(double tol);
 double Num_GaussNormal(double x, double width);
+void Num_GaussNormalN(double x0, double dx, size_t n, double width, double scale, double *g);
 double Num_GaussNormal2(double x, double width);
 void Num_RanDir3D(gsl_rng *rng, double *cost, double *sint, double *phi);
 void Num_QRanDir3D(const double *QRN, double *cost, double *sint, double *phi);
 
+/* Counter-based random number generator for gsl_rng_alloc() */
+extern const gsl_rng_type *Num_rng_philox;
+void Num_Philox4x32(const uint32_t ctr[4], const uint32_t key[2], uint32_t out[4]);
+void Num_PhiloxSetStream(gsl_rng *rng, unsigned long seed, uint32_t s1, uint32_t s2, uint32_t s3);
+
 #endif
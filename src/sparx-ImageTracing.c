@@ -134,8 +134,10 @@ void SpImgTrac_InitSubPixel( double *dx, double *dy,
 
 
 /*---------------------------------------------------------------------------- */
+/* add the intensity of the boundary the ray ended at: iline indexes the
+ * intensities of the sources */
 void SpImgTrac_IntensityBC( size_t side, double *I_nu, double *tau_nu, GeRay *ray,
-                            int geom, size_t vn, double I_in, double I_cmb, SpPhysParm * parms){
+                            int geom, size_t vn, double I_in, double I_cmb, size_t iline, SpPhysParm * parms){
 
     #define ADD_BC( INTENSITY ) \
     for(size_t iv = 0; iv < vn; iv++)\
@@ -190,8 +192,8 @@ void SpImgTrac_IntensityBC( size_t side, double *I_nu, double *tau_nu, GeRay *ra
             }
         }
         if (target){
-            // printf("OK %e\n",target->intensity[0]);
-            ADD_BC(target->intensity[0])
+            // printf("OK %e\n",target->intensity[iline]);
+            ADD_BC(target->intensity[iline])
         }
         else{
             /* Add CMB to all channels -- this is done even if the ray misses the source */
@@ -232,3 +234,381 @@ void SpImgTrac_InitLOSCoord( double *dx, double *dy, GeRay *ray, GeVec3_d *z, Ge
     return;
 }
 
+
+/*----------------------------------------------------------------------------*/
+/* cost and index of an image tile, for sorting */
+typedef struct {
+    size_t cost, tile;
+} TileCost;
+
+static int CompareTileCost(const void *a, const void *b)
+{
+    const TileCost *ta = a, *tb = b;
+
+    /* Decreasing cost, then increasing tile index */
+    if(ta->cost != tb->cost)
+        return (ta->cost > tb->cost) ? -1 : 1;
+    return (ta->tile > tb->tile) - (ta->tile < tb->tile);
+}
+
+/*----------------------------------------------------------------------------*/
+/* initialize the queue of image tiles: the cost of a tile is the number of
+ * rays shot through its pixels, nsub^2 for pixels inside subres boxes */
+void SpImgTrac_InitTiles(SpImgTiles *tiles, SpTelsim *tel_parms, MirImg_Axis *x, MirImg_Axis *y)
+{
+    tiles->nx = x->n;
+    tiles->ny = y->n;
+    tiles->ntx = (x->n + SpImgTrac_TILE - 1) / SpImgTrac_TILE;
+    tiles->nty = (y->n + SpImgTrac_TILE - 1) / SpImgTrac_TILE;
+    tiles->ntile = tiles->ntx * tiles->nty;
+    tiles->next = 0;
+    tiles->order = Mem_CALLOC(tiles->ntile, tiles->order);
+    pthread_mutex_init(&tiles->mutex, NULL);
+
+    TileCost *cost = Mem_CALLOC(tiles->ntile, cost);
+    for(size_t ix = 0; ix < x->n; ix++) {
+        for(size_t iy = 0; iy < y->n; iy++) {
+            size_t nsub = SpImgTrac_Init_nsub(ix, iy, tel_parms, x, y);
+            size_t itile = (ix / SpImgTrac_TILE) * tiles->nty + iy / SpImgTrac_TILE;
+            cost[itile].cost += nsub * nsub;
+        }
+    }
+    for(size_t i = 0; i < tiles->ntile; i++)
+        cost[i].tile = i;
+
+    /* Expensive tiles first, so that the cheap ones fill in at the end */
+    qsort(cost, tiles->ntile, sizeof(*cost), CompareTileCost);
+    for(size_t i = 0; i < tiles->ntile; i++)
+        tiles->order[i] = cost[i].tile;
+
+    free(cost);
+
+    return;
+}
+
+/*----------------------------------------------------------------------------*/
+/* take the next tile off the queue: pixels ix0 <= ix < ix1, iy0 <= iy < iy1;
+ * returns 0 when the queue is empty or the thread should terminate */
+int SpImgTrac_NextTile(SpImgTiles *tiles, size_t *ix0, size_t *ix1, size_t *iy0, size_t *iy1)
+{
+    size_t itile;
+
+    if(SpUtil_TermThread())
+        return 0;
+
+    pthread_mutex_lock(&tiles->mutex);
+    itile = tiles->next;
+    if(itile < tiles->ntile)
+        tiles->next++;
+    pthread_mutex_unlock(&tiles->mutex);
+
+    if(itile >= tiles->ntile)
+        return 0;
+
+    itile = tiles->order[itile];
+    *ix0 = (itile / tiles->nty) * SpImgTrac_TILE;
+    *iy0 = (itile % tiles->nty) * SpImgTrac_TILE;
+    /* The last tiles of a row or column may be smaller */
+    *ix1 = Num_MIN(*ix0 + SpImgTrac_TILE, tiles->nx);
+    *iy1 = Num_MIN(*iy0 + SpImgTrac_TILE, tiles->ny);
+
+    return 1;
+}
+
+/*----------------------------------------------------------------------------*/
+void SpImgTrac_FreeTiles(SpImgTiles *tiles)
+{
+    if(tiles->order) {
+        free(tiles->order);
+        pthread_mutex_destroy(&tiles->mutex);
+    }
+    Mem_BZERO(tiles);
+
+    return;
+}
+
+/*----------------------------------------------------------------------------*/
+/* calculate the image with ThreadFunc, which computes the pixels of the
+ * tiles of pix with SpImgTrac_CalcPixel(): in one pass, or with adaptive
+ * refinement in a sampling pass and a refining pass */
+int SpImgTrac_CalcImage(SpImgPixels *pix, void *(*ThreadFunc)(void *tid_p))
+{
+    int sts = 0;
+    size_t npix = pix->x->n * pix->y->n;
+
+    SpImgTrac_InitTiles(&pix->tiles, pix->tel_parms, pix->x, pix->y);
+    pix->refine = 0;
+    pix->nrefined = 0;
+    /* One ray at a time, and four quadrants at each level of refinement */
+    pix->nscratch = pix->nval;
+
+    if(pix->tel_parms->adapt_tol > 0) {
+        pix->val0 = Mem_CALLOC(npix * pix->nval, pix->val0);
+        pix->nscratch += 4 * pix->tel_parms->adapt_depth * pix->nval;
+    }
+
+    sts = SpUtil_Threads2(Sp_NTHREAD, ThreadFunc);
+
+    if(!sts && pix->val0) {
+        /* Peak of each quantity over all pixels and channels */
+        size_t nquant = pix->nval / pix->nchan;
+        pix->scale = Mem_CALLOC(nquant, pix->scale);
+        for(size_t i = 0; i < npix * pix->nval; i++) {
+            size_t iq = (i % pix->nval) / pix->nchan;
+            pix->scale[iq] = Num_MAX(pix->scale[iq], fabs(pix->val0[i]));
+        }
+
+        pix->refine = 1;
+        pix->tiles.next = 0;
+        sts = SpUtil_Threads2(Sp_NTHREAD, ThreadFunc);
+
+        if(!sts)
+            Sp_PRINT("Adaptive sub-pixel refinement: %g/%g pixels refined\n", (double)pix->nrefined, (double)npix);
+    }
+
+    if(pix->val0)
+        free(pix->val0);
+    if(pix->scale)
+        free(pix->scale);
+    pix->val0 = pix->scale = NULL;
+    SpImgTrac_FreeTiles(&pix->tiles);
+
+    return sts;
+}
+
+/*----------------------------------------------------------------------------*/
+/* whether any of the values v differs from v0 by more than the tolerance */
+static int ValuesDiffer(const SpImgPixels *pix, const double *v, const double *v0)
+{
+    double tol = pix->tel_parms->adapt_tol;
+
+    for(size_t i = 0; i < pix->nval; i++) {
+        if(fabs(v[i] - v0[i]) > tol * pix->scale[i / pix->nchan])
+            return 1;
+    }
+
+    return 0;
+}
+
+/*----------------------------------------------------------------------------*/
+/* add w times the values averaged over the square of h x h pixels centered
+ * at (cx, cy) (in pixels) with value v0 at its center to val: the four
+ * quadrants are sampled at their centers, and all of them are refined
+ * further if any differs from v0 by more than the tolerance. scratch holds
+ * 4 * depth * nval values. */
+static void RefineSquare(SpImgPixels *pix, double cx, double cy, double h, const double *v0,
+                         size_t depth, double w, double *val, double *scratch, size_t tid)
+{
+    size_t nval = pix->nval;
+    double *sub = scratch;
+    double qx[4], qy[4];
+    int differ = 0;
+
+    for(size_t q = 0; q < 4; q++) {
+        qx[q] = cx + ((q & 1) ? 0.25 : -0.25) * h;
+        qy[q] = cy + ((q & 2) ? 0.25 : -0.25) * h;
+        double dx = (qx[q] - (double)pix->x->crpix) * pix->x->delt;
+        double dy = (qy[q] - (double)pix->y->crpix) * pix->y->delt;
+        pix->los(dx, dy, &sub[q * nval], tid);
+        if(!differ)
+            differ = ValuesDiffer(pix, &sub[q * nval], v0);
+    }
+
+    for(size_t q = 0; q < 4; q++) {
+        double *vq = &sub[q * nval];
+        if(differ && depth > 1) {
+            RefineSquare(pix, qx[q], qy[q], 0.5 * h, vq, depth - 1, 0.25 * w, val, &scratch[4 * nval], tid);
+        }
+        else {
+            for(size_t i = 0; i < nval; i++)
+                val[i] += 0.25 * w * vq[i];
+        }
+    }
+
+    return;
+}
+
+/*----------------------------------------------------------------------------*/
+/* calculate the values of pixel (ix, iy) in val: averaged over nsub x nsub
+ * rays in subres boxes; otherwise traced through the center of the pixel,
+ * and in the refining pass of adaptive refinement, refined if they differ
+ * from those of any of its four neighbours. scratch holds pix->nscratch
+ * values. */
+void SpImgTrac_CalcPixel(SpImgPixels *pix, size_t ix, size_t iy, double *val, double *scratch, size_t tid)
+{
+    size_t nval = pix->nval, ny = pix->y->n;
+    size_t nsub = SpImgTrac_Init_nsub(ix, iy, pix->tel_parms, pix->x, pix->y);
+
+    if(pix->refine) {
+        const double *v0 = &pix->val0[(ix * ny + iy) * nval];
+        int differ = 0;
+
+        if(nsub == 1) {
+            if(ix > 0)
+                differ = differ || ValuesDiffer(pix, &pix->val0[((ix - 1) * ny + iy) * nval], v0);
+            if(ix + 1 < pix->x->n)
+                differ = differ || ValuesDiffer(pix, &pix->val0[((ix + 1) * ny + iy) * nval], v0);
+            if(iy > 0)
+                differ = differ || ValuesDiffer(pix, &pix->val0[(ix * ny + iy - 1) * nval], v0);
+            if(iy + 1 < ny)
+                differ = differ || ValuesDiffer(pix, &pix->val0[(ix * ny + iy + 1) * nval], v0);
+        }
+
+        if(differ) {
+            Mem_BZERO2(val, nval);
+            RefineSquare(pix, (double)ix, (double)iy, 1.0, v0, pix->tel_parms->adapt_depth, 1.0, val, scratch, tid);
+            pthread_mutex_lock(&pix->tiles.mutex);
+            pix->nrefined++;
+            pthread_mutex_unlock(&pix->tiles.mutex);
+        }
+        else {
+            Mem_MEMCPY(val, v0, nval);
+        }
+
+        return;
+    }
+
+    /* Loop through sub-resolution positions */
+    double *sub = scratch;
+    Mem_BZERO2(val, nval);
+    for(size_t isub = 0; isub < nsub; isub++) {
+        for(size_t jsub = 0; jsub < nsub; jsub++) {
+            double dx, dy;
+            /* Calculate sub-pixel position */
+            SpImgTrac_InitSubPixel(&dx, &dy, ix, iy, isub, jsub, nsub, pix->x, pix->y);
+            pix->los(dx, dy, sub, tid);
+            for(size_t i = 0; i < nval; i++)
+                val[i] += sub[i];
+        }
+    }
+    double DnsubSquare = 1. / (double)(nsub * nsub);
+    for(size_t i = 0; i < nval; i++)
+        val[i] *= DnsubSquare;
+
+    /* Keep the values of the sampling pass */
+    if(pix->val0)
+        Mem_MEMCPY(&pix->val0[(ix * ny + iy) * nval], val, nval);
+
+    return;
+}
+
+/*----------------------------------------------------------------------------*/
+/* get the optional list of views [[rotate_x, rotate_y, rotate_z, dist], ...]
+ * rendered from the same model: only dist and rotate of views are set, and
+ * nview is 0 if there is none */
+int SpImgTrac_GetViews(SpTelsim **views, size_t *nview)
+{
+    int sts = 0;
+    PyObject *o;
+
+    *views = NULL;
+    *nview = 0;
+
+    if(SpPy_CheckOptionalInput("views") && !(sts = SpPy_GetInput_PyObj("views", &o))) {
+        *nview = (size_t)PyList_Size(o);
+        *views = Mem_CALLOC(*nview, *views);
+        for(size_t i = 0; i < *nview; i++) {
+            PyObject *o_view = Sp_PYLST(o, i);
+            for(size_t j = 0; j < 3; j++)
+                (*views)[i].rotate[j] = Sp_PYDBL(Sp_PYLST(o_view, j));
+            (*views)[i].dist = Sp_PYDBL(Sp_PYLST(o_view, 3)) / Sp_LENFAC;
+        }
+        SpPy_XDECREF(o);
+    }
+
+    return sts;
+}
+
+/*----------------------------------------------------------------------------*/
+/* observe from view iview of nview */
+void SpImgTrac_SetView(SpTelsim *tel_parms, const SpTelsim *view, size_t iview, size_t nview)
+{
+    /* dist is in units of Sp_LENFAC (pc) */
+    tel_parms->dist = view->dist;
+    for(size_t j = 0; j < 3; j++)
+        tel_parms->rotate[j] = view->rotate[j];
+
+    Sp_PRINT("View %g/%g: rotate=(%g, %g, %g) deg, dist=%g pc\n",
+             (double)(iview + 1), (double)nview,
+             view->rotate[0] * 180.0 / M_PI, view->rotate[1] * 180.0 / M_PI, view->rotate[2] * 180.0 / M_PI,
+             view->dist);
+
+    return;
+}
+
+/*----------------------------------------------------------------------------*/
+/* open output image `name', or if there are views, only keep its name as the
+ * template of the view images opened by SpImgTrac_OpenViewImage() */
+int SpImgTrac_OpenImage(const char *name, size_t nview, MirImg_Axis *x, MirImg_Axis *y, MirImg_Axis *v, MirFile **fp)
+{
+    int sts = 0;
+
+    if(nview > 0) {
+        *fp = Mem_CALLOC(1, *fp);
+        (*fp)->name = Mem_STRDUP(name);
+    }
+    else {
+        *fp = MirXY_Open_new(name, x->n, y->n, v->n);
+        if(!*fp) {
+            PyWrErr_SetString(PyExc_Exception, "Error opening Miriad XYV file '%s'", name);
+            sts = 1;
+        }
+    }
+
+    return sts;
+}
+
+/*----------------------------------------------------------------------------*/
+/* open the output image named by user input `key', see SpImgTrac_OpenImage() */
+int SpImgTrac_GetInput_Image(const char *key, size_t nview, MirImg_Axis *x, MirImg_Axis *y, MirImg_Axis *v, MirFile **fp)
+{
+    int sts = 0;
+    PyObject *o;
+
+    if(!(sts = SpPy_GetInput_PyObj(key, &o))) {
+        sts = SpImgTrac_OpenImage(Sp_PYSTR(o), nview, x, y, v, fp);
+        Py_DECREF(o);
+    }
+
+    return sts;
+}
+
+/*----------------------------------------------------------------------------*/
+/* close image opened by SpImgTrac_OpenImage() */
+void SpImgTrac_CloseImage(MirFile *fp, size_t nview)
+{
+    if(nview > 0) {
+        free(fp->name);
+        free(fp);
+    }
+    else {
+        SpImgTrac_CloseViewImage(fp);
+    }
+
+    return;
+}
+
+/*----------------------------------------------------------------------------*/
+/* open the image of view iview, named <base>_view<iview> */
+MirFile *SpImgTrac_OpenViewImage(const MirFile *base, size_t iview, MirImg_Axis *x, MirImg_Axis *y, MirImg_Axis *v)
+{
+    char *name = Mem_Sprintf("%s_view%lu", base->name, (unsigned long)iview);
+    MirFile *fp = MirXY_Open_new(name, x->n, y->n, v->n);
+
+    free(name);
+
+    return fp;
+}
+
+/*----------------------------------------------------------------------------*/
+void SpImgTrac_CloseViewImage(MirFile *fp)
+{
+    #if Sp_MIRSUPPORT
+    MirXY_Close(fp);
+    #else
+    free(fp->name);
+    free(fp);
+    #endif
+
+    return;
+}
@@ -837,6 +837,14 @@ int SpIO_H5WriteGrid(hid_t h5f_id, const Zone *zone, const SpPhysParm *parms)
             if(parms->mol){
                     COPY_TYPE_TO_RECORD(ZoneH5_Record_Molec, ZoneH5_FwriteTable_Molec, SpIO_MolecToH5Record);
                     SpIO_H5WritePops(h5f_id, zone);
+                    /* Ray budgets of zones solved by amc */
+                    for(size_t i = 0; i < zone->nchildren; i++) {
+                        SpPhys *pp = zone->children[i]->data;
+                        if(pp->nray > 0) {
+                            SpIO_H5WriteNray(h5f_id, zone);
+                            break;
+                        }
+                    }
             }
             if(parms->dust){
                     COPY_TYPE_TO_RECORD(ZoneH5_Record_Dust, ZoneH5_FwriteTable_Dust, SpIO_DustToH5Record);
@@ -975,11 +983,41 @@ int SpIO_H5WritePops(hid_t h5f_id, const Zone *zone)
 	Deb_ASSERT(pp->mol != NULL);
         Deb_ASSERT(pp->pops_preserve != NULL);
 
-	herr_t hstatus = 0;
 	int status = 0;
 	size_t
 		i, j,
-		nlev = pp->mol->nlev,
+		nlev = pp->mol->nlev;
+	double *pops = Mem_CALLOC(zone->nchildren * nlev, pops);
+
+	/* Load data */
+	#define POPS(i, j)\
+		pops[(j) + nlev * (i)]
+
+	for(i = 0; i < zone->nchildren; i++) {
+		pp = zone->children[i]->data;
+		for(j = 0; j < nlev; j++) {
+                    POPS(i, j) = pp->pops_preserve[j];
+		}
+	}
+
+	#undef POPS
+
+	status = SpIO_H5WritePopsTable(h5f_id, pops, zone->nchildren, nlev);
+
+	free(pops);
+
+	return status;
+}
+
+/*----------------------------------------------------------------------------*/
+
+int SpIO_H5WritePopsTable(hid_t h5f_id, const double *pops, size_t nzone, size_t nlev)
+/* Write the pops of nzone zones (nzone x nlev) to the HDF5 table `POPS' */
+{
+	herr_t hstatus = 0;
+	int status = 0;
+	size_t
+		i,
 		record_size =  sizeof(double) * nlev,
 		field_offset[nlev];
 	const char **field_names = Mem_CALLOC(nlev, field_names);
@@ -987,7 +1025,6 @@ int SpIO_H5WritePops(hid_t h5f_id, const Zone *zone)
 	hid_t field_type[nlev];
 	hsize_t chunk_size = 10;
 	int *fill_data = NULL, compress  = 0;
-	double *pops = Mem_CALLOC(zone->nchildren * nlev, pops);
 
 	/* Init fields */
 	for(i = 0; i < nlev; i++) {
@@ -997,26 +1034,13 @@ int SpIO_H5WritePops(hid_t h5f_id, const Zone *zone)
 		field_names[i] = level_names[i];
 	}
 
-	/* Load data */
-	#define POPS(i, j)\
-		pops[(j) + nlev * (i)]
-
-	for(i = 0; i < zone->nchildren; i++) {
-		pp = zone->children[i]->data;
-		for(j = 0; j < nlev; j++) {
-                    POPS(i, j) = pp->pops_preserve[j];
-		}
-	}
-
-	#undef POPS
-
 	/* Write table */
 	hstatus = H5TBmake_table(
 		"Level populations",
 		h5f_id,
 		"POPS",
 		(hsize_t)nlev,
-		(hsize_t)zone->nchildren,
+		(hsize_t)nzone,
 		record_size,
 		field_names,
 		field_offset,
@@ -1032,7 +1056,6 @@ int SpIO_H5WritePops(hid_t h5f_id, const Zone *zone)
 		free(level_names[i]);
 	free(level_names);
 	free(field_names);
-	free(pops);
 
 	if(hstatus < 0)
 		status = printf("Error writing `POPS' table\n");
@@ -1042,6 +1065,54 @@ int SpIO_H5WritePops(hid_t h5f_id, const Zone *zone)
 
 /*----------------------------------------------------------------------------*/
 
+int SpIO_H5WriteNray(hid_t h5f_id, const Zone *zone)
+/* Write the number of rays per zone of all children to an HDF5 table */
+{
+	SpPhys *pp;
+	herr_t hstatus = 0;
+	int status = 0;
+	size_t i,
+		record_size = sizeof(unsigned long long),
+		field_offset[1] = {0};
+	const char *field_names[1] = {"nray"};
+	hid_t field_type[1] = {H5T_NATIVE_ULLONG};
+	hsize_t chunk_size = 10;
+	int *fill_data = NULL, compress  = 0;
+	unsigned long long *nray = Mem_CALLOC(zone->nchildren, nray);
+
+	/* Load data */
+	for(i = 0; i < zone->nchildren; i++) {
+		pp = zone->children[i]->data;
+		nray[i] = (unsigned long long)pp->nray;
+	}
+
+	/* Write table */
+	hstatus = H5TBmake_table(
+		"Number of rays",
+		h5f_id,
+		"NRAY",
+		(hsize_t)1,
+		(hsize_t)zone->nchildren,
+		record_size,
+		field_names,
+		field_offset,
+		field_type,
+		chunk_size,
+		fill_data,
+		compress,
+		nray
+	);
+
+	free(nray);
+
+	if(hstatus < 0)
+		status = printf("Error writing `NRAY' table\n");
+
+	return status;
+}
+
+/*----------------------------------------------------------------------------*/
+
 int SpIO_H5ReadPops(hid_t h5f_id, Zone *zone)
 /* Write data of all children to an HDF5 table */
 {
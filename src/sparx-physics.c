@@ -112,44 +112,99 @@ void SpPhys_InitCollRates(SpPhys *pp)
 	Deb_ASSERT(pp->mol != NULL);
 	Deb_ASSERT(pp->cmat == NULL);
 
-	#define NLEV (pp->mol->nlev)
-	#define COL(i) (pp->mol->col[(i)])
-	#define TMP(i, j) (COL(i)->tmp[(j)])
-	#define TR(i, j) (COL(i)->tr[(j)])
-	#define CMAT(i, j) (pp->cmat[(j) + NLEV * (i)])
+	double *K_ul = Mem_CALLOC(Num_MAX(1, SpPhys_CollCoeffsSize(pp->mol)), K_ul);
 
 	/* Allocate collisional rates matrix */
-	pp->cmat = Mem_CALLOC(NLEV * NLEV, pp->cmat);
+	pp->cmat = Mem_CALLOC(pp->mol->nlev * pp->mol->nlev, pp->cmat);
 
-	/* Fill in downward rates: collisional rates for each transition are the
-	 * sum of collisional rates from ALL collisional partners */
-	for(size_t i = 0; i < pp->mol->ncol; i++) {
+	SpPhys_GetCollCoeffs(pp->mol, pp->T_k, K_ul);
+	SpPhys_FillCollRates(pp, K_ul, pp->cmat);
+
+	free(K_ul);
+
+	return;
+}
+
+/*----------------------------------------------------------------------------*/
+
+size_t SpPhys_CollCoeffsSize(const Molec *mol)
+/* Number of downward rate coeffs returned by SpPhys_GetCollCoeffs() */
+{
+	size_t n = 0;
+
+	for(size_t i = 0; i < mol->ncol; i++)
+		n += mol->col[i]->ntr;
+
+	return n;
+}
+
+/*----------------------------------------------------------------------------*/
+
+void SpPhys_GetCollCoeffs(const Molec *mol, double T_k, double *K_ul)
+/* Interpolate downward rate coeffs of all collisional transitions at T_k;
+ * K_ul holds the transitions of all collisional partners one after
+ * another. The coeffs only depend on T_k, so they can be shared by all
+ * zones with the same temperature. */
+{
+	#define COL(i) (mol->col[(i)])
+	#define TMP(i, j) (COL(i)->tmp[(j)])
+	#define TR(i, j) (COL(i)->tr[(j)])
+
+	for(size_t i = 0, k = 0; i < mol->ncol; i++) {
 		/* Locate nearest temperature available for this species */
-		size_t itmp = gsl_interp_bsearch(COL(i)->tmp, pp->T_k, (size_t)0, COL(i)->ntmp);
+		size_t itmp = gsl_interp_bsearch(COL(i)->tmp, T_k, (size_t)0, COL(i)->ntmp);
 
 		/* Loop through all collisional transitions and calculate
 		 * collisional rats */
-		for(size_t j = 0; j < COL(i)->ntr; j++) {
-                        double K_ul;
+		for(size_t j = 0; j < COL(i)->ntr; j++, k++) {
 			/* Interpolate downward rate coeffs */
 			if(itmp == COL(i)->ntmp - 1) {
 				/* T_k greater than available tempratures, coerce to
 				 * upper end of K_ul */
-				K_ul = TR(i, j)->K_ul[COL(i)->ntmp - 1];
+				K_ul[k] = TR(i, j)->K_ul[COL(i)->ntmp - 1];
 			}
-			else if(pp->T_k < TMP(i, 0)) {
+			else if(T_k < TMP(i, 0)) {
 				/* T_k less than available temperatures, coerce to
 				 * lower end of K_ul */
-				K_ul = TR(i, j)->K_ul[0];
+				K_ul[k] = TR(i, j)->K_ul[0];
 			}
 			else {
 				/* T_k within range, linearly interpolate K_ul */
-				K_ul = Num_InterpLinear(pp->T_k, TMP(i, itmp), TMP(i, itmp + 1), TR(i, j)->K_ul[itmp], TR(i, j)->K_ul[itmp + 1]);
+				K_ul[k] = Num_InterpLinear(T_k, TMP(i, itmp), TMP(i, itmp + 1), TR(i, j)->K_ul[itmp], TR(i, j)->K_ul[itmp + 1]);
 			}
+		}
+	}
 
+	#undef COL
+	#undef TMP
+	#undef TR
+
+	return;
+}
+
+/*----------------------------------------------------------------------------*/
+
+void SpPhys_FillCollRates(const SpPhys *pp, const double *K_ul, double *cmat)
+/* Fill the NLEV x NLEV collisional rates matrix cmat of pp from downward
+ * rate coeffs K_ul (from SpPhys_GetCollCoeffs()) and infer upward rates
+ * from Boltzmann relation at pp->T_k */
+{
+	#define NLEV (pp->mol->nlev)
+	#define COL(i) (pp->mol->col[(i)])
+	#define TR(i, j) (COL(i)->tr[(j)])
+	#define CMAT(i, j) (cmat[(j) + NLEV * (i)])
+
+	Mem_BZERO2(cmat, NLEV * NLEV);
+
+	/* Fill in downward rates: collisional rates for each transition are the
+	 * sum of collisional rates from ALL collisional partners */
+	for(size_t i = 0, k = 0; i < pp->mol->ncol; i++) {
+		double n_col = SpPhys_GetCollDens(pp, COL(i)->species);
+
+		for(size_t j = 0; j < COL(i)->ntr; j++, k++) {
 			/* Collisional rate is density of collisional partner multiplied
 			 * by downard rate */
-			CMAT(TR(i, j)->up, TR(i, j)->lo) += SpPhys_GetCollDens(pp, COL(i)->species) * K_ul;
+			CMAT(TR(i, j)->up, TR(i, j)->lo) += n_col * K_ul[k];
 		}
 	}
 
@@ -185,7 +240,6 @@ void SpPhys_InitCollRates(SpPhys *pp)
 
 	#undef NLEV
 	#undef COL
-	#undef TMP
 	#undef TR
 	#undef CMAT
 
@@ -708,6 +762,84 @@ void SpPhys_GetMoljk(const SpPhys *pp, size_t tr, double vfac, double *j_nu, dou
 
 /*----------------------------------------------------------------------------*/
 
+SpLineTab *SpPhys_AllocLineTab(const Molec *mol)
+/* Pack the radiative transitions of mol into a SpLineTab */
+{
+	SpLineTab *tab = Mem_CALLOC(1, tab);
+	size_t n = Num_MAX(1, mol->nrad);
+
+	tab->nrad = mol->nrad;
+	tab->up = Mem_CALLOC(n, tab->up);
+	tab->lo = Mem_CALLOC(n, tab->lo);
+	tab->freq = Mem_CALLOC(n, tab->freq);
+	tab->A_ul = Mem_CALLOC(n, tab->A_ul);
+	tab->B_lu = Mem_CALLOC(n, tab->B_lu);
+	tab->B_ul = Mem_CALLOC(n, tab->B_ul);
+
+	for(size_t i = 0; i < mol->nrad; i++) {
+		const MolTrRad *trans = mol->rad[i];
+
+		tab->up[i] = trans->up;
+		tab->lo[i] = trans->lo;
+		tab->freq[i] = trans->freq;
+		tab->A_ul[i] = trans->A_ul;
+		tab->B_lu[i] = trans->B_lu;
+		tab->B_ul[i] = trans->B_ul;
+	}
+
+	return tab;
+}
+
+/*----------------------------------------------------------------------------*/
+
+void SpPhys_FreeLineTab(SpLineTab *tab)
+{
+	free(tab->up);
+	free(tab->lo);
+	free(tab->freq);
+	free(tab->A_ul);
+	free(tab->B_lu);
+	free(tab->B_ul);
+	free(tab);
+
+	return;
+}
+
+/*----------------------------------------------------------------------------*/
+
+void SpPhys_GetMoljkN(const SpPhys *pp, const SpLineTab *tab, double *j_coef, double *k_coef)
+/* Calculate the molecular emission and absorption coefficients of all lines
+ * in tab for vfac = 1: SpPhys_GetMoljk(pp, i, vfac, ...) gives
+ * vfac * j_coef[i] and vfac * k_coef[i]. Zones without tracers get 0. */
+{
+	static const double
+		pi = PHYS_CONST_PI,
+		c = PHYS_CONST_MKS_LIGHTC,
+		KONST = PHYS_CONST_MKS_PLANCKH / (4.0 * PHYS_CONST_PI);
+	const double *pops = pp->pops_preserve;
+	double nX = pp->n_H2 * pp->X_mol;
+
+	if(!pp->has_tracer) {
+		Mem_BZERO2(j_coef, tab->nrad);
+		Mem_BZERO2(k_coef, tab->nrad);
+		return;
+	}
+
+	for(size_t i = 0; i < tab->nrad; i++) {
+		double nu = tab->freq[i],
+		       n_u = pops[tab->up[i]],
+		       n_l = pops[tab->lo[i]],
+		       factor = KONST * nX * nu * (c / (pp->width * nu * sqrt(pi)));
+
+		j_coef[i] = factor * (n_u * tab->A_ul[i]);
+		k_coef[i] = factor * (n_l * tab->B_lu[i] - n_u * tab->B_ul[i]);
+	}
+
+	return;
+}
+
+/*----------------------------------------------------------------------------*/
+
 GeVec3_d SpPhys_GetVgas(const GeVec3_d *pos, const Zone *zone)
 /* Retriev gas velocity at pos */
 {
@@ -1100,6 +1232,46 @@ double SpPhys_GetVfac(const GeRay *ray, double dt, double v_los, const Zone *zon
 
 /*----------------------------------------------------------------------------*/
 
+void SpPhys_GetVfacN(const GeRay *ray, double dt, double v_0, double delta_v, size_t nv,
+	const Zone *zone, double *vfac)
+/* Same as SpPhys_GetVfac() for the nv line-of-sight velocities
+ * v_0 + i * delta_v, e.g. all channels of a spectrum: the gas velocity is
+ * sampled along the path once and the line profile is evaluated for all
+ * velocities at each sample. */
+{
+	SpPhys *pp = zone->data;
+
+	Mem_BZERO2(vfac, nv);
+
+	/* Sample the path in the same way as SpPhys_GetVfac() */
+	GeVec3_d v_a = SpPhys_GetVfunc(ray, 0.0, zone);
+	GeVec3_d v_b = SpPhys_GetVfunc(ray, dt, zone);
+	size_t n_step = Num_MAX((size_t)(GeVec3_Mag2(&v_b, &v_a) / pp->width), 1);
+
+	for(size_t i = 0; i < n_step; i++) {
+		double s_0 = dt * (double)i / (double)n_step;
+		double s_1 = dt * (double)(i + 1) / (double)n_step;
+		v_a = SpPhys_GetVfunc(ray, s_0, zone);
+		v_b = SpPhys_GetVfunc(ray, s_1, zone);
+		size_t n_avg = Num_MAX( (size_t)(GeVec3_Mag2(&v_b, &v_a) / pp->width) , 1);
+
+		/* Average line profile over n_avg */
+		for(size_t j = 0; j < n_avg; j++) {
+			double s = s_0 + (s_1 - s_0) * ((double)j + 0.5) / (double)n_avg;
+			GeVec3_d v = SpPhys_GetVfunc(ray, s, zone);
+			Num_GaussNormalN(v_0 - GeVec3_DotProd(&v, &ray->d), delta_v, nv, pp->width,
+				1.0 / (double)n_avg, vfac);
+		}
+	}
+
+	for(size_t i = 0; i < nv; i++)
+		vfac[i] /= (double)n_step;
+
+	return;
+}
+
+/*----------------------------------------------------------------------------*/
+
 GeVec3_d SpPhys_GetVfac2(const GeRay *ray, double dt, const Zone *zone, int debug)
 {
 	//debug
@@ -3,6 +3,8 @@
 #include <gsl/gsl_qrng.h>
 
 #include <time.h>
+#include <stdint.h>
+#include <sys/resource.h>
 #include "task.h"
 
 enum {
@@ -14,55 +16,223 @@ enum {
 
 #define QRAN_DIM 6
 
+/* One step of a ray through a non-empty zone */
+typedef struct {
+    Zone *zp;
+    double t, vfac;
+} RaySeg;
+
+/* Segments of all rays of one zone recorded in the fixed rays stage, where
+ * the same rays are traced in every iteration: ray i consists of
+ * seg[seg_start[i]] ... seg[seg_start[i + 1] - 1] and leaves the cloud
+ * with boundary intensity I_bc[i]. Zones that did not fit within the
+ * memory limit are marked uncached and are retraced. */
+typedef struct {
+    size_t nray, nseg, ray_cap, seg_cap;
+    RaySeg *seg;
+    size_t *seg_start;
+    const double **I_bc;
+    int uncached;
+} RayCache;
+
+/* Performance counters of a thread in the current iteration: rays traced,
+ * segments traversed, time spent tracing rays and working on zones in
+ * total, the wall time at which the thread ran out of work and the time
+ * it then waited for the other threads */
+typedef struct {
+    size_t nray, nseg;
+    double t_rays, t_busy, t_end, t_idle;
+} ThreadStats;
+
+/* Per-thread scratch buffers: the ray buffers grow with the largest nray
+ * seen by the thread, the others have fixed sizes. They are reused for
+ * all zones and iterations so that the excitation loop does no heap
+ * allocation. */
+typedef struct {
+    size_t nray_max;
+    double *ds0, *vfac0, *intensity, *tau;
+    double *dtau, *J_bar, *L_star;
+    /* Line profile factors at the velocity offsets of overlapping lines */
+    double *ol_vfac;
+    /* Emission and absorption coefficients of a step */
+    double *j_nu, *k_nu;
+    /* Rate equations of a block of zones, solved together */
+    double *blk_rmat, *blk_pops;
+    int *blk_sing;
+    RayCache rec;
+    ThreadStats stats;
+} Scratch;
+
 /* Global parameter struct */
 static struct glb {
     SpFile *outf;
     SpModel model,pops;
-    size_t nzone, nray, nconv, maxi, fixi, rani, nray_tot;
+    size_t nzone, nray, nconv, fixi, rani, nray_tot;
     Zone **zones;
     size_t *zone_rank, *zone_tid;
     gsl_rng *rng[Sp_NTHREAD];
     gsl_qrng *qrng[Sp_NTHREAD];
-    unsigned long seed;
+    unsigned long seed, seed0;
+    /* Counter-based RNG: the rays of every zone are drawn from their own
+     * Philox streams, so the results do not depend on which thread or
+     * process computes the zone */
+    int crng;
+    size_t iter;
     double tolerance, minpop, snr, max_diff, overlap_vel, sor;
     double  *I_norm, *I_cmb, *I_in;
-    int stage, fully_random, lte, overlap, popsold, qmc, ali, dat;
+    int stage, fully_random, lte, lvg, overlap, popsold, qmc, ali, alo, dat;
+    /* Overlapping lines: the partners j != i of line i are ol_line[k] for
+     * k from ol_start[i] to ol_start[i + 1], at velocity offset
+     * ol_dv[ol_idx[k]]; pairs with equal offsets share an entry of ol_dv */
+    size_t nol_dv, *ol_start, *ol_line, *ol_idx;
+    double *ol_dv;
+    /* Packed line data, and pool of the line coeffs of all zones
+     * (pp->line_j, pp->line_k), updated from pops_preserve at the start of
+     * every iteration */
+    SpLineTab *lines;
+    double *line_pool;
+    /* Set nray of unconverged zones in the random rays stage from their
+     * Monte Carlo noise, instead of quadrupling it */
+    int adaptive_rays;
     // parameter trace lets the temporary result wroe out in every n step of iteration
     size_t trace;
-
-    pthread_mutex_t exc_mutex;
+    /* Ng acceleration: ng_hist keeps the last (ng_order + 2) pops of every zone */
+    int ng;
+    size_t ng_order, ng_nhist;
+    double *ng_hist;
+    /* Checkpoint/restart: ckpt_rng keeps the RNG states of this process
+     * read from the restart file until they are restored in CalcExc() */
+    char *ckpt_fname, *restart_fname;
+    size_t ckpt_iter, iter0, ckpt_rng_size;
+    double ckpt_time;
+    time_t t_ckpt;
+    int restart;
+    char *ckpt_rng;
+    /* Work queue of the zones of this process, in order of decreasing cost
+     * (time per ray measured in the last iteration times nray) */
+    size_t *queue, nqueue, queue_next;
+    double *zone_tpr, *zone_cost, queue_cost;
+    /* nray of the next iteration, set by UpdateZone() and copied to
+     * pp->nray once the threads are done */
+    size_t *zone_nray;
+    /* Trace files are written by trace_thread in the background, either
+     * the POPS table from the snapshot trace_pops (nzone x NLEV) or the
+     * whole model, whose pops and nray stay fixed until the writer is
+     * joined in FinishTraceWrite() */
+    int trace_pops_only, trace_pending, trace_sts;
+    char *trace_fname;
+    double *trace_pops;
+    pthread_t trace_thread;
+    /* Telemetry: one JSON line per iteration with the ThreadStats of all
+     * threads of all processes, written to tel_fp by the master process */
+    int telemetry;
+    FILE *tel_fp;
+
+    Scratch scratch[Sp_NTHREAD];
+    /* Ray segment cache of the fixed rays stage, limited to raycache_max
+     * bytes */
+    RayCache *ray_cache;
+    size_t raycache_max, raycache_bytes;
+    int raycache_full;
+
+    /* Collisional rates: downward rate coeffs are interpolated once for
+     * every distinct T_k (quantized to a relative resolution coll_tres),
+     * and zone_coll[izone] indexes the coeffs of a zone in coll_K. The
+     * rates matrices of the zones this process owns are kept in slots of
+     * one contiguous pool, cmat_slot[izone] being NO_SLOT for other zones */
+    double coll_tres, *coll_T, *coll_K, *cmat_pool;
+    size_t ncoll_T, ncoll_K, *zone_coll;
+    size_t *cmat_slot, *cmat_free, ncmat_slot, ncmat_free;
+    /* Active set of the fixed rays stage: zones converged for `freeze'
+     * consecutive iterations are frozen, and only recomputed every
+     * freeze_check iterations or when one of their neighbours (nbr[] from
+     * nbr_start[izone] to nbr_start[izone + 1]) changed by more than
+     * TOLERANCE. zone_frozen is the iteration + 1 at which a zone was
+     * frozen, or 0, and nskip the number of zones skipped in the current
+     * iteration */
+    size_t freeze, freeze_check, nskip, *zone_nconv, *zone_frozen, *nbr_start, *nbr;
+    int *zone_active, full_sweep;
+    pthread_mutex_t exc_mutex, queue_mutex;
 } glb;
 
+#define NO_SLOT ((size_t)-1)
+
 /* Subroutine prototypes */
 int SpTask_Amc(void);
 static int InitModel(void);
 static void *InitModelThread(void *tid_p);
 static int CalcExc(void);
 static void *CalcExcThread(void *tid_p);
+static void InitOverlapPairs(void);
+static void InitLineCoeffs(void);
+static void *InitPopsLVGThread(void *tid_p);
+static double LVGVelGrad(Zone *zp);
+static int SolvePopsLVG(size_t izone, double *rmat, double *cmat, double *pops, double *x, double *beta);
+static void UpdateLineCoeffs(void);
+static void ScratchAlloc(Scratch *scr);
+static void ScratchReserve(Scratch *scr, size_t nray);
+static void ScratchFree(Scratch *scr);
+static void ReleaseForeignZones(void);
+static double CollKey(double T_k);
+static void InitCollCoeffs(void);
+static void AssignCollRates(void);
+static void InitActiveSet(void);
+static void SelectActiveZones(size_t iter);
+static void UpdateActiveSet(size_t iter);
+static void StartTraceWrite(size_t iter);
+static void *TraceWriterThread(void *arg);
+static int FinishTraceWrite(void);
+static void InitZoneQueue(void);
+static int CompareZoneCost(const void *a, const void *b);
+static int NextZoneChunk(size_t *begin, size_t *end);
 static void SyncProcs(void);
-static void SyncPops(size_t izone);
+static int WriteTelemetry(size_t iter, double t_wall, double t_sync);
+static unsigned long NewSeed(void);
 static void CalcRays_RNG(
     size_t tid,
+    size_t izone,
+    size_t isys,
     Zone *zone,
     double *ds0,
     double *vfac0,
     double *intensity,
-    double *tau);
+    double *tau,
+    RayCache *rec);
 static void CalcRays_QRNG(
     size_t tid,
     Zone *zone,
     double *ds0,
     double *vfac0,
     double *intensity,
-    double *tau);
+    double *tau,
+    RayCache *rec);
+static void ReplayRays(size_t tid, Zone *zone, const RayCache *rc, double *ds0,
+                       double *vfac0, double *intensity, double *tau);
 static void RadiativeXfer(size_t tid, Zone *zone, GeRay *ray, double vel, double *ds0,
-                          double *vfac0, double *intensity, double *tau);
-static void CalcDetailedBalance(size_t tid, SpPhys *pp, const double *ds0,
-                                const double *vfac0, const double *intensity, const double *tau);
+                          double *vfac0, double *intensity, double *tau, RayCache *rec);
+static void XferSegment(size_t tid, Zone *zp, double t, double vfac, const GeRay *ray,
+                        double vel, double *intensity, double *tau);
+static const double *BoundaryIntensity(const Zone *zone, const GeRay *ray, size_t plane);
+static void RayCacheBegin(RayCache *rec, size_t nray);
+static void RayCacheAddSegment(RayCache *rec, Zone *zp, double t, double vfac);
+static void RayCacheCommit(RayCache *rc, RayCache *rec);
+static void RayCacheFree(RayCache *rc);
+static void CalcZoneRates(size_t tid, size_t izone, size_t nsys, double *rmat);
+static void UpdateZone(size_t tid, size_t izone, size_t nsys, double *pops, const int *singular, double t_zone);
+static void BuildRateMatrix(size_t tid, SpPhys *pp, const double *ds0, const double *vfac0,
+                            const double *intensity, const double *tau, double *rmat);
 static void CalcJbar(size_t tid, SpPhys *pp, const double *ds0, const double *vfac0,
-                     const double *intensity, const double *tau, double *J_bar);
-static double CalcDiff(const double *hist, size_t *max_diff_lev,size_t izone,size_t tid);
-static double CalcDiff2(const double *hist, size_t *max_diff_lev);
+                     const double *intensity, const double *tau, double *J_bar, double *L_star);
+static double CalcDiff(const double *hist, size_t *max_diff_lev, double *max_sigma, size_t izone, size_t tid);
+static size_t NextNray(size_t nray, double sigma);
+static int CheckpointDue(size_t iter);
+static size_t RngStateSize(void);
+static void WriteCheckpoint(size_t iter);
+static int ReadCheckpoint(void);
+static void RestoreRngState(void);
+static void NgPushPops(void);
+static size_t NgAccelerate(void);
+static int NgExtrapolate(const double *ng_hist, double *pops);
 static void Cleanup(void);
 
 /*----------------------------------------------------------------------------*/
@@ -112,21 +282,79 @@ int SpTask_Amc(void)
      */
     // 1. get parameters from python interface
     if(!sts) sts = SpPy_GetInput_sizt("nrays", &glb.nray);
-    if(!sts) sts = SpPy_GetInput_sizt("maxiter", &glb.maxi);
     if(!sts) sts = SpPy_GetInput_sizt("fixiter", &glb.fixi);
     if(!sts) sts = SpPy_GetInput_sizt("raniter", &glb.rani);
     if(!sts) sts = SpPy_GetInput_sizt("trace", &glb.trace);
+    if(!sts) sts = SpPy_GetInput_bool("trace_pops", &glb.trace_pops_only);
     /* Deduct raniter and fixiter by 1 (remove at some point?) */
     if(!sts) glb.fixi -= 1;
     if(!sts) glb.rani -= 1;
     if(!sts) sts = SpPy_GetInput_bool("lte", &glb.lte);
+    if(!sts) sts = SpPy_GetInput_bool("lvg", &glb.lvg);
     if(!sts) sts = SpPy_GetInput_bool("qmc", &glb.qmc);
+    if(!sts) sts = SpPy_GetInput_bool("crng", &glb.crng);
+    if(!sts) sts = SpPy_GetInput_sizt("seed", &glb.seed0);
+    if(!sts && glb.crng && glb.qmc) {
+        Sp_PRINT("crng selected, quasi-random rays (qmc) disabled\n");
+        glb.qmc = 0;
+    }
+    if(!sts) sts = SpPy_GetInput_bool("adaptive_rays", &glb.adaptive_rays);
     if(!sts) sts = SpPy_GetInput_bool("ali", &glb.ali);
+    if(!sts) sts = SpPy_GetInput_bool("alo", &glb.alo);
     if(!sts) sts = SpPy_GetInput_bool("dat", &glb.dat);
     if(!sts) sts = SpPy_GetInput_dbl("snr", &glb.snr);
     glb.tolerance = 0.1/glb.snr;
     if(!sts) sts = SpPy_GetInput_dbl("minpop", &glb.minpop);
     if(!sts) sts = SpPy_GetInput_dbl("sor", &glb.sor);
+    if(!sts) sts = SpPy_GetInput_dbl("coll_tres", &glb.coll_tres);
+    if(!sts) sts = SpPy_GetInput_sizt("freeze", &glb.freeze);
+    if(!sts) sts = SpPy_GetInput_sizt("freeze_check", &glb.freeze_check);
+    if(!sts) {
+        double tol;
+        if(!(sts = SpPy_GetInput_dbl("profile_tol", &tol)))
+            Num_SetGaussNormalTol(tol);
+    }
+    if(!sts) sts = SpPy_GetInput_bool("ng", &glb.ng);
+    if(!sts) sts = SpPy_GetInput_sizt("ng_order", &glb.ng_order);
+    if(!sts) sts = SpPy_GetInput_sizt("checkpoint", &glb.ckpt_iter);
+    if(!sts) sts = SpPy_GetInput_dbl("checkpoint_time", &glb.ckpt_time);
+    if(!sts) sts = SpPy_GetInput_sizt("raycache", &glb.raycache_max);
+    glb.raycache_max *= (size_t)1024 * 1024;
+
+    /* Checkpoint file is named after the output file */
+    if(!sts && (glb.ckpt_iter > 0 || glb.ckpt_time > 0)) {
+        PyObject *o;
+        sts = SpPy_GetInput_PyObj("out", &o);
+        if(!sts) {
+            glb.ckpt_fname = Mem_Sprintf("%s.ckpt", Sp_PYSTR(o));
+            Py_DECREF(o);
+        }
+    }
+    if(!sts && SpPy_CheckOptionalInput("restart")) {
+        PyObject *o;
+        sts = SpPy_GetInput_PyObj("restart", &o);
+        if(!sts) {
+            glb.restart_fname = Mem_STRDUP(Sp_PYSTR(o));
+            glb.restart = 1;
+            Py_DECREF(o);
+        }
+    }
+
+    if(!sts && SpPy_CheckOptionalInput("telemetry")) {
+        glb.telemetry = 1;
+        if(Sp_MPIRANK == 0) {
+            PyObject *o;
+            sts = SpPy_GetInput_PyObj("telemetry", &o);
+            if(!sts) {
+                glb.tel_fp = fopen(Sp_PYSTR(o), glb.restart ? "a" : "w");
+                if(!glb.tel_fp) {
+                    PyWrErr_SetString(PyExc_Exception, "Error opening telemetry file '%s'", Sp_PYSTR(o));
+                    sts = 1;
+                }
+                Py_DECREF(o);
+            }
+        }
+    }
 
     if(!sts) sts = SpPy_GetInput_dbl("overlap", &glb.overlap_vel);
     glb.overlap = (glb.overlap_vel == 0.0) ? 0 : 1;
@@ -135,7 +363,7 @@ int SpTask_Amc(void)
 
 
     /* Open output file handle -- only the master process can write files! */
-    if(Sp_MPIRANK == 0 && !sts) sts = SpPy_GetInput_spfile("out", &glb.outf, Sp_NEW);
+    if(Sp_MPIRANK == 0 && !sts) sts = SpPy_GetInput_spfile("out", &glb.outf, glb.restart ? Sp_TRUNC : Sp_NEW);
 
 
 
@@ -143,6 +371,10 @@ int SpTask_Amc(void)
     if(!sts)
         sts = InitModel();
 
+    /* Load state of an interrupted calculation */
+    if(!sts && glb.restart)
+        sts = ReadCheckpoint();
+
     /* Calculate excitation */
     if(!sts)
         sts = CalcExc();
@@ -168,6 +400,28 @@ static void Cleanup(void)
     if(Sp_MPIRANK == 0 && glb.outf)
         SpIO_CloseFile(glb.outf);
 
+    /* Rates matrices live in the pool and must not be freed with the
+     * model */
+    if(glb.cmat_pool) {
+        for(size_t izone = 0; izone < glb.nzone; izone++) {
+            SpPhys *pp = glb.zones[izone]->data;
+            pp->cmat = NULL;
+        }
+        free(glb.cmat_pool);
+    }
+
+    /* Same for line coeffs */
+    if(glb.line_pool) {
+        for(size_t izone = 0; izone < glb.nzone; izone++) {
+            SpPhys *pp = glb.zones[izone]->data;
+            pp->line_j = pp->line_k = NULL;
+        }
+        free(glb.line_pool);
+    }
+
+    if(glb.lines)
+        SpPhys_FreeLineTab(glb.lines);
+
     SpModel_Cleanup(glb.model);
 
     if(glb.zones)
@@ -193,11 +447,108 @@ static void Cleanup(void)
     if(glb.I_in)
         free(glb.I_in);
 
+    if(glb.ng_hist)
+        free(glb.ng_hist);
+
+    if(glb.ckpt_fname)
+        free(glb.ckpt_fname);
+
+    if(glb.restart_fname)
+        free(glb.restart_fname);
+
+    if(glb.tel_fp)
+        fclose(glb.tel_fp);
+
+    if(glb.ckpt_rng)
+        free(glb.ckpt_rng);
+
+    if(glb.queue)
+        free(glb.queue);
+
+    if(glb.zone_tpr)
+        free(glb.zone_tpr);
+
+    if(glb.zone_nray)
+        free(glb.zone_nray);
+
+    if(glb.trace_pops)
+        free(glb.trace_pops);
+
+    if(glb.zone_cost)
+        free(glb.zone_cost);
+
+    if(glb.coll_T)
+        free(glb.coll_T);
+
+    if(glb.coll_K)
+        free(glb.coll_K);
+
+    if(glb.zone_coll)
+        free(glb.zone_coll);
+
+    if(glb.cmat_slot)
+        free(glb.cmat_slot);
+
+    if(glb.cmat_free)
+        free(glb.cmat_free);
+
+    if(glb.zone_nconv)
+        free(glb.zone_nconv);
+
+    if(glb.zone_frozen)
+        free(glb.zone_frozen);
+
+    if(glb.zone_active)
+        free(glb.zone_active);
+
+    if(glb.nbr_start)
+        free(glb.nbr_start);
+
+    if(glb.nbr)
+        free(glb.nbr);
+
+    if(glb.ol_start)
+        free(glb.ol_start);
+
+    if(glb.ol_line)
+        free(glb.ol_line);
+
+    if(glb.ol_idx)
+        free(glb.ol_idx);
+
+    if(glb.ol_dv)
+        free(glb.ol_dv);
+
+    for(size_t i = 0; i < Sp_NTHREAD; i++)
+        ScratchFree(&glb.scratch[i]);
+
+    if(glb.ray_cache) {
+        for(size_t i = 0; i < glb.nzone; i++)
+            RayCacheFree(&glb.ray_cache[i]);
+        free(glb.ray_cache);
+    }
+
     return;
 }
 
 /*----------------------------------------------------------------------------*/
 
+static unsigned long NewSeed(void)
+/* Seed given by the user, or from the clock. Counter-based rays must have
+ * the same seed on all processes. */
+{
+    unsigned long seed = glb.seed0 ? (unsigned long)glb.seed0 : (unsigned long)time(NULL);
+
+    #ifdef HAVE_MPI
+    if(glb.crng && Sp_MPISIZE > 1)
+        MPI_Bcast(&seed, 1, MPI_UNSIGNED_LONG, 0, MPI_COMM_WORLD);
+    #endif
+
+    return seed;
+}
+
+/*----------------------------------------------------------------------------*/
+
 static int InitModel(void)
 {
     /*
@@ -205,11 +556,11 @@ static int InitModel(void)
      */
     if(!glb.qmc){
         /* Init RNG seed */
-        glb.seed = (unsigned long)time(NULL);
+        glb.seed = NewSeed();
 
         /* Init RNG */
         for(size_t i = 0; i < Sp_NTHREAD; i++) {
-            glb.rng[i] = gsl_rng_alloc(gsl_rng_ranlux);
+            glb.rng[i] = gsl_rng_alloc(glb.crng ? Num_rng_philox : gsl_rng_ranlux);
             gsl_rng_set(glb.rng[i], glb.seed);
         }
     }
@@ -297,6 +648,7 @@ static int InitModel(void)
             }
             // 			printf("\n");
         }
+        InitOverlapPairs();
     }
 
 
@@ -369,11 +721,47 @@ static int InitModel(void)
         //glb.zone_tid[i] = i % Sp_NTHREAD;
     }
 
+    /* Allocate scratch buffers of all threads */
+    for(size_t i = 0; i < Sp_NTHREAD; i++)
+        ScratchAlloc(&glb.scratch[i]);
+
+    /* Allocate ray segment cache: overlapping lines need the velocity
+     * profile at shifted velocities along the ray, which is not cached */
+    if(glb.raycache_max > 0) {
+        if(glb.overlap)
+            Sp_PWARN("ray segment cache is not available with overlapping lines and is disabled\n");
+        else
+            glb.ray_cache = Mem_CALLOC(glb.nzone, glb.ray_cache);
+    }
+
+    /* Allocate work queue */
+    glb.queue = Mem_CALLOC(glb.nzone, glb.queue);
+    glb.zone_tpr = Mem_CALLOC(glb.nzone, glb.zone_tpr);
+    glb.zone_nray = Mem_CALLOC(glb.nzone, glb.zone_nray);
+    glb.zone_cost = Mem_CALLOC(glb.nzone, glb.zone_cost);
+
+    /* Allocate history of pops for Ng acceleration */
+    if(glb.ng)
+        glb.ng_hist = Mem_CALLOC(glb.nzone * (glb.ng_order + 2) * NLEV, glb.ng_hist);
+
     /* enable pops */
     parms->pops = 1;
 
     SpUtil_Threads2(Sp_NTHREAD, InitModelThread);
 
+    /* Interpolate collisional rate coeffs for all temperatures */
+    InitCollCoeffs();
+
+    /* Packed line data and line coeffs of all zones */
+    InitLineCoeffs();
+
+    /* Improve the initial pops with the LVG approximation */
+    if(glb.lvg && glb.popsold == 0)
+        SpUtil_Threads2(Sp_NTHREAD, InitPopsLVGThread);
+
+    /* Neighbours and state for freezing converged zones */
+    InitActiveSet();
+
     return 0;
 }
 
@@ -407,8 +795,8 @@ static void *InitModelThread(void *tid_p)
                 /* Calculate thermal line width */
                 pp->width = SpPhys_CalcLineWidth(pp);
 
-                /* Interpolate downward collisional coeffs and infer upward coeffs */
-                SpPhys_InitCollRates(pp);
+                /* Collisional rates are only needed by the process owning
+                 * the zone: they are initialized in CalcExcThread() */
 
                 /* Set initial pops to either optically thin or LTE */
                 if (glb.popsold == 0){   // only if not using old pops (added by I-Ta 2012.10.26)
@@ -450,12 +838,16 @@ static void *InitModelThread(void *tid_p)
 #define TOLERANCE (glb.tolerance)
 #define MCNOISE (1.0 / glb.snr)
 #define NHIST ((size_t)3)
+#define DB_BLOCK ((size_t)16) /* Zones per batched solve of the rate equations */
 #define HIST(i, j) \
 hist[(j) + NLEV * (i)]
 #define INTENSITY(i, j) \
 intensity[(j) + NRAD * (i)]
 #define TAU(i, j) \
 tau[(j) + NRAD * (i)]
+#define NG_NHIST (glb.ng_order + 2)
+#define NG_HIST(izone, k) \
+(&glb.ng_hist[NLEV * ((k) + NG_NHIST * (izone))])
 
 /*----------------------------------------------------------------------------*/
 
@@ -465,22 +857,27 @@ static int CalcExc(void)
     /* set the minimal converged cell number for the fully-random stage */
     size_t ran_min_nconv = (size_t)(0.995*(double)glb.nzone+0.5);
 
-    /* Make sure exc_mutex is initialized */
+    /* Make sure exc_mutex and queue_mutex are initialized */
     pthread_mutex_init(&glb.exc_mutex, NULL);
+    pthread_mutex_init(&glb.queue_mutex, NULL);
 
     /* Start timer */
     time_t t_start;
     time(&t_start);
+    glb.t_ckpt = t_start;
+
+    /* Whether the current stage is resumed from a checkpoint */
+    int resume = glb.restart;
 
     Sp_PRINT("Model geometry is `%s'\n", Geom_CodeToName(glb.model.grid->voxel.geom));
     Sp_PRINT("Solving excitation for %s\n", glb.model.parms.mol->chemname);
     Sp_PRINT("Total %d levels, %d lines\n", glb.model.parms.mol->nlev, glb.model.parms.mol->nrad);
-    Sp_PRINT("Beginning convergence from %s conditions\n", glb.lte ? "LTE" : "GROUND STATE");
+    Sp_PRINT("Beginning convergence from %s%s conditions\n", glb.lvg ? "LVG pops started from " : "", glb.lte ? "LTE" : "GROUND STATE");
 
 
 
     int sts = 0;
-    for(glb.stage = 0;
+    for(glb.stage = (resume ? glb.stage : 0);
         !sts && (glb.stage < (glb.ali ? 1 : STAGE_N));
     glb.stage++) {
 
@@ -498,13 +895,16 @@ static int CalcExc(void)
                 }
             }
         }
-        else{
+        else if(!resume){
             /* Get new seed for each stage */
-            glb.seed = (unsigned long)time(NULL);
+            glb.seed = NewSeed();
         }
 
         /* Reset number of converged zones */
-        glb.nconv = 0;
+        if(resume)
+            RestoreRngState();
+        else
+            glb.nconv = 0;
 
         /* Some pretty output for the user's convenience */
         if(!glb.fully_random) {
@@ -512,14 +912,20 @@ static int CalcExc(void)
             if(glb.qmc)
                 Sp_PRINT("Iterating for convergence with FIXED set of random rays, Quasi Random Ray\n");
             else
-                Sp_PRINT("Iterating for convergence with FIXED set of random rays, seed=%lu\n", glb.seed);
+                Sp_PRINT("Iterating for convergence with FIXED set of random rays, seed=%lu%s\n", glb.seed, glb.crng ? " (counter-based)" : "");
         }
         else {
             Sp_PRINT("\n");
             if(glb.qmc)
                 Sp_PRINT("Iterating for convergence with FULLY RANDOM rays,  Quasi Random Ray\n");
             else
-                Sp_PRINT("Iterating for convergence with FULLY RANDOM rays,  initial seed=%lu\n", glb.seed);
+                Sp_PRINT("Iterating for convergence with FULLY RANDOM rays,  initial seed=%lu%s\n", glb.seed, glb.crng ? " (counter-based)" : "");
+        }
+
+        /* Restart the Ng history from the current pops */
+        if(glb.ng && !glb.fully_random && !resume) {
+            glb.ng_nhist = 0;
+            NgPushPops();
         }
 
         Sp_PRINT("%6s|%15s|%10s|%10s|%10s|%9s|%20s\n", "Iter.", "Converged/Total", "Prcntg.", "Max diff.", "Goal", "Elapsed", "Status");
@@ -527,7 +933,7 @@ static int CalcExc(void)
 
 
         //for(iter = 0; !sts && (glb.nconv < glb.nzone ); iter++) {
-        for (size_t iter = 0;
+        for (size_t iter = (resume ? glb.iter0 : 0);
              !sts && (glb.nconv < ( glb.fully_random ? ran_min_nconv : glb.nzone ) );
         iter++){
             /* Check for thread termination */
@@ -537,15 +943,46 @@ static int CalcExc(void)
             }
 
             /* Reset global parameters */
+            glb.iter = iter;
             glb.nconv = 0;
             glb.max_diff = 0;
             glb.nray_tot = 0;
 
             /* Calculate excitation */
+            SelectActiveZones(iter);
+            InitZoneQueue();
+            AssignCollRates();
+            UpdateLineCoeffs();
+            double t_wall = SpUtil_WallTime();
             SpUtil_Threads2(Sp_NTHREAD, CalcExcThread);
+            double t_join = SpUtil_WallTime();
+            t_wall = t_join - t_wall;
+            for(size_t i = 0; i < Sp_NTHREAD; i++) {
+                ThreadStats *st = &glb.scratch[i].stats;
+                st->t_idle = Num_MAX(t_join - st->t_end, 0.0);
+            }
+
+            /* The trace file of the last iteration must be complete
+             * before pops and nray change */
+            if(FinishTraceWrite() && !sts)
+                sts = 1;
+
+            for(size_t izone = 0; izone < glb.nzone; izone++) {
+                SpPhys *pp = glb.zones[izone]->data;
+                pp->nray = glb.zone_nray[izone];
+            }
 
             /* Sync pops from all processes and threads */
+            double t_sync = SpUtil_WallTime();
             SyncProcs();
+            t_sync = SpUtil_WallTime() - t_sync;
+
+            /* Frozen zones that were skipped have converged before */
+            glb.nconv += glb.nskip;
+            UpdateActiveSet(iter);
+
+            if(glb.telemetry && WriteTelemetry(iter, t_wall, t_sync) && !sts)
+                sts = 1;
 
             /* Get time for this iteration */
             time_t t_iter;
@@ -562,16 +999,35 @@ static int CalcExc(void)
                      Phys_SecsToHMS_Str((int)difftime(t_iter, t_start)));
 
             Sp_PRINTF("|->%13g rays\n", (double)glb.nray_tot);
+            if(glb.nskip > 0)
+                Sp_PRINT("%g frozen zones skipped\n", (double)glb.nskip);
             if (glb.nconv >= ((glb.fully_random) ? ran_min_nconv:glb.nzone)) {
                 if(iter < (glb.fully_random ? glb.rani : glb.fixi)) {
                     Sp_PRINTF("%5d more iters\n", (glb.fully_random ? glb.rani : glb.fixi) - iter);
                     glb.nconv = 0;
                 }
+                else if(glb.nskip > 0) {
+                    /* Verify convergence with one more iteration over all
+                     * zones */
+                    Sp_PRINT("Verifying convergence of frozen zones\n");
+                    glb.full_sweep = 1;
+                    glb.nconv = 0;
+                }
                 else {
                     Sp_PRINTF("%16s\n", "Converged!");
                 }
             }
 
+            /* Extrapolate pops with Ng acceleration while the fixed rays
+             * stage is still iterating */
+            if(glb.ng && !glb.fully_random && glb.nconv < glb.nzone) {
+                NgPushPops();
+                if(glb.ng_nhist == NG_NHIST) {
+                    size_t nacc = NgAccelerate();
+                    Sp_PRINT("Ng acceleration: extrapolated %g/%g zones\n", (double)nacc, (double)glb.nzone);
+                }
+            }
+
 
             #ifdef HAVE_MPI
             if(Sp_MPISIZE > 1)
@@ -580,16 +1036,8 @@ static int CalcExc(void)
 
             /* Write out model if requested by user to trace convergence history */
             if (glb.trace)
-                if( iter % glb.trace == 0 && Sp_MPIRANK == 0 ) {
-                    SpFile *tracefp = NULL;
-                    if(!sts) {
-                        char *stmp = Mem_Sprintf("%s.stage%d-%05d", glb.outf->name, glb.stage, iter);
-                        sts = SpIO_OpenFile2(stmp, Sp_NEW, &tracefp);
-                        free(stmp);
-                    }
-                    if(!sts) sts = SpIO_FwriteModel(tracefp, glb.model);
-                    if(!sts) SpIO_CloseFile(tracefp);
-                }
+                if( iter % glb.trace == 0 && Sp_MPIRANK == 0 && !sts)
+                    StartTraceWrite(iter);
 
             /* Redistribute parallelization by weighting nray (added by I-Ta)*/
             if(glb.stage == STAGE_RAN){
@@ -632,6 +1080,9 @@ static int CalcExc(void)
                         glb.zone_rank[izone] = ( ithread / Sp_NTHREAD ) % Sp_MPISIZE;
                     }
                 }
+
+                /* Release collisional rates of zones handed to other processes */
+                ReleaseForeignZones();
             }
             #if 0
             /* Write out convergent information for visualization */
@@ -732,11 +1183,28 @@ static int CalcExc(void)
         fclose(fp);
         }
         #endif
+
+        /* Save state for restarting if requested by user */
+        if(CheckpointDue(iter))
+            WriteCheckpoint(iter + 1);
+
         #ifdef HAVE_MPI
         if(Sp_MPISIZE > 1)
             MPI_Barrier(MPI_COMM_WORLD);
         #endif
         }
+        resume = 0;
+
+        /* Wait for the last trace file of this stage */
+        if(FinishTraceWrite() && !sts)
+            sts = 1;
+
+        /* Ray segments of the fixed rays stage are not needed any more */
+        if(glb.ray_cache && !glb.fully_random) {
+            for(size_t izone = 0; izone < glb.nzone; izone++)
+                RayCacheFree(&glb.ray_cache[izone]);
+            glb.raycache_bytes = 0;
+        }
 
         if(glb.qmc && glb.fully_random)
             for (size_t i =0; i < Sp_NTHREAD; i++)
@@ -827,298 +1295,1226 @@ return sts;
 static void *CalcExcThread(void *tid_p)
 {
     size_t tid = *((size_t *)tid_p);
-    double *hist = Mem_CALLOC(NHIST * NLEV, hist);
+    Scratch *scr = &glb.scratch[tid];
+
+    /* Number of independent rate equations per zone: one for every set of
+     * rays */
+    size_t nsys = (glb.stage == STAGE_RAN) ? NHIST : 1;
+    size_t begin, end;
+    ThreadStats *st = &scr->stats;
+
+    Mem_BZERO(st);
+
+    /* Pull chunks of zones off the work queue until it is empty, and
+     * solve the rate equations of up to DB_BLOCK zones of a chunk at a
+     * time */
+    while(!SpUtil_TermThread() && NextZoneChunk(&begin, &end)) {
+        for(size_t ib = begin; ib < end; ib += DB_BLOCK) {
+            size_t nb = Num_MIN(DB_BLOCK, end - ib);
+            double t_zone[DB_BLOCK];
+
+            /* Shoot rays and assemble rate equations */
+            for(size_t k = 0; k < nb; k++) {
+                /* Check for thread termination */
+                if(SpUtil_TermThread()) break;
+
+                t_zone[k] = SpUtil_WallTime();
+                CalcZoneRates(tid, glb.queue[ib + k], nsys, &scr->blk_rmat[k * nsys * NLEV * NLEV]);
+                t_zone[k] = SpUtil_WallTime() - t_zone[k];
+            }
+            if(SpUtil_TermThread()) break;
+
+            /* Solve rate equations of the whole block: the last row of each
+             * system is the constraint that all level densities must sum
+             * to unity */
+            double t_solve = SpUtil_WallTime();
+            Mem_BZERO2(scr->blk_pops, nb * nsys * NLEV);
+            for(size_t k = 0; k < nb * nsys; k++)
+                scr->blk_pops[k * NLEV + NLEV - 1] = 1.0;
+            Num_LUDecompSolveBatch(scr->blk_rmat, NLEV, nb * nsys, scr->blk_pops, scr->blk_sing);
+            t_solve = SpUtil_WallTime() - t_solve;
+
+            st->t_busy += t_solve;
+            for(size_t k = 0; k < nb; k++)
+                st->t_busy += t_zone[k];
+
+            /* Update pops and convergence of each zone, sharing the time
+             * of the solve equally */
+            for(size_t k = 0; k < nb; k++) {
+                UpdateZone(tid, glb.queue[ib + k], nsys, &scr->blk_pops[k * nsys * NLEV],
+                           &scr->blk_sing[k * nsys], t_zone[k] + t_solve / (double)nb);
+            }
+        }
+    }
+    st->t_end = SpUtil_WallTime();
 
-    #define TIMER 0
+    pthread_exit(NULL);
 
-    #if  TIMER
-    // Timer
-    float Tmc_thread = 0.0;
-    float Tdb_thread = 0.0;
-    float Tall_thread = 0.0;
-    #endif
+}
 
-    for(size_t izone = 0; izone < glb.nzone; izone++) {
-        /* Skip zones that don't belong to this rank/thread */
-        if((glb.zone_tid[izone] != tid) || (glb.zone_rank[izone] != Sp_MPIRANK))
-            continue;
+/*----------------------------------------------------------------------------*/
 
-        /* Check for thread termination */
-        if(SpUtil_TermThread()) break;
+static void CalcZoneRates(size_t tid, size_t izone, size_t nsys, double *rmat)
+/* Shoot nsys sets of rays for zone izone and assemble the rate equations
+ * of each set in rmat (nsys NLEV x NLEV matrices) */
+{
+    Scratch *scr = &glb.scratch[tid];
 
-        /* Zone related pointers */
-        Zone *zp = glb.zones[izone];
-        SpPhys *pp = zp->data;
+    /* Zone related pointers */
+    Zone *zp = glb.zones[izone];
+    SpPhys *pp = zp->data;
 
-        /* Buffers for calculating excitation */
-        double *ds0 = Mem_CALLOC(pp->nray, ds0);
-        double *vfac0 = Mem_CALLOC(pp->nray, vfac0);
-        double *intensity = Mem_CALLOC(pp->nray * NRAD, intensity);
-        double *tau = Mem_CALLOC(pp->nray * NRAD, tau);
+    /* Fill in collisional rates from the shared downward coeffs the
+     * first time this process works on the zone */
+    if(!pp->cmat) {
+        pp->cmat = &glb.cmat_pool[glb.cmat_slot[izone] * NLEV * NLEV];
+        SpPhys_FillCollRates(pp, &glb.coll_K[glb.zone_coll[izone] * glb.ncoll_K], pp->cmat);
+    }
 
-        if(!glb.fully_random){
-            if(glb.qmc){
-                // reset QMC random seed
-                glb.qrng[tid] = gsl_qrng_alloc(gsl_qrng_niederreiter_2, QRAN_DIM);
-                // skip the initial zero-array
-                double QRN[QRAN_DIM];
-                gsl_qrng_get(glb.qrng[tid], QRN);
-            }
-            else{
-                // reset random seed while in the fixed-ray stage
-                gsl_rng_set(glb.rng[tid], glb.seed);
-            }
-        }
+    /* Buffers for calculating excitation */
+    ScratchReserve(scr, pp->nray);
+    double *ds0 = scr->ds0;
+    double *vfac0 = scr->vfac0;
+    double *intensity = scr->intensity;
+    double *tau = scr->tau;
 
-        /* Calculate NHIST times for statistics */
-        for(size_t ihist = 0; ihist < (glb.stage == STAGE_RAN? NHIST:1); ihist++) {
+    if(!glb.fully_random){
+        if(glb.qmc){
+            // reset QMC random seed
+            glb.qrng[tid] = gsl_qrng_alloc(gsl_qrng_niederreiter_2, QRAN_DIM);
+            // skip the initial zero-array
+            double QRN[QRAN_DIM];
+            gsl_qrng_get(glb.qrng[tid], QRN);
+        }
+        else{
+            // reset random seed while in the fixed-ray stage
+            gsl_rng_set(glb.rng[tid], glb.seed);
+        }
+    }
 
-            #if  TIMER
-            clock_t start = clock();
-            #endif
+    /* Replay cached rays in the fixed rays stage, or record them if
+     * this zone has not been cached yet */
+    RayCache *rc = (glb.ray_cache && !glb.fully_random) ? &glb.ray_cache[izone] : NULL;
+    RayCache *rec = (rc && rc->nray == 0 && !rc->uncached) ? &scr->rec : NULL;
+
+    /* Calculate nsys times for statistics */
+    for(size_t isys = 0; isys < nsys; isys++) {
+        if(rec)
+            RayCacheBegin(rec, pp->nray);
+
+        double t_rays = SpUtil_WallTime();
+        if(rc && rc->nray == pp->nray)
+            ReplayRays(tid, zp, rc, ds0, vfac0, intensity, tau);
+        else if(glb.qmc)
+            CalcRays_QRNG(tid, zp, ds0, vfac0, intensity, tau, rec);
+        else
+            CalcRays_RNG(tid, izone, isys, zp, ds0, vfac0, intensity, tau, rec);
+        scr->stats.t_rays += SpUtil_WallTime() - t_rays;
+        scr->stats.nray += pp->nray;
 
-            if(glb.qmc)
-                CalcRays_QRNG(tid, zp, ds0, vfac0, intensity, tau);
-            else
-                CalcRays_RNG(tid, zp, ds0, vfac0, intensity, tau);
+        if(rec && !SpUtil_TermThread())
+            RayCacheCommit(rc, rec);
 
-            #if  TIMER
-            float Tmc = (float)(clock() - start) / (float)CLOCKS_PER_SEC;
-            #endif
+        BuildRateMatrix(tid, pp, ds0, vfac0, intensity, tau, &rmat[isys * NLEV * NLEV]);
+    }
 
-            CalcDetailedBalance(tid, pp, ds0, vfac0, intensity, tau);
+    if(glb.qmc && !glb.fully_random)
+        gsl_qrng_free(glb.qrng[tid]);
 
-            #if  TIMER
-            float Tall = (float)(clock() - start) / (float)CLOCKS_PER_SEC;
-            float Tdb =  Tall - Tmc;
+    return;
+}
 
-            Tmc_thread += Tmc;
-            Tdb_thread += Tdb;
-            Tall_thread += Tall;
-            #endif
+/*----------------------------------------------------------------------------*/
 
-            if(glb.stage == STAGE_RAN){
-                for(size_t i = 0; i < NLEV; i++) {
-                    HIST(ihist, i) = pp->pops_update[i];
-                }
-            }
+static void UpdateZone(size_t tid, size_t izone, size_t nsys, double *pops, const int *singular, double t_zone)
+/* Update pops of zone izone from the nsys solutions of its rate equations
+ * in pops, and check convergence */
+{
+    Zone *zp = glb.zones[izone];
+    SpPhys *pp = zp->data;
+    double *hist = pops;
+
+    for(size_t isys = 0; isys < nsys; isys++) {
+        /* Keep the old pops if the rate equations could not be solved */
+        if(singular[isys]) {
+            Sp_PWARN("singular rate equations in zone <%lu,%lu,%lu>, pops not updated\n",
+                     GeVec3_X(pp->zp->index, 0),
+                     GeVec3_X(pp->zp->index, 1),
+                     GeVec3_X(pp->zp->index, 2));
+            Mem_MEMCPY(&HIST(isys, 0), pp->pops_preserve, NLEV);
         }
 
-        if(glb.qmc && !glb.fully_random)
-            gsl_qrng_free(glb.qrng[tid]);
-
-        /* ================ */
-        /* modified by I-Ta */
-        double diff;
-        if (glb.stage == STAGE_RAN){
-            // Stage 2, calculate difference by inner loop: Monte Carlo noise
-            diff = CalcDiff(hist, NULL,izone,tid);
-            pp->diff=diff;
+        /* Zero out negative/uncertain pops */
+        for(size_t i = 0; i < NLEV; i++) {
+            if(HIST(isys, i) < 0)
+                HIST(isys, i) = 0.0;
         }
-        else{
-            // Stage 1, calculate difference by outer loop: iterative noise
-            diff = 0.0;
-            for(size_t i = 0; i < NLEV; i++) {
-                if( pp->pops_update[i] > glb.minpop ){
-                    double temp =
-                        fabs( pp->pops_update[i] - pp->pops_preserve[i] ) / pp->pops_update[i];
-                    diff = ( diff>temp? diff:temp );
-                }
+    }
+
+    /* ================ */
+    /* modified by I-Ta */
+    double diff, sigma = 0.0;
+    if (glb.stage == STAGE_RAN){
+        // Stage 2, calculate difference by inner loop: Monte Carlo noise
+        diff = CalcDiff(hist, NULL, &sigma, izone, tid);
+        pp->diff=diff;
+    }
+    else{
+        Mem_MEMCPY(pp->pops_update, pops, NLEV);
+
+        // Stage 1, calculate difference by outer loop: iterative noise
+        diff = 0.0;
+        for(size_t i = 0; i < NLEV; i++) {
+            if( pp->pops_update[i] > glb.minpop ){
+                double temp =
+                    fabs( pp->pops_update[i] - pp->pops_preserve[i] ) / pp->pops_update[i];
+                diff = ( diff>temp? diff:temp );
             }
         }
-        /* ================ */
+        /* Kept for waking frozen neighbours */
+        pp->diff = diff;
+    }
+    /* ================ */
+
+    /* Measure cost per ray for scheduling the next iteration */
+    glb.zone_tpr[izone] = t_zone / (double)pp->nray;
+
+    /* Lock mutex for global parameters */
+    pthread_mutex_lock(&glb.exc_mutex);
+
+    /* Update max_diff */
+    if( diff > glb.max_diff )
+        glb.max_diff = diff;
+
+    /* Determine convergence and act accordingly */
+    /* The nray-doubling critiria modified by I-Ta */
+    size_t nray = pp->nray;
+    if( glb.fully_random ){
+        if( diff < MCNOISE )
+            glb.nconv += 1;
+        if( diff > 0.5 * MCNOISE )
+            nray = glb.adaptive_rays ? NextNray(nray, sigma) : nray * 4;
+    }
+    else{
+        if( diff < TOLERANCE )
+            glb.nconv += 1;
+    }
+
 
+    /* The old critiria
+     *		if(diff <= (glb.fully_random ? MCNOISE : TOLERANCE)) {
+     *			glb.nconv += 1;
+}
+else if(!glb.fully_random) {
+    //debug
+    //pp->nray += (size_t)(0.01 * glb.nray);
+}
+else {
+    pp->nray *= 4;
+}
+*/
 
 
+    /* Make sure nray does not exceed upper limit */
+    if(nray > MAXRAYS) {
+        nray = MAXRAYS;
+    }
+    glb.zone_nray[izone] = nray;
 
-        /* Lock mutex for global parameters */
-        pthread_mutex_lock(&glb.exc_mutex);
+    /* Update total number of rays */
+    glb.nray_tot += nray;
 
-        /* Update max_diff */
-        if( diff > glb.max_diff )
-            glb.max_diff = diff;
+    /* Unlock mutex */
+    pthread_mutex_unlock(&glb.exc_mutex);
 
-        /* Determine convergence and act accordingly */
-        /* The nray-doubling critiria modified by I-Ta */
-        if( glb.fully_random ){
-            if( diff < MCNOISE )
-                glb.nconv += 1;
-            if( diff > 0.5 * MCNOISE )
-                pp->nray *= 4;
-        }
-        else{
-            if( diff < TOLERANCE )
-                glb.nconv += 1;
-        }
+    return;
+}
 
+/*----------------------------------------------------------------------------*/
 
-        /* The old critiria
-         *		if(diff <= (glb.fully_random ? MCNOISE : TOLERANCE)) {
-         *			glb.nconv += 1;
-    }
-    else if(!glb.fully_random) {
-        //debug
-        //pp->nray += (size_t)(0.01 * glb.nray);
-    }
-    else {
-        pp->nray *= 4;
-    }
-    */
+/* Velocity offsets closer than this (m/s), far below any line width, are
+ * treated as equal */
+#define OL_DV_TOL 1.0e-3
 
+static void InitOverlapPairs(void)
+/* Compress the overlapping table into lists of the partners of each line
+ * for XferSegment() */
+{
+    size_t npair = 0;
 
-        /* Make sure nray does not exceed upper limit */
-        if(pp->nray > MAXRAYS) {
-            pp->nray = MAXRAYS;
+    for(size_t i = 0; i < NRAD; i++) {
+        for(size_t j = 0; j < NRAD; j++) {
+            if(i != j && OVERLAP(i,j) == 1)
+                npair += 1;
         }
+    }
+
+    glb.ol_start = Mem_CALLOC(NRAD + 1, glb.ol_start);
+    glb.ol_line = Mem_CALLOC(Num_MAX(1, npair), glb.ol_line);
+    glb.ol_idx = Mem_CALLOC(Num_MAX(1, npair), glb.ol_idx);
+    glb.ol_dv = Mem_CALLOC(Num_MAX(1, npair), glb.ol_dv);
+    glb.nol_dv = 0;
 
-        /* Update total number of rays */
-        glb.nray_tot += pp->nray;
+    size_t k = 0;
+    for(size_t i = 0; i < NRAD; i++) {
+        glb.ol_start[i] = k;
+        for(size_t j = 0; j < NRAD; j++) {
+            if(i == j || OVERLAP(i,j) != 1)
+                continue;
 
-        /* Unlock mutex */
-        pthread_mutex_unlock(&glb.exc_mutex);
+            /* Look for a pair with the same velocity offset */
+            size_t idv;
+            for(idv = 0; idv < glb.nol_dv; idv++) {
+                if(fabs(glb.ol_dv[idv] - RELVEL(i,j)) <= OL_DV_TOL)
+                    break;
+            }
+            if(idv == glb.nol_dv)
+                glb.ol_dv[glb.nol_dv++] = RELVEL(i,j);
 
-        free(ds0);
-        free(vfac0);
-        free(intensity);
-        free(tau);
+            glb.ol_line[k] = j;
+            glb.ol_idx[k] = idv;
+            k += 1;
+        }
     }
-    #if TIMER
-    printf("Tid = %zu , total time = %f, Detailed Balance percentage: %f % \n", tid, Tall_thread, 100.*Tdb_thread/Tall_thread);
-    #endif
-    #undef TIMER
+    glb.ol_start[NRAD] = k;
 
-    free(hist);
-    pthread_exit(NULL);
+    Sp_PRINT("%g overlapping line pairs, %g distinct velocity offsets\n", (double)npair, (double)glb.nol_dv);
 
+    return;
 }
 
+#undef OL_DV_TOL
+
 /*----------------------------------------------------------------------------*/
 
-static void SyncProcs(void)
+static void InitLineCoeffs(void)
+/* Pack the line data and point the line coeffs of all zones into the
+ * pool */
 {
-    /* Sync pops from all processes and threads */
-    for(size_t i = 0; i < glb.nzone; i++)
-        SyncPops(i);
+    glb.lines = SpPhys_AllocLineTab(glb.model.parms.mol);
+    glb.line_pool = Mem_CALLOC(Num_MAX(1, 2 * NRAD * glb.nzone), glb.line_pool);
 
-    #ifdef HAVE_MPI
-    if(Sp_MPISIZE > 1) {
-        /* Sync total number of rays */
-        int glb_nray_tot = (int)glb.nray_tot;
-        int nray_tot_buff;
-        MPI_Reduce(&glb_nray_tot, &nray_tot_buff, 1, MPI_INT, MPI_SUM, 0, MPI_COMM_WORLD);
-        glb_nray_tot = (int)nray_tot_buff;
-        MPI_Bcast(&glb_nray_tot, 1, MPI_INT, 0, MPI_COMM_WORLD);
-        glb.nray_tot = (size_t)glb_nray_tot;
+    for(size_t izone = 0; izone < glb.nzone; izone++) {
+        SpPhys *pp = glb.zones[izone]->data;
 
-        /* Sync total number of converged zones */
-        int glb_nconv = (int)glb.nconv;
-        int nconv_buff;
-        MPI_Reduce(&glb_nconv, &nconv_buff, 1, MPI_INT, MPI_SUM, 0, MPI_COMM_WORLD);
-        glb_nconv = nconv_buff;
-        MPI_Bcast(&glb_nconv, 1, MPI_INT, 0, MPI_COMM_WORLD);
-        glb.nconv = (size_t)glb_nconv;
+        pp->line_j = &glb.line_pool[2 * NRAD * izone];
+        pp->line_k = pp->line_j + NRAD;
+    }
 
-        /* Gather max_diff from all processes */
-        double max_diff_buff[Sp_MPISIZE];
-        MPI_Gather(&glb.max_diff, 1, MPI_DOUBLE, max_diff_buff, 1, MPI_DOUBLE, 0, MPI_COMM_WORLD);
+    return;
+}
 
-        if(Sp_MPIRANK == 0) {
-            /* Sort max_diff_buff to get largest max_diff */
-            Num_Qsort_d(max_diff_buff, Sp_MPISIZE);
-            glb.max_diff = max_diff_buff[Sp_MPISIZE - 1];
-        }
+/*----------------------------------------------------------------------------*/
 
-        /* Sync max_diff with master */
-        MPI_Bcast(&glb.max_diff, 1, MPI_DOUBLE, 0, MPI_COMM_WORLD);
+static void UpdateLineCoeffs(void)
+/* Calculate the line coeffs of all zones from pops_preserve, which is
+ * fixed during an iteration */
+{
+    for(size_t izone = 0; izone < glb.nzone; izone++) {
+        SpPhys *pp = glb.zones[izone]->data;
+
+        SpPhys_GetMoljkN(pp, glb.lines, pp->line_j, pp->line_k);
     }
-    #endif
 
     return;
 }
 
 /*----------------------------------------------------------------------------*/
 
-static void SyncPops(size_t izone)
+/* Iterations and accuracy of the LVG initial pops */
+#define LVG_MAXITER 100
+#define LVG_TOL 1.0e-6
+
+static void *InitPopsLVGThread(void *tid_p)
+/* Replace the initial pops of all zones by the solution of the rate
+ * equations in the Sobolev (large velocity gradient) approximation, each
+ * thread taking every Sp_NTHREAD'th zone */
 {
-    Zone *zp = glb.zones[izone];
-    SpPhys *pp = zp->data;
+    size_t tid = *((size_t *)tid_p), nfail = 0;
+    double *rmat = Mem_CALLOC(NLEV * NLEV, rmat);
+    double *cmat = Mem_CALLOC(NLEV * NLEV, cmat);
+    double *pops = Mem_CALLOC(NLEV, pops);
+    double *x = Mem_CALLOC(NLEV, x);
+    double *beta = Mem_CALLOC(NRAD, beta);
+
+    for(size_t izone = tid; izone < glb.nzone && !SpUtil_TermThread(); izone += Sp_NTHREAD) {
+        if(SolvePopsLVG(izone, rmat, cmat, pops, x, beta))
+            nfail += 1;
+    }
+
+    if(nfail > 0)
+        Sp_PWARN("LVG pops did not converge in %g zones, kept initial pops\n", (double)nfail);
+
+    free(rmat);
+    free(cmat);
+    free(pops);
+    free(x);
+    free(beta);
 
-    /* First copy pops from all other threads to thread 0 */
+    pthread_exit(NULL);
+}
 
-    Mem_MEMCPY(pp->pops_preserve, pp->pops_update, NLEV);
+/*----------------------------------------------------------------------------*/
 
-    #ifdef HAVE_MPI
-    /* Then sync results from all processes if using MPI */
-    size_t zone_rank = glb.zone_rank[izone];
-    MPI_Status mpi_status;
+static double LVGVelGrad(Zone *zp)
+/* Estimate the velocity gradient (1/s) of zone zp from the velocities at
+ * the centers of zp and its neighbours, projected onto their separations.
+ * The neighbours are the leaf zones entered by rays from the center of zp
+ * along the +-x, +-y and +-z axes (radially in and out for spherical
+ * flows), so they may belong to other parents or grid levels. For
+ * spherical flows the transverse gradient v_r/r is included, i.e. dv/ds
+ * is averaged over directions as (dv_r/dr + 2 v_r/r) / 3. The gradient is
+ * at least width/size of the zone, so that zones in a static medium do
+ * not become optically thick without bound. */
+{
+    const SpPhys *pp = zp->data;
+    int geom = zp->voxel.geom;
+    GeVec3_d pos = zp->voxel.cen, vmin = zp->voxel.min, vmax = zp->voxel.max;
+    GeVec3_d c0 = GeVec3_Geom2Cart((GEOM_TYPE)geom, &pos);
+    GeVec3_d v0 = SpPhys_GetVgas(&c0, zp);
+    GeVec3_d cmin = GeVec3_Geom2Cart((GEOM_TYPE)geom, &vmin);
+    GeVec3_d cmax = GeVec3_Geom2Cart((GEOM_TYPE)geom, &vmax);
+    double size = GeVec3_Mag2(&cmax, &cmin), r = GeVec3_Mag(&c0);
+    double grad = 0.0;
+    size_t ngrad = 0;
+
+    for(size_t axis = 0; axis < 3; axis++) {
+        if(geom == GEOM_SPH1D && (axis > 0 || !(r > 0)))
+            break;
 
-    if(Sp_MPISIZE > 1) {
-        /* Gather all calculated results to master process */
-        if(Sp_MPIRANK != 0) {
-            /* This is a slave process; send to master */
-            if(zone_rank == Sp_MPIRANK) {
-                MPI_Send(pp->pops_preserve, (int)NLEV, MPI_DOUBLE, 0, Sp_MPITAG, MPI_COMM_WORLD);
-                MPI_Send(pp->tau, (int)NRAD, MPI_DOUBLE, 0, Sp_MPITAG, MPI_COMM_WORLD);
-                MPI_Send(&pp->ds, 1, MPI_DOUBLE, 0, Sp_MPITAG, MPI_COMM_WORLD);
-
-                //MPI_Send(pp->J_bar, (int)NRAD, MPI_DOUBLE, 0, Sp_MPITAG, MPI_COMM_WORLD);
-                MPI_Send(&pp->nray, sizeof(size_t), MPI_CHAR, 0, Sp_MPITAG, MPI_COMM_WORLD);
-                //MPI_Send(&pp->diff, 1, MPI_DOUBLE, 0, Sp_MPITAG, MPI_COMM_WORLD);
-            }
-        }
-        else {
-            /* This is the master process; receive from a slave */
-            if(zone_rank != 0) {
-                MPI_Recv(pp->pops_preserve, (int)NLEV, MPI_DOUBLE, (int)zone_rank, Sp_MPITAG, MPI_COMM_WORLD, &mpi_status);
-                MPI_Recv(pp->tau, (int)NRAD, MPI_DOUBLE, (int)zone_rank, Sp_MPITAG, MPI_COMM_WORLD, &mpi_status);
-                MPI_Recv(&pp->ds, 1, MPI_DOUBLE, (int)zone_rank, Sp_MPITAG, MPI_COMM_WORLD, &mpi_status);
-
-                //MPI_Recv(pp->J_bar, (int)NRAD, MPI_DOUBLE, (int)zone_rank, Sp_MPITAG, MPI_COMM_WORLD, &mpi_status);
-                MPI_Recv(&pp->nray, sizeof(size_t), MPI_CHAR, (int)zone_rank, Sp_MPITAG, MPI_COMM_WORLD, &mpi_status);
-                //MPI_Recv(&pp->diff, 1, MPI_DOUBLE, (int)zone_rank, Sp_MPITAG, MPI_COMM_WORLD, &mpi_status);
+        for(int step = -1; step <= 1; step += 2) {
+            GeVec3_d dir = GeVec3_INIT(0.0, 0.0, 0.0);
+            if(geom == GEOM_SPH1D)
+                dir = GeVec3_Scale(&c0, (double)step / r);
+            else
+                GeVec3_X(dir, axis) = (double)step;
+
+            /* Walk to the face of zp and step into the next zone */
+            GeRay ray = GeRay_Init(GeVec3_X(c0, 0), GeVec3_X(c0, 1), GeVec3_X(c0, 2),
+                                   GeVec3_X(dir, 0), GeVec3_X(dir, 1), GeVec3_X(dir, 2));
+            size_t plane = 6;
+            double t = 0;
+            GeRay_TraverseVoxel(&ray, &zp->voxel, &t, &plane);
+            ray = GeRay_Inc(&ray, t);
+            const Zone *zn = Zone_GetNext(zp, &plane, &ray);
+            if(!zn)
+                continue;
+
+            const SpPhys *pn = zn->data;
+            if(!pn->non_empty_leaf)
+                continue;
+
+            GeVec3_d npos = zn->voxel.cen;
+            GeVec3_d c1 = GeVec3_Geom2Cart((GEOM_TYPE)geom, &npos);
+            GeVec3_d v1 = SpPhys_GetVgas(&c1, zn);
+            GeVec3_d dc = GeVec3_Sub(&c1, &c0), dv = GeVec3_Sub(&v1, &v0);
+            double dc2 = GeVec3_DotProd(&dc, &dc);
+
+            if(dc2 > 0) {
+                grad += fabs(GeVec3_DotProd(&dv, &dc)) / dc2;
+                ngrad += 1;
             }
         }
+    }
 
-        /* Sync all processes with master */
-        MPI_Bcast(pp->pops_preserve, (int)NLEV, MPI_DOUBLE, 0, MPI_COMM_WORLD);
-        MPI_Bcast(pp->tau, (int)NRAD, MPI_DOUBLE, 0, MPI_COMM_WORLD);
+    if(ngrad > 0)
+        grad /= (double)ngrad;
 
-        //MPI_Bcast(pp->J_bar, (int)NRAD, MPI_DOUBLE, 0, MPI_COMM_WORLD);
-        MPI_Bcast(&pp->nray, sizeof(size_t), MPI_CHAR, 0, MPI_COMM_WORLD);
-        //MPI_Bcast(&pp->diff, 1, MPI_DOUBLE, 0, MPI_COMM_WORLD);
+    if(geom == GEOM_SPH1D) {
+        if(r > 0)
+            grad = (grad + 2.0 * fabs(GeVec3_X(pp->v_cen, 0)) / r) / 3.0;
     }
-    #endif
 
+    if(size > 0)
+        grad = Num_MAX(grad, pp->width / size);
 
-    return;
+    return grad;
 }
 
 /*----------------------------------------------------------------------------*/
 
-static void CalcRays_RNG(size_t tid, Zone *zone, double *ds0, double *vfac0,
-                         double *intensity, double *tau)
-/* Collect `external' contribution to local mean radiation field (J_bar)
- * by shooting NRAY rays in random directions and calculating the
- * corresponding intensity.
- */
+static int SolvePopsLVG(size_t izone, double *rmat, double *cmat, double *pops, double *x, double *beta)
+/* Solve the rate equations of zone izone with escape probabilities
+ * beta = (1 - exp(-tau)) / tau of the Sobolev optical depths
+ *	tau = h c n_mol (n_l B_lu - n_u B_ul) / (4 pi dv/ds),
+ * iterating on beta from the optically thin limit, and store the result in
+ * pops_preserve. The local radiation field is J_bar = (1 - beta) S + beta
+ * I_cmb, so the net radiative rates are those of beta * A_ul in the CMB.
+ * Dust and other continua are ignored. Returns nonzero (and keeps the old
+ * pops) if the iteration fails. */
 {
-    SpPhys *pp = zone->data;
-    Deb_ASSERT(pp->nray > 0); /* Just in case */
+    static const double KONST = PHYS_CONST_MKS_PLANCKH * PHYS_CONST_MKS_LIGHTC / (4.0 * PHYS_CONST_PI);
+    Zone *zp = glb.zones[izone];
+    SpPhys *pp = zp->data;
+    double n_mol = pp->n_H2 * pp->X_mol, grad = LVGVelGrad(zp);
+    int singular = 0, converged = 0;
 
-    #if debug_ray
-    cpgopen("/xs");
-    Vox_Cpgenv(&zone->root->voxel);
-    Zone_Cpgplot(zone->root, &cam);
-    cpgupdt();
-    #endif
+    #define RMAT(i, j) \
+    rmat[(j) + NLEV * (i)]
 
-    /* Reset pp->ds */
-    pp->ds = 0;
+    SpPhys_FillCollRates(pp, &glb.coll_K[glb.zone_coll[izone] * glb.ncoll_K], cmat);
+    Mem_MEMCPY(pops, pp->pops_preserve, NLEV);
+    for(size_t i = 0; i < NRAD; i++)
+        beta[i] = 1.0;
 
-    /* Reset tau */
+    for(size_t iter = 0; iter < LVG_MAXITER && !converged && !singular; iter++) {
+        Mem_MEMCPY(rmat, cmat, NLEV * NLEV);
+
+        for(size_t i = 0; i < NRAD; i++) {
+            size_t up = RAD(i)->up, lo = RAD(i)->lo;
+            double I_bg = glb.I_cmb[i] * glb.I_norm[i];
+            double R_ul = beta[i] * (RAD(i)->A_ul + RAD(i)->B_ul * I_bg);
+            double R_lu = beta[i] * RAD(i)->B_lu * I_bg;
+
+            RMAT(up, up) -= R_ul;
+            RMAT(lo, lo) -= R_lu;
+            RMAT(up, lo) += R_lu;
+            RMAT(lo, up) += R_ul;
+        }
+        for(size_t j = 0; j < NLEV; j++)
+            RMAT(NLEV - 1, j) = 1.0;
+
+        /* Solve with the RHS (0, ..., 0, 1) */
+        Mem_BZERO2(x, NLEV);
+        x[NLEV - 1] = 1.0;
+        if(Num_LUDecompSolveBatch(rmat, NLEV, 1, x, &singular) > 0)
+            break;
+
+        /* Check convergence, then damp oscillations of the solution */
+        double diff = 0.0;
+        for(size_t j = 0; j < NLEV; j++) {
+            if(!(x[j] >= 0.0))
+                x[j] = 0.0;
+            if(x[j] >= glb.minpop)
+                diff = Num_MAX(diff, fabs(x[j] - pops[j]) / x[j]);
+            pops[j] = (iter < 4) ? x[j] : 0.5 * (x[j] + pops[j]);
+        }
+        converged = (iter > 0 && diff < LVG_TOL);
+
+        for(size_t i = 0; i < NRAD; i++) {
+            size_t up = RAD(i)->up, lo = RAD(i)->lo;
+            double tau = KONST * n_mol * (pops[lo] * RAD(i)->B_lu - pops[up] * RAD(i)->B_ul) / grad;
+
+            beta[i] = (tau > 1.0e-6) ? (1.0 - exp(-tau)) / tau : 1.0;
+        }
+    }
+
+    #undef RMAT
+
+    if(!converged)
+        return 1;
+
+    Mem_MEMCPY(pp->pops_preserve, pops, NLEV);
+
+    return 0;
+}
+
+#undef LVG_MAXITER
+#undef LVG_TOL
+
+/*----------------------------------------------------------------------------*/
+
+static void ScratchAlloc(Scratch *scr)
+/* Allocate the fixed-size scratch buffers of one thread */
+{
+    scr->nray_max = 0;
+    scr->dtau = Mem_CALLOC(NRAD, scr->dtau);
+    scr->J_bar = Mem_CALLOC(NRAD, scr->J_bar);
+    scr->L_star = Mem_CALLOC(NRAD, scr->L_star);
+    scr->ol_vfac = Mem_CALLOC(Num_MAX(1, glb.nol_dv), scr->ol_vfac);
+    scr->j_nu = Mem_CALLOC(NRAD, scr->j_nu);
+    scr->k_nu = Mem_CALLOC(NRAD, scr->k_nu);
+    scr->blk_rmat = Mem_CALLOC(DB_BLOCK * NHIST * NLEV * NLEV, scr->blk_rmat);
+    scr->blk_pops = Mem_CALLOC(DB_BLOCK * NHIST * NLEV, scr->blk_pops);
+    scr->blk_sing = Mem_CALLOC(DB_BLOCK * NHIST, scr->blk_sing);
+
+    return;
+}
+
+/*----------------------------------------------------------------------------*/
+
+static void ScratchReserve(Scratch *scr, size_t nray)
+/* Make sure the ray buffers can hold nray rays */
+{
+    if(nray <= scr->nray_max)
+        return;
+
+    /* Contents need not be kept: free and allocate instead of realloc */
+    double **bufs[] = {&scr->ds0, &scr->vfac0, &scr->intensity, &scr->tau};
+    size_t sizes[] = {nray, nray, nray * NRAD, nray * NRAD};
+
+    for(size_t i = 0; i < sizeof(bufs) / sizeof(bufs[0]); i++) {
+        if(*bufs[i])
+            free(*bufs[i]);
+        *bufs[i] = Mem_CALLOC(sizes[i], *bufs[i]);
+    }
+    scr->nray_max = nray;
+
+    return;
+}
+
+/*----------------------------------------------------------------------------*/
+
+static void ScratchFree(Scratch *scr)
+{
+    double **bufs[] = {
+        &scr->ds0, &scr->vfac0, &scr->intensity, &scr->tau, &scr->dtau, &scr->J_bar,
+        &scr->L_star, &scr->ol_vfac, &scr->j_nu, &scr->k_nu, &scr->blk_rmat, &scr->blk_pops
+    };
+
+    for(size_t i = 0; i < sizeof(bufs) / sizeof(bufs[0]); i++) {
+        if(*bufs[i])
+            free(*bufs[i]);
+        *bufs[i] = NULL;
+    }
+    scr->nray_max = 0;
+
+    if(scr->blk_sing)
+        free(scr->blk_sing);
+    scr->blk_sing = NULL;
+
+    RayCacheFree(&scr->rec);
+
+    return;
+}
+
+/*----------------------------------------------------------------------------*/
+
+static void ReleaseForeignZones(void)
+/* Return the collisional rates matrices (NLEV x NLEV per zone, by far the
+ * largest per-zone allocation) of zones owned by other processes to the
+ * pool, so that each process only keeps them for its own block of zones */
+{
+    if(Sp_MPISIZE < 2)
+        return;
+
+    for(size_t izone = 0; izone < glb.nzone; izone++) {
+        SpPhys *pp = glb.zones[izone]->data;
+
+        if(glb.zone_rank[izone] != Sp_MPIRANK && glb.cmat_slot[izone] != NO_SLOT) {
+            glb.cmat_free[glb.ncmat_free++] = glb.cmat_slot[izone];
+            glb.cmat_slot[izone] = NO_SLOT;
+            pp->cmat = NULL;
+        }
+    }
+
+    return;
+}
+
+/*----------------------------------------------------------------------------*/
+
+static double CollKey(double T_k)
+/* Temperature at which the collisional rate coeffs of a zone at T_k are
+ * interpolated: T_k rounded to a geometric grid of ratio 1 + coll_tres */
+{
+    if(glb.coll_tres > 0 && T_k > 0) {
+        double step = log1p(glb.coll_tres);
+        return exp(round(log(T_k) / step) * step);
+    }
+
+    return T_k;
+}
+
+/*----------------------------------------------------------------------------*/
+
+static void InitCollCoeffs(void)
+/* Interpolate downward collisional rate coeffs once for every distinct
+ * (quantized) T_k, instead of once per zone */
+{
+    glb.ncoll_K = SpPhys_CollCoeffsSize(glb.model.parms.mol);
+    glb.zone_coll = Mem_CALLOC(glb.nzone, glb.zone_coll);
+    glb.cmat_slot = Mem_CALLOC(glb.nzone, glb.cmat_slot);
+    for(size_t izone = 0; izone < glb.nzone; izone++)
+        glb.cmat_slot[izone] = NO_SLOT;
+
+    if(glb.nzone == 0)
+        return;
+
+    /* Collect distinct temperatures */
+    glb.coll_T = Mem_CALLOC(glb.nzone, glb.coll_T);
+    for(size_t izone = 0; izone < glb.nzone; izone++) {
+        SpPhys *pp = glb.zones[izone]->data;
+        glb.coll_T[izone] = CollKey(pp->T_k);
+    }
+    Num_Qsort_d(glb.coll_T, glb.nzone);
+
+    glb.ncoll_T = 1;
+    for(size_t i = 1; i < glb.nzone; i++) {
+        if(glb.coll_T[i] != glb.coll_T[glb.ncoll_T - 1])
+            glb.coll_T[glb.ncoll_T++] = glb.coll_T[i];
+    }
+    glb.coll_T = Mem_REALLOC(glb.ncoll_T, glb.coll_T);
+
+    /* Interpolate coeffs at each temperature */
+    glb.coll_K = Mem_CALLOC(Num_MAX(1, glb.ncoll_T * glb.ncoll_K), glb.coll_K);
+    for(size_t i = 0; i < glb.ncoll_T; i++)
+        SpPhys_GetCollCoeffs(glb.model.parms.mol, glb.coll_T[i], &glb.coll_K[i * glb.ncoll_K]);
+
+    /* Look up the coeffs of each zone */
+    for(size_t izone = 0; izone < glb.nzone; izone++) {
+        SpPhys *pp = glb.zones[izone]->data;
+        double *T = Num_Bsearch_d(CollKey(pp->T_k), glb.coll_T, glb.ncoll_T);
+
+        Deb_ASSERT(T != NULL);
+        glb.zone_coll[izone] = (size_t)(T - glb.coll_T);
+    }
+
+    if(Sp_MPIRANK == 0)
+        Sp_PRINT("Collisional rate coeffs interpolated at %lu temperature(s) for %lu zones\n",
+            (unsigned long)glb.ncoll_T, (unsigned long)glb.nzone);
+
+    return;
+}
+
+/*----------------------------------------------------------------------------*/
+
+static void AssignCollRates(void)
+/* Give every zone of this process a slot for its rates matrix in the pool,
+ * which is filled by CalcExcThread() the first time it works on the zone.
+ * Growing the pool may move it, so this must be called outside of the
+ * threads. */
+{
+    size_t nneed = 0;
+
+    for(size_t izone = 0; izone < glb.nzone; izone++) {
+        if(glb.zone_rank[izone] == Sp_MPIRANK && glb.cmat_slot[izone] == NO_SLOT)
+            nneed += 1;
+    }
+
+    /* Grow pool and make the new slots available */
+    if(nneed > glb.ncmat_free) {
+        size_t ngrow = nneed - glb.ncmat_free, nslot = glb.ncmat_slot + ngrow;
+
+        glb.cmat_pool = Mem_REALLOC(nslot * NLEV * NLEV, glb.cmat_pool);
+        glb.cmat_free = Mem_REALLOC(nslot, glb.cmat_free);
+        for(size_t i = glb.ncmat_slot; i < nslot; i++)
+            glb.cmat_free[glb.ncmat_free++] = i;
+        glb.ncmat_slot = nslot;
+
+        /* Point zones at their slots in the (possibly moved) pool */
+        for(size_t izone = 0; izone < glb.nzone; izone++) {
+            SpPhys *pp = glb.zones[izone]->data;
+
+            if(pp->cmat)
+                pp->cmat = &glb.cmat_pool[glb.cmat_slot[izone] * NLEV * NLEV];
+        }
+    }
+
+    for(size_t izone = 0; izone < glb.nzone; izone++) {
+        if(glb.zone_rank[izone] == Sp_MPIRANK && glb.cmat_slot[izone] == NO_SLOT)
+            glb.cmat_slot[izone] = glb.cmat_free[--glb.ncmat_free];
+    }
+
+    return;
+}
+
+/*----------------------------------------------------------------------------*/
+
+typedef struct {
+    const Zone *zp;
+    size_t izone;
+} ZoneRef;
+
+static int CompareZoneRef(const void *a, const void *b)
+{
+    uintptr_t za = (uintptr_t)((const ZoneRef *)a)->zp, zb = (uintptr_t)((const ZoneRef *)b)->zp;
+
+    return (za > zb) - (za < zb);
+}
+
+/*----------------------------------------------------------------------------*/
+
+static void InitActiveSet(void)
+/* Find the neighbours of every zone for waking frozen zones: zones of the
+ * same parent whose index differs by one along one axis. Neighbours across
+ * grid levels or periodic boundaries are not included; such zones are
+ * still rechecked every freeze_check iterations. */
+{
+    glb.zone_nconv = Mem_CALLOC(Num_MAX(1, glb.nzone), glb.zone_nconv);
+    glb.zone_frozen = Mem_CALLOC(Num_MAX(1, glb.nzone), glb.zone_frozen);
+    glb.zone_active = Mem_CALLOC(Num_MAX(1, glb.nzone), glb.zone_active);
+    glb.nbr_start = Mem_CALLOC(glb.nzone + 1, glb.nbr_start);
+
+    for(size_t izone = 0; izone < glb.nzone; izone++)
+        glb.zone_active[izone] = 1;
+
+    if(glb.freeze == 0 || glb.nzone == 0)
+        return;
+
+    /* Map zone pointers to zone indices */
+    ZoneRef *refs = Mem_CALLOC(glb.nzone, refs);
+    for(size_t izone = 0; izone < glb.nzone; izone++) {
+        refs[izone].zp = glb.zones[izone];
+        refs[izone].izone = izone;
+    }
+    qsort(refs, glb.nzone, sizeof(*refs), CompareZoneRef);
+
+    glb.nbr = Mem_CALLOC(6 * glb.nzone, glb.nbr);
+    size_t nnbr = 0;
+    for(size_t izone = 0; izone < glb.nzone; izone++) {
+        const Zone *zp = glb.zones[izone], *parent = zp->parent;
+
+        glb.nbr_start[izone] = nnbr;
+        if(!parent)
+            continue;
+
+        for(size_t axis = 0; axis < 3; axis++) {
+            for(int step = -1; step <= 1; step += 2) {
+                GeVec3_s idx = zp->index;
+
+                if(step < 0 && GeVec3_X(idx, axis) == 0)
+                    continue;
+                GeVec3_X(idx, axis) = (size_t)((long)GeVec3_X(idx, axis) + step);
+                if(GeVec3_X(idx, axis) >= GeVec3_X(parent->naxes, axis))
+                    continue;
+
+                ZoneRef key = {Zone_CHILD(parent, idx), 0};
+                ZoneRef *ref = bsearch(&key, refs, glb.nzone, sizeof(*refs), CompareZoneRef);
+
+                /* Neighbours without tracers are never computed */
+                if(ref)
+                    glb.nbr[nnbr++] = ref->izone;
+            }
+        }
+    }
+    glb.nbr_start[glb.nzone] = nnbr;
+
+    free(refs);
+
+    return;
+}
+
+/*----------------------------------------------------------------------------*/
+
+static void SelectActiveZones(size_t iter)
+/* Decide which zones are computed in this iteration: frozen zones are
+ * skipped unless they are due for a recheck, a neighbour changed by more
+ * than TOLERANCE in the last iteration, or convergence is being verified.
+ * All processes make the same decision from the synced pp->diff. */
+{
+    glb.nskip = 0;
+
+    for(size_t izone = 0; izone < glb.nzone; izone++) {
+        int active = 1;
+
+        if(!glb.fully_random && glb.freeze > 0 && !glb.full_sweep && glb.zone_frozen[izone] > 0) {
+            active = ((iter + 1 - glb.zone_frozen[izone]) % glb.freeze_check == 0);
+
+            for(size_t i = glb.nbr_start[izone]; !active && i < glb.nbr_start[izone + 1]; i++) {
+                SpPhys *pp = glb.zones[glb.nbr[i]]->data;
+                if(pp->diff >= TOLERANCE)
+                    active = 1;
+            }
+        }
+
+        glb.zone_active[izone] = active;
+        if(!active)
+            glb.nskip += 1;
+    }
+
+    return;
+}
+
+/*----------------------------------------------------------------------------*/
+
+static void UpdateActiveSet(size_t iter)
+/* Freeze zones that have converged for `freeze' consecutive iterations and
+ * thaw rechecked zones that changed again */
+{
+    glb.full_sweep = 0;
+
+    if(glb.freeze == 0)
+        return;
+
+    for(size_t izone = 0; izone < glb.nzone; izone++) {
+        SpPhys *pp = glb.zones[izone]->data;
+
+        if(glb.fully_random) {
+            glb.zone_nconv[izone] = 0;
+            glb.zone_frozen[izone] = 0;
+            continue;
+        }
+
+        if(!glb.zone_active[izone])
+            continue;
+
+        if(pp->diff < TOLERANCE) {
+            glb.zone_nconv[izone] += 1;
+            if(glb.zone_frozen[izone] == 0 && glb.zone_nconv[izone] >= glb.freeze)
+                glb.zone_frozen[izone] = iter + 1;
+        }
+        else {
+            glb.zone_nconv[izone] = 0;
+            glb.zone_frozen[izone] = 0;
+        }
+    }
+
+    return;
+}
+
+/*----------------------------------------------------------------------------*/
+
+static void StartTraceWrite(size_t iter)
+/* Start writing the trace file of iteration iter in the background */
+{
+    glb.trace_fname = Mem_Sprintf("%s.stage%d-%05d", glb.outf->name, glb.stage, iter);
+
+    /* Snapshot of the pops */
+    if(glb.trace_pops_only) {
+        if(!glb.trace_pops)
+            glb.trace_pops = Mem_CALLOC(Num_MAX(1, glb.nzone * NLEV), glb.trace_pops);
+        for(size_t izone = 0; izone < glb.nzone; izone++) {
+            SpPhys *pp = glb.zones[izone]->data;
+            Mem_MEMCPY(&glb.trace_pops[izone * NLEV], pp->pops_preserve, NLEV);
+        }
+    }
+
+    glb.trace_sts = 0;
+    if(pthread_create(&glb.trace_thread, NULL, TraceWriterThread, NULL) == 0) {
+        glb.trace_pending = 1;
+    }
+    else {
+        /* Write in the foreground instead */
+        TraceWriterThread(NULL);
+    }
+
+    return;
+}
+
+/*----------------------------------------------------------------------------*/
+
+static void *TraceWriterThread(void *arg)
+{
+    SpFile *tracefp = NULL;
+    int sts = SpIO_OpenFile2(glb.trace_fname, Sp_NEW, &tracefp);
+
+    if(!sts) {
+        if(glb.trace_pops_only)
+            sts = SpIO_H5WritePopsTable(tracefp->h5f_id, glb.trace_pops, glb.nzone, NLEV);
+        else
+            sts = SpIO_FwriteModel(tracefp, glb.model);
+        SpIO_CloseFile(tracefp);
+    }
+    glb.trace_sts = sts;
+
+    free(glb.trace_fname);
+    glb.trace_fname = NULL;
+
+    return NULL;
+}
+
+/*----------------------------------------------------------------------------*/
+
+static int FinishTraceWrite(void)
+/* Wait for the trace file being written, if any, and return its status.
+ * Called by all processes: trace files are written by the master, whose
+ * status is passed on to the others so that they all stop together. */
+{
+    if(glb.trace_pending) {
+        pthread_join(glb.trace_thread, NULL);
+        glb.trace_pending = 0;
+    }
+
+    #ifdef HAVE_MPI
+    if(Sp_MPISIZE > 1)
+        MPI_Bcast(&glb.trace_sts, 1, MPI_INT, 0, MPI_COMM_WORLD);
+    #endif
+
+    return glb.trace_sts;
+}
+
+/*----------------------------------------------------------------------------*/
+
+static void InitZoneQueue(void)
+/* Queue zones of this process for CalcExcThread(), most expensive first,
+ * so that the tail of each iteration is made of cheap zones. The cost of a
+ * zone is its time per ray measured in the last iteration times its
+ * current nray; before every zone has been timed, nray alone is used. */
+{
+    int timed = 1;
+
+    glb.nqueue = 0;
+    for(size_t izone = 0; izone < glb.nzone; izone++) {
+        SpPhys *pp = glb.zones[izone]->data;
+
+        glb.zone_nray[izone] = pp->nray;
+        if(glb.zone_rank[izone] != Sp_MPIRANK || !glb.zone_active[izone])
+            continue;
+        glb.queue[glb.nqueue++] = izone;
+        if(!(glb.zone_tpr[izone] > 0))
+            timed = 0;
+    }
+
+    glb.queue_cost = 0;
+    for(size_t iq = 0; iq < glb.nqueue; iq++) {
+        size_t izone = glb.queue[iq];
+        SpPhys *pp = glb.zones[izone]->data;
+
+        glb.zone_cost[izone] = (timed ? glb.zone_tpr[izone] : 1.0) * (double)pp->nray;
+        glb.queue_cost += glb.zone_cost[izone];
+    }
+
+    qsort(glb.queue, glb.nqueue, sizeof(*glb.queue), CompareZoneCost);
+    glb.queue_next = 0;
+
+    return;
+}
+
+/*----------------------------------------------------------------------------*/
+
+static int CompareZoneCost(const void *a, const void *b)
+/* Order zone indices by decreasing cost, then by increasing index */
+{
+    size_t ia = *(const size_t *)a, ib = *(const size_t *)b;
+
+    if(glb.zone_cost[ia] != glb.zone_cost[ib])
+        return (glb.zone_cost[ia] < glb.zone_cost[ib]) ? 1 : -1;
+
+    return (ia > ib) - (ia < ib);
+}
+
+/*----------------------------------------------------------------------------*/
+
+static int NextZoneChunk(size_t *begin, size_t *end)
+/* Hand the next chunk of the work queue, [begin, end), to the calling
+ * thread. Chunks hold about 1/(2 * Sp_NTHREAD) of the remaining cost and
+ * at least one zone, so they shrink as the queue drains (guided
+ * scheduling). Returns 0 when the queue is empty. */
+{
+    pthread_mutex_lock(&glb.queue_mutex);
+
+    double target = glb.queue_cost / (double)(2 * Sp_NTHREAD), cost = 0;
+
+    *begin = glb.queue_next;
+    while(glb.queue_next < glb.nqueue && (glb.queue_next == *begin || cost < target)) {
+        cost += glb.zone_cost[glb.queue[glb.queue_next]];
+        glb.queue_next += 1;
+    }
+    *end = glb.queue_next;
+    glb.queue_cost -= cost;
+
+    pthread_mutex_unlock(&glb.queue_mutex);
+
+    return *end > *begin;
+}
+
+/*----------------------------------------------------------------------------*/
+
+static void SyncProcs(void)
+{
+    /* Sync pops from all threads: pops_update of frozen zones skipped in
+     * this iteration is stale, and their pops_preserve (possibly
+     * extrapolated by NgAccelerate()) is kept */
+    for(size_t i = 0; i < glb.nzone; i++) {
+        if(!glb.zone_active[i])
+            continue;
+        SpPhys *pp = glb.zones[i]->data;
+        Mem_MEMCPY(pp->pops_preserve, pp->pops_update, NLEV);
+    }
+
+    #ifdef HAVE_MPI
+    if(Sp_MPISIZE > 1) {
+        /* Exchange pops, tau, ds, nray and diff of the zones owned by each
+         * process in a single collective: every process packs its own zones,
+         * in order of zone index, into records of NLEV + NRAD + 3 doubles */
+        #define NREC (NLEV + NRAD + 3)
+        int counts[Sp_MPISIZE], displs[Sp_MPISIZE];
+        for(size_t rank = 0; rank < Sp_MPISIZE; rank++)
+            counts[rank] = 0;
+        for(size_t i = 0; i < glb.nzone; i++)
+            counts[glb.zone_rank[i]] += (int)NREC;
+        displs[0] = 0;
+        for(size_t rank = 1; rank < Sp_MPISIZE; rank++)
+            displs[rank] = displs[rank - 1] + counts[rank - 1];
+
+        double *sendbuf = Mem_CALLOC(Num_MAX(1, (size_t)counts[Sp_MPIRANK]), sendbuf);
+        double *recvbuf = Mem_CALLOC(Num_MAX(1, glb.nzone * NREC), recvbuf);
+
+        /* Pack */
+        double *rec = sendbuf;
+        for(size_t i = 0; i < glb.nzone; i++) {
+            if(glb.zone_rank[i] != Sp_MPIRANK)
+                continue;
+            SpPhys *pp = glb.zones[i]->data;
+            Mem_MEMCPY(rec, pp->pops_preserve, NLEV);
+            Mem_MEMCPY(rec + NLEV, pp->tau, NRAD);
+            rec[NLEV + NRAD] = pp->ds;
+            rec[NLEV + NRAD + 1] = (double)pp->nray;
+            rec[NLEV + NRAD + 2] = pp->diff;
+            rec += NREC;
+        }
+
+        MPI_Allgatherv(sendbuf, counts[Sp_MPIRANK], MPI_DOUBLE,
+                       recvbuf, counts, displs, MPI_DOUBLE, MPI_COMM_WORLD);
+
+        /* Unpack zones owned by other processes */
+        for(size_t i = 0; i < glb.nzone; i++) {
+            size_t rank = glb.zone_rank[i];
+            rec = recvbuf + displs[rank];
+            displs[rank] += (int)NREC;
+            if(rank == Sp_MPIRANK)
+                continue;
+            SpPhys *pp = glb.zones[i]->data;
+            Mem_MEMCPY(pp->pops_preserve, rec, NLEV);
+            Mem_MEMCPY(pp->tau, rec + NLEV, NRAD);
+            pp->ds = rec[NLEV + NRAD];
+            pp->nray = (size_t)rec[NLEV + NRAD + 1];
+            pp->diff = rec[NLEV + NRAD + 2];
+        }
+        #undef NREC
+
+        free(sendbuf);
+        free(recvbuf);
+
+        /* Sync total number of rays */
+        int glb_nray_tot = (int)glb.nray_tot;
+        int nray_tot_buff;
+        MPI_Reduce(&glb_nray_tot, &nray_tot_buff, 1, MPI_INT, MPI_SUM, 0, MPI_COMM_WORLD);
+        glb_nray_tot = (int)nray_tot_buff;
+        MPI_Bcast(&glb_nray_tot, 1, MPI_INT, 0, MPI_COMM_WORLD);
+        glb.nray_tot = (size_t)glb_nray_tot;
+
+        /* Sync total number of converged zones */
+        int glb_nconv = (int)glb.nconv;
+        int nconv_buff;
+        MPI_Reduce(&glb_nconv, &nconv_buff, 1, MPI_INT, MPI_SUM, 0, MPI_COMM_WORLD);
+        glb_nconv = nconv_buff;
+        MPI_Bcast(&glb_nconv, 1, MPI_INT, 0, MPI_COMM_WORLD);
+        glb.nconv = (size_t)glb_nconv;
+
+        /* Gather max_diff from all processes */
+        double max_diff_buff[Sp_MPISIZE];
+        MPI_Gather(&glb.max_diff, 1, MPI_DOUBLE, max_diff_buff, 1, MPI_DOUBLE, 0, MPI_COMM_WORLD);
+
+        if(Sp_MPIRANK == 0) {
+            /* Sort max_diff_buff to get largest max_diff */
+            Num_Qsort_d(max_diff_buff, Sp_MPISIZE);
+            glb.max_diff = max_diff_buff[Sp_MPISIZE - 1];
+        }
+
+        /* Sync max_diff with master */
+        MPI_Bcast(&glb.max_diff, 1, MPI_DOUBLE, 0, MPI_COMM_WORLD);
+    }
+    #endif
+
+    return;
+}
+
+/*----------------------------------------------------------------------------*/
+
+static int WriteTelemetry(size_t iter, double t_wall, double t_sync)
+/* Append the telemetry record of iteration iter to the telemetry file:
+ * t_wall is the time spent in the excitation threads and t_sync in
+ * SyncProcs(). Called by all processes, since the counters of the other
+ * processes are gathered to the master, and returns the status of the
+ * master on all of them. */
+{
+    int sts = 0;
+
+    /* Counters of this process: time in SyncProcs(), peak resident set
+     * size (kB), and nray, nseg, t_rays, t_busy, t_idle of every thread */
+    #define NSTAT 5
+    size_t nrec = 2 + NSTAT * Sp_NTHREAD;
+    double *rec = Mem_CALLOC(nrec, rec), *all = rec;
+    struct rusage usage;
+
+    rec[0] = t_sync;
+    rec[1] = getrusage(RUSAGE_SELF, &usage) ? 0.0 : (double)usage.ru_maxrss;
+    for(size_t i = 0; i < Sp_NTHREAD; i++) {
+        const ThreadStats *st = &glb.scratch[i].stats;
+        double *p = &rec[2 + NSTAT * i];
+        p[0] = (double)st->nray;
+        p[1] = (double)st->nseg;
+        p[2] = st->t_rays;
+        p[3] = st->t_busy;
+        p[4] = st->t_idle;
+    }
+
+    #ifdef HAVE_MPI
+    if(Sp_MPISIZE > 1) {
+        if(Sp_MPIRANK == 0)
+            all = Mem_CALLOC(nrec * Sp_MPISIZE, all);
+        MPI_Gather(rec, (int)nrec, MPI_DOUBLE, all, (int)nrec, MPI_DOUBLE, 0, MPI_COMM_WORLD);
+    }
+    #endif
+
+    if(Sp_MPIRANK == 0) {
+        FILE *fp = glb.tel_fp;
+
+        fprintf(fp, "{\"out\": \"%s\", \"stage\": \"%s\", \"iter\": %lu, \"nconv\": %lu, \"nskip\": %lu, \"nzone\": %lu, "
+                "\"max_diff\": %.6e, \"nray_tot\": %lu, \"t_wall\": %.6e, \"procs\": [",
+                glb.outf->name, glb.stage == STAGE_FIX ? "fix" : "ran", (unsigned long)iter + 1,
+                (unsigned long)glb.nconv, (unsigned long)glb.nskip, (unsigned long)glb.nzone,
+                glb.max_diff, (unsigned long)glb.nray_tot, t_wall);
+
+        for(size_t rank = 0; rank < Sp_MPISIZE; rank++) {
+            const double *r = &all[nrec * rank];
+            fprintf(fp, "%s{\"rank\": %lu, \"t_sync\": %.6e, \"maxrss_kb\": %.0f, \"threads\": [",
+                    rank > 0 ? ", " : "", (unsigned long)rank, r[0], r[1]);
+            for(size_t i = 0; i < Sp_NTHREAD; i++) {
+                const double *p = &r[2 + NSTAT * i];
+                /* Time in the rate equations is the busy time not spent
+                 * tracing rays */
+                fprintf(fp, "%s{\"nray\": %.0f, \"nseg\": %.0f, \"t_rays\": %.6e, \"t_rates\": %.6e, \"t_idle\": %.6e}",
+                        i > 0 ? ", " : "", p[0], p[1], p[2], Num_MAX(p[3] - p[2], 0.0), p[4]);
+            }
+            fprintf(fp, "]}");
+        }
+        fprintf(fp, "]}\n");
+
+        if(ferror(fp) || fflush(fp))
+            sts = 1;
+    }
+    #undef NSTAT
+
+    /* All processes stop together if the master failed to write */
+    #ifdef HAVE_MPI
+    if(Sp_MPISIZE > 1)
+        MPI_Bcast(&sts, 1, MPI_INT, 0, MPI_COMM_WORLD);
+    #endif
+
+    if(all != rec)
+        free(all);
+    free(rec);
+
+    return sts;
+}
+
+/*----------------------------------------------------------------------------*/
+
+static void CalcRays_RNG(size_t tid, size_t izone, size_t isys, Zone *zone, double *ds0,
+                         double *vfac0, double *intensity, double *tau, RayCache *rec)
+/* Collect `external' contribution to local mean radiation field (J_bar)
+ * by shooting NRAY rays in random directions and calculating the
+ * corresponding intensity. Rays are recorded in rec if it is not NULL.
+ * With crng, ray i of set isys is drawn from its own stream.
+ */
+{
+    SpPhys *pp = zone->data;
+    Deb_ASSERT(pp->nray > 0); /* Just in case */
+
+    #if debug_ray
+    cpgopen("/xs");
+    Vox_Cpgenv(&zone->root->voxel);
+    Zone_Cpgplot(zone->root, &cam);
+    cpgupdt();
+    #endif
+
+    /* Reset pp->ds */
+    pp->ds = 0;
+
+    /* Reset tau */
     Mem_BZERO2(tau, pp->nray * NRAD);
 
+    /* Stream of the rays: stage, set and iteration (the fixed rays stage
+     * uses the same rays in every iteration) */
+    uint32_t stream = ((uint32_t)glb.stage << 30) | ((uint32_t)isys << 24)
+        | (glb.fully_random ? (uint32_t)glb.iter & 0xffffffU : 0);
+
     for(size_t i = 0; i < pp->nray; i++) {
+        if(glb.crng)
+            Num_PhiloxSetStream(glb.rng[tid], glb.seed, (uint32_t)i, (uint32_t)izone, stream);
+
         /* Set random ray origin and direction */
         GeRay ray = GeRay_Rand(glb.rng[tid], &zone->voxel);
 
@@ -1139,7 +2535,7 @@ static void CalcRays_RNG(size_t tid, Zone *zone, double *ds0, double *vfac0,
         #undef PRAND
 
         /* Calculate radiative transfer along this direction */
-        RadiativeXfer(tid, zone, &ray, vel, &ds0[i], &vfac0[i], &INTENSITY(i, 0), &TAU(i, 0));
+        RadiativeXfer(tid, zone, &ray, vel, &ds0[i], &vfac0[i], &INTENSITY(i, 0), &TAU(i, 0), rec);
     }
 
     #if debug_ray
@@ -1156,10 +2552,10 @@ static void CalcRays_RNG(size_t tid, Zone *zone, double *ds0, double *vfac0,
 /*----------------------------------------------------------------------------*/
 
 static void CalcRays_QRNG(size_t tid, Zone *zone, double *ds0, double *vfac0,
-                          double *intensity, double *tau)
+                          double *intensity, double *tau, RayCache *rec)
 /* Collect `external' contribution to local mean radiation field (J_bar)
  * by shooting NRAY rays in random directions and calculating the
- * corresponding intensity.
+ * corresponding intensity. Rays are recorded in rec if it is not NULL.
  */
 {
     SpPhys *pp = zone->data;
@@ -1182,7 +2578,7 @@ static void CalcRays_QRNG(size_t tid, Zone *zone, double *ds0, double *vfac0,
         + GeVec3_DotProd(&v_gas, &ray.d);
 
         /* Calculate radiative transfer along this direction */
-        RadiativeXfer(tid, zone, &ray, vel, &ds0[i], &vfac0[i], &INTENSITY(i, 0), &TAU(i, 0));
+        RadiativeXfer(tid, zone, &ray, vel, &ds0[i], &vfac0[i], &INTENSITY(i, 0), &TAU(i, 0), rec);
     }
 
     /* Calculate average path length */
@@ -1193,10 +2589,60 @@ static void CalcRays_QRNG(size_t tid, Zone *zone, double *ds0, double *vfac0,
 
 /*----------------------------------------------------------------------------*/
 
+static void ReplayRays(size_t tid, Zone *zone, const RayCache *rc, double *ds0,
+                       double *vfac0, double *intensity, double *tau)
+/* Same as CalcRays_RNG()/CalcRays_QRNG(), but for rays recorded in rc:
+ * only the emission and absorption along the segments are recalculated */
+{
+    SpPhys *pp = zone->data;
+
+    /* Reset pp->ds */
+    pp->ds = 0;
+
+    for(size_t i = 0; i < rc->nray; i++) {
+        /* Check for thread termination */
+        if(SpUtil_TermThread()) break;
+
+        /* Reset intensity, tau, ds0 and vfac0 */
+        Mem_BZERO2(&INTENSITY(i, 0), NRAD);
+        Mem_BZERO2(&TAU(i, 0), NRAD);
+        ds0[i] = 0;
+        vfac0[i] = 0;
+
+        for(size_t iseg = rc->seg_start[i]; iseg < rc->seg_start[i + 1]; iseg++) {
+            const RaySeg *seg = &rc->seg[iseg];
+
+            /* Increment average path length counter */
+            pp->ds += seg->t;
+
+            if(iseg == rc->seg_start[i]) {
+                /* First step is handled in CalcJbar() */
+                ds0[i] = seg->t * Sp_LENFAC;
+                vfac0[i] = seg->vfac;
+            }
+            else {
+                XferSegment(tid, seg->zp, seg->t, seg->vfac, NULL, 0.0, &INTENSITY(i, 0), &TAU(i, 0));
+            }
+        }
+
+        /* Add boundary intensity */
+        for(size_t j = 0; j < NRAD; j++)
+            INTENSITY(i, j) += rc->I_bc[i][j] * exp(-TAU(i, j));
+    }
+
+    /* Calculate average path length */
+    pp->ds /= (double)rc->nray;
+
+    return;
+}
+
+/*----------------------------------------------------------------------------*/
+
 static void RadiativeXfer(size_t tid, Zone *zone, GeRay *ray, double vel, double *ds0,
-                          double *vfac0, double *intensity, double *tau)
+                          double *vfac0, double *intensity, double *tau, RayCache *rec)
 /* Given a previously initialized ray, calculate intensity for all lines
- * along the ray from the ray origin to the edge of the cloud */
+ * along the ray from the ray origin to the edge of the cloud. If rec is not
+ * NULL, the ray is appended to it for ReplayRays(). */
 {
     size_t firststep = 1;
     Zone *zp = zone;
@@ -1207,9 +2653,6 @@ static void RadiativeXfer(size_t tid, Zone *zone, GeRay *ray, double vel, double
     printf("%12s %12s %12s %12s %12s %12s %12s %12s\n", "iter", "ds", "vfac", "n_H2", "X_mol", "width", "dtau", "tau_nu");
     #endif
 
-    /* Allocate array for dtau */
-    double *dtau = Mem_CALLOC(NRAD, dtau);
-
     /* Reset intensity, tau, ds0 and vfac0 */
     Mem_BZERO2(intensity, NRAD);
     Mem_BZERO2(tau, NRAD);
@@ -1219,6 +2662,10 @@ static void RadiativeXfer(size_t tid, Zone *zone, GeRay *ray, double vel, double
     /* Reset counter for average path length */
     SpPhys *zone_pp = zone->data;
 
+    /* Start a new ray in the recording */
+    if(rec)
+        rec->seg_start[rec->nray++] = rec->nseg;
+
     /* Propagate the ray through the cloud until we've
      * reached the edge */
     while(zp) {
@@ -1228,9 +2675,6 @@ static void RadiativeXfer(size_t tid, Zone *zone, GeRay *ray, double vel, double
         /* Reset t */
         double t = 0;
 
-        /* Reset dtau */
-        Mem_BZERO2(dtau, NRAD);
-
         /* Calculate path to next boundary */
         GeRay_TraverseVoxel(ray, &zp->voxel, &t, &plane);
 
@@ -1239,151 +2683,266 @@ static void RadiativeXfer(size_t tid, Zone *zone, GeRay *ray, double vel, double
 
         /* Do calculations on non-empty leaf zones only */
         if(pp->non_empty_leaf) {
-            /* Calculate propagation path length and velocity factor
-             * for line profile */
-            double ds = t * Sp_LENFAC;
-
             /* Increment average path length counter */
             zone_pp->ds += t;
 
             /* Calculate velocity line profile factor */
             double vfac = pp->has_tracer ? SpPhys_GetVfac(ray, t, vel, zp, 0) : 0.0;
 
-            /* Calculate radiative contribution from neighboring
-             * zones */
-            for(size_t i = 0; i < NRAD; i++) {
-                double j_nu = 0.;
-                double k_nu = 0.;
-                if(pp->has_tracer) {
-                    if(glb.overlap){
-                        for(size_t j = 0; j < NRAD; j++) {
-                            if(OVERLAP(i,j)==1){
-                                double tempj_nu, tempk_nu;
-                                if(i==j){
-                                    /* Calculate molecular line emission and absorption coefficients */
-                                    SpPhys_GetMoljk(pp, j, vfac, &tempj_nu, &tempk_nu);
-                                }
-                                else{
-                                    /* Calculate velocity line profile factor */
-                                    double vfac2 = pp->has_tracer ? SpPhys_GetVfac(ray, t, vel-RELVEL(i,j), zp, 0) : 0.0;
-                                    /* Calculate molecular line emission and absorption coefficients */
-                                    SpPhys_GetMoljk(pp, j, vfac2, &tempj_nu, &tempk_nu);
-                                }
-                                j_nu += tempj_nu;
-                                k_nu += tempk_nu;
-                            }
-                        }
-                    }
-                    else{
-                        /* Calculate molecular line emission and absorption coefficients */
-                        SpPhys_GetMoljk(pp, i, vfac, &j_nu, &k_nu);
-                    }
-                }
-                else {
-                    j_nu = k_nu = 0.;
-                }
+            if(rec)
+                RayCacheAddSegment(rec, zp, t, vfac);
+
+            /* If this is the first step, save ds, vfac for later use and do
+             *			   nothing else */
+            if(firststep) {
+                *ds0 = t * Sp_LENFAC;
+                *vfac0 = vfac;
+                firststep = 0;
+            }
+            else {
+                /* Calculate radiative contribution from neighboring
+                 * zones */
+                XferSegment(tid, zp, t, vfac, ray, vel, intensity, tau);
+            }
+            #if debug_ray
+            printf("%12lu %12.4e %12.4e %12.4e %12.4e %12.4e %12.4e %12.4e\n", (unsigned long)iter, t, vfac, pp->n_H2, pp->X_mol, pp->width, dtau_nu, tau[0]);
+            #endif
+        }
+
+        #if debug_ray //debug
+        GeRay tmp_ray = GeRay_Inc(ray, t);
+        GeVec3_Cpgarro2(&ray->e, &tmp_ray.e, &cam);
+        if(1) {
+            //printf("plane=%lu\n", (unsigned long)plane);
+            cpgupdt();
+            Deb_PAUSE();
+        }
+        #endif
+
+        /* Propagate ray to next position */
+        *ray = GeRay_Inc(ray, t);
+
+        /* Get next zone to traverse to */
+        zp = Zone_GetNext(zp, &plane, ray);
+
+        #if debug_ray //debug
+        iter++;
+        #endif
+    }
+
+    /* Add intensity entering the ray at the boundary */
+    const double *intensity_bc = BoundaryIntensity(zone, ray, plane);
+    for(size_t i = 0; i < NRAD; i++)
+        intensity[i] += intensity_bc[i] * exp(-tau[i]);
+
+    if(rec)
+        rec->I_bc[rec->nray - 1] = intensity_bc;
+
+    #if debug_ray //debug
+    printf("ds0=%12.4e, vfac0=%12.4e\n", (*ds0) / Sp_LENFAC, *vfac0);
+    //Deb_PAUSE();
+    #endif
+
+    return;
+}
+
+/*----------------------------------------------------------------------------*/
+
+static void XferSegment(size_t tid, Zone *zp, double t, double vfac, const GeRay *ray,
+                        double vel, double *intensity, double *tau)
+/* Add emission and absorption of a step of length t through zone zp with
+ * line profile factor vfac to intensity and tau. ray (at the beginning of
+ * the step) and vel are only used for overlapping lines. */
+{
+    SpPhys *pp = zp->data;
+    Scratch *scr = &glb.scratch[tid];
+    double *dtau = scr->dtau, *j_nu = scr->j_nu, *k_nu = scr->k_nu;
+    double ds = t * Sp_LENFAC;
 
-                /* Add continuum emission/absorption */
-                j_nu += pp->cont[i].j;
-                k_nu += pp->cont[i].k;
+    scr->stats.nseg++;
 
-                /* Calculate source function and optical depth if
-                 * absorption is NOT zero */
-                double S_nu = fabs(k_nu) > 0.0 ? j_nu / k_nu / glb.I_norm[i] : 0.0;
+    if(pp->has_tracer) {
+        /* Molecular line emission and absorption coefficients */
+        for(size_t i = 0; i < NRAD; i++) {
+            j_nu[i] = vfac * pp->line_j[i];
+            k_nu[i] = vfac * pp->line_k[i];
+        }
 
-                dtau[i] = k_nu * ds;
-                SpPhys_LIMITTAU(dtau[i]);
+        /* Add overlapping lines, with the line profile factor of each
+         * distinct velocity offset evaluated once */
+        if(glb.overlap) {
+            double *ol_vfac = scr->ol_vfac;
 
-                if(!firststep) {
-                    /* Calculate intensity contributed by this step */
-                    intensity[i] += S_nu * (1.0 - exp(-dtau[i])) * exp(-tau[i]);
+            for(size_t k = 0; k < glb.nol_dv; k++)
+                ol_vfac[k] = SpPhys_GetVfac(ray, t, vel - glb.ol_dv[k], zp, 0);
 
-                    /* Accumulate total optical depth for this line (must be done
-                     * AFTER calculation of intensity!) */
-                    tau[i] += dtau[i];
-                    SpPhys_LIMITTAU(tau[i]);
+            for(size_t i = 0; i < NRAD; i++) {
+                for(size_t k = glb.ol_start[i]; k < glb.ol_start[i + 1]; k++) {
+                    j_nu[i] += ol_vfac[glb.ol_idx[k]] * pp->line_j[glb.ol_line[k]];
+                    k_nu[i] += ol_vfac[glb.ol_idx[k]] * pp->line_k[glb.ol_line[k]];
                 }
             }
-
-            /* If this is the first step, save ds, vfac for later use and do
-             *			   nothing else */
-            if(firststep) {
-                *ds0 = ds;
-                *vfac0 = vfac;
-                firststep = 0;
-            }
-            #if debug_ray
-            printf("%12lu %12.4e %12.4e %12.4e %12.4e %12.4e %12.4e %12.4e\n", (unsigned long)iter, t, vfac, pp->n_H2, pp->X_mol, pp->width, dtau_nu, tau[0]);
-            #endif
         }
+    }
+    else {
+        Mem_BZERO2(j_nu, NRAD);
+        Mem_BZERO2(k_nu, NRAD);
+    }
 
-        #if debug_ray //debug
-        GeRay tmp_ray = GeRay_Inc(ray, t);
-        GeVec3_Cpgarro2(&ray->e, &tmp_ray.e, &cam);
-        if(1) {
-            //printf("plane=%lu\n", (unsigned long)plane);
-            cpgupdt();
-            Deb_PAUSE();
-        }
-        #endif
+    for(size_t i = 0; i < NRAD; i++) {
+        /* Add continuum emission/absorption */
+        double j = j_nu[i] + pp->cont[i].j;
+        double k = k_nu[i] + pp->cont[i].k;
 
-        /* Propagate ray to next position */
-        *ray = GeRay_Inc(ray, t);
+        /* Calculate source function and optical depth if
+         * absorption is NOT zero */
+        double S_nu = fabs(k) > 0.0 ? j / k / glb.I_norm[i] : 0.0;
 
-        /* Get next zone to traverse to */
-        zp = Zone_GetNext(zp, &plane, ray);
+        dtau[i] = k * ds;
+        SpPhys_LIMITTAU(dtau[i]);
 
-        #if debug_ray //debug
-        iter++;
-        #endif
+        /* Calculate intensity contributed by this step */
+        intensity[i] += S_nu * (1.0 - exp(-dtau[i])) * exp(-tau[i]);
+
+        /* Accumulate total optical depth for this line (must be done
+         * AFTER calculation of intensity!) */
+        tau[i] += dtau[i];
+        SpPhys_LIMITTAU(tau[i]);
     }
 
+    return;
+}
+
+/*----------------------------------------------------------------------------*/
+
+static const double *BoundaryIntensity(const Zone *zone, const GeRay *ray, size_t plane)
+/* Intensity entering a ray that left the cloud through plane */
+{
     /* Ray has been reached inner boundary, to give inner B.C. T_in */
     int geom = zone->voxel.geom;
     if ( (geom == GEOM_SPH1D || geom == GEOM_SPH3D) && plane == 0 ){
-        for(size_t i = 0; i < NRAD; i++)
-            intensity[i] += glb.I_in[i] * exp(-tau[i]);
+        return glb.I_in;
     }
     else if ( (geom == GEOM_SPH1D || geom == GEOM_SPH3D) && plane > 1){
         /* It shouldn't happen, just in case */
         Deb_ASSERT(0);
     }
-    /* Ray escaped cloud, add CMB to all lines */
-    else{
-        SpPhysParm * parms = &glb.model.parms;
-        SourceData *target = NULL;
-        for ( int source_id = 0; source_id < parms->Outer_Source; source_id++){
-            SourceData *candidate = &parms->source[source_id];
-
-            GeVec3_d source_vec = GeVec3_Sub( &ray->e, &candidate->pt_cart);
-            GeVec3_d source_d = GeVec3_Normalize( &source_vec) ;
-            double cos_alpha = GeVec3_DotProd( &ray->d, &source_d);
-            double alpha = acos(cos_alpha);
-            // the ray is inside the view of angle of the source
-            // alpha < beta (angle of view of the radius of the source)
-            if ( alpha < parms->BetaPerInitRay ){
-                if ( !target || (target && candidate->distance < target->distance) )
-                    target = candidate;
-            }
+
+    /* Ray escaped cloud, add CMB or outer source to all lines */
+    SpPhysParm * parms = &glb.model.parms;
+    SourceData *target = NULL;
+    for ( int source_id = 0; source_id < parms->Outer_Source; source_id++){
+        SourceData *candidate = &parms->source[source_id];
+
+        GeVec3_d source_vec = GeVec3_Sub( &ray->e, &candidate->pt_cart);
+        GeVec3_d source_d = GeVec3_Normalize( &source_vec) ;
+        double cos_alpha = GeVec3_DotProd( &ray->d, &source_d);
+        double alpha = acos(cos_alpha);
+        // the ray is inside the view of angle of the source
+        // alpha < beta (angle of view of the radius of the source)
+        if ( alpha < parms->BetaPerInitRay ){
+            if ( !target || (target && candidate->distance < target->distance) )
+                target = candidate;
         }
+    }
 
-        double *intensity_bc;
-        if (target)
-            intensity_bc = target->EffectiveIntensity;
-        else
-            intensity_bc = glb.I_cmb;
+    if (target)
+        return target->EffectiveIntensity;
+    else
+        return glb.I_cmb;
+}
+
+/*----------------------------------------------------------------------------*/
 
-        for(size_t i = 0; i < NRAD; i++)
-            intensity[i] += intensity_bc[i] * exp(-tau[i]);
+static void RayCacheBegin(RayCache *rec, size_t nray)
+/* Reset recording buffer rec for nray rays */
+{
+    if(nray + 1 > rec->ray_cap) {
+        if(rec->seg_start)
+            free(rec->seg_start);
+        if(rec->I_bc)
+            free(rec->I_bc);
+        rec->seg_start = Mem_CALLOC(nray + 1, rec->seg_start);
+        rec->I_bc = Mem_CALLOC(nray, rec->I_bc);
+        rec->ray_cap = nray + 1;
     }
+    rec->nray = 0;
+    rec->nseg = 0;
 
+    return;
+}
 
-    #if debug_ray //debug
-    printf("ds0=%12.4e, vfac0=%12.4e\n", (*ds0) / Sp_LENFAC, *vfac0);
-    //Deb_PAUSE();
-    #endif
+/*----------------------------------------------------------------------------*/
+
+static void RayCacheAddSegment(RayCache *rec, Zone *zp, double t, double vfac)
+{
+    if(rec->nseg == rec->seg_cap) {
+        rec->seg_cap = Num_MAX(1024, 2 * rec->seg_cap);
+        rec->seg = Mem_REALLOC(rec->seg_cap, rec->seg);
+    }
+    rec->seg[rec->nseg].zp = zp;
+    rec->seg[rec->nseg].t = t;
+    rec->seg[rec->nseg].vfac = vfac;
+    rec->nseg += 1;
+
+    return;
+}
+
+/*----------------------------------------------------------------------------*/
 
-    free(dtau);
+static void RayCacheCommit(RayCache *rc, RayCache *rec)
+/* Copy rays recorded in rec to the cache rc of a zone if the memory limit
+ * allows it; otherwise mark the zone so that it is not recorded again */
+{
+    rec->seg_start[rec->nray] = rec->nseg;
+
+    size_t nbytes = rec->nseg * sizeof(*rec->seg)
+                  + (rec->nray + 1) * sizeof(*rec->seg_start)
+                  + rec->nray * sizeof(*rec->I_bc);
+    int fits, warn = 0;
+
+    pthread_mutex_lock(&glb.exc_mutex);
+    fits = (glb.raycache_bytes + nbytes <= glb.raycache_max);
+    if(fits) {
+        glb.raycache_bytes += nbytes;
+    }
+    else if(!glb.raycache_full) {
+        glb.raycache_full = 1;
+        warn = 1;
+    }
+    pthread_mutex_unlock(&glb.exc_mutex);
+
+    if(warn)
+        Sp_PWARN("ray segment cache is full, remaining zones are retraced in every iteration\n");
+
+    if(!fits) {
+        rc->uncached = 1;
+        return;
+    }
+
+    rc->seg = Mem_CALLOC(Num_MAX(1, rec->nseg), rc->seg);
+    rc->seg_start = Mem_CALLOC(rec->nray + 1, rc->seg_start);
+    rc->I_bc = Mem_CALLOC(rec->nray, rc->I_bc);
+    Mem_MEMCPY(rc->seg, rec->seg, rec->nseg);
+    Mem_MEMCPY(rc->seg_start, rec->seg_start, rec->nray + 1);
+    Mem_MEMCPY(rc->I_bc, rec->I_bc, rec->nray);
+    rc->nseg = rec->nseg;
+    rc->nray = rec->nray;
+
+    return;
+}
+
+/*----------------------------------------------------------------------------*/
+
+static void RayCacheFree(RayCache *rc)
+{
+    if(rc->seg)
+        free(rc->seg);
+    if(rc->seg_start)
+        free(rc->seg_start);
+    if(rc->I_bc)
+        free((void *)rc->I_bc);
+    Mem_BZERO(rc);
 
     return;
 }
@@ -1391,13 +2950,18 @@ static void RadiativeXfer(size_t tid, Zone *zone, GeRay *ray, double vel, double
 /*----------------------------------------------------------------------------*/
 
 static void CalcJbar(size_t tid, SpPhys *pp, const double *ds0, const double *vfac0,
-                     const double *intensity, const double *tau, double *J_bar)
+                     const double *intensity, const double *tau, double *J_bar, double *L_star)
 /* Calculate J_bar, the mean radiation field intensity, by averaging the
- * radiation field over direction and velocity */
+ * radiation field over direction and velocity. L_star is the diagonal
+ * (local) approximate lambda operator, i.e. the fraction of J_bar
+ * contributed by the line source function of this zone:
+ * 	L_star = <vfac0 * (1 - exp(-dtau0)) * k_line / k_nu> / <vfac0>
+ */
 {
     /* Reset Jbar (very important!) */
     //Mem_BZERO2(pp->J_bar, NRAD);
     Mem_BZERO2(J_bar, NRAD);
+    Mem_BZERO2(L_star, NRAD);
 
     /* Reset tau */
     Mem_BZERO2(pp->tau, NRAD);
@@ -1410,8 +2974,9 @@ static void CalcJbar(size_t tid, SpPhys *pp, const double *ds0, const double *vf
         /* Loop through lines */
         for(size_t j = 0; j < NRAD; j++) {
             /* Calculate local emission and absorption */
-            double j_nu, k_nu;
-            SpPhys_GetMoljk(pp, j, vfac0[i], &j_nu, &k_nu);
+            double j_nu = vfac0[i] * pp->line_j[j];
+            double k_nu = vfac0[i] * pp->line_k[j];
+            double k_line = k_nu;
 
             /* Add continuum emission/absorption */
             j_nu += pp->cont[j].j;
@@ -1429,6 +2994,11 @@ static void CalcJbar(size_t tid, SpPhys *pp, const double *ds0, const double *vf
                 //pp->J_bar[j] += vfac0[i] * (INTENSITY(i, j) * exp(-dtau_nu) + S_nu * (1.0 - exp(-dtau_nu)));
                 J_bar[j] += vfac0[i] * (INTENSITY(i, j) * exp(-dtau_nu) + S_nu * (1.0 - exp(-dtau_nu)));
 
+                /* Accumulate the local operator; masing lines are left
+                 * to ordinary lambda iteration */
+                if(k_line > 0 && k_nu > 0)
+                    L_star[j] += vfac0[i] * (1.0 - exp(-dtau_nu)) * k_line / k_nu;
+
                 /* Store total tau in zone for bookkeeping */
                 pp->tau[j] += vfac0[i] * (TAU(i, j) + dtau_nu);
             }
@@ -1445,6 +3015,7 @@ static void CalcJbar(size_t tid, SpPhys *pp, const double *ds0, const double *vf
             /* Denormalized and average J_bar */
             //pp->J_bar[i] = pp->J_bar[i] * glb.I_norm[i] / vfac0_sum;
             J_bar[i] = J_bar[i] * glb.I_norm[i] / vfac0_sum;
+            L_star[i] /= vfac0_sum;
 
             /* Calculate averaged tau for this zone */
             pp->tau[i] /= vfac0_sum;
@@ -1456,170 +3027,90 @@ static void CalcJbar(size_t tid, SpPhys *pp, const double *ds0, const double *vf
 
 /*----------------------------------------------------------------------------*/
 
-static void CalcDetailedBalance(size_t tid, SpPhys *pp, const double *ds0,
-                                const double *vfac0, const double *intensity, const double *tau)
-/* Calculate and invert detailed balance equations to solve for level
- * populations, and save results in pp */
+static void BuildRateMatrix(size_t tid, SpPhys *pp, const double *ds0, const double *vfac0,
+                            const double *intensity, const double *tau, double *rmat)
+/* Assemble the detailed balance equations of a zone in rmat (NLEV x NLEV),
+ * with the last row replaced by the constraint that all level densities
+ * must sum to unity, i.e. the RHS is (0, ..., 0, 1).
+ *
+ * J_bar only depends on pops_preserve, which is fixed during an iteration,
+ * so a single solve of these equations gives the pops of this set of
+ * rays. */
 {
-    size_t  max_diff_lev = 0;
-    double diff = 0;
-    const double MAXDIFF = glb.minpop;
-    //const double MAXDIFF = TOLERANCE * 0.1;
-
-    /* Allocate J_bar array (no need now) */
-    double *J_bar = Mem_CALLOC(NRAD, J_bar);
-
-    #define QR_DECOMPOSE 0
-    #define LU_DECOMPOSE 1
-
-    #if QR_DECOMPOSE
-    /* Allocate rates matrix: (NLEV + 1) x NLEV,
-     * where the additional row is for the constraint
-     * that all levels must sum to unity */
-    double *rmat = Mem_CALLOC((NLEV + 1) * NLEV, rmat);
-    /* RHS of rate equation */
-    double *rhs = Mem_CALLOC(NLEV + 1, rhs);
-    rhs[NLEV] = 1.0;
-
-    #elif LU_DECOMPOSE
-    double *rmat = Mem_CALLOC(NLEV * NLEV, rmat);
-    /* RHS of rate equation */
-    double *rhs = Mem_CALLOC(NLEV, rhs);
-    rhs[NLEV-1] = 1.0;
-
-    #else
-    Deb_ASSERT(0);
-
-    #endif
-
-    /* Allocate hist array */
-    double *hist = Mem_CALLOC(NHIST * NLEV, hist);
-
-    for(size_t iter = 0; iter < glb.maxi; iter++) {
-        for(size_t ihist = 0; ihist < NHIST; ihist++) {
-            /* Calculate J_bar, the mean radiation field intensity */
-            CalcJbar(tid, pp, ds0, vfac0, intensity, tau, J_bar);
-
-            /* Reset rates matrix */
-            #if QR_DECOMPOSE
-            Mem_BZERO2(rmat, (NLEV + 1) * NLEV);
-            #elif LU_DECOMPOSE
-            Mem_BZERO2(rmat, NLEV * NLEV);
-            #else
-            Deb_ASSERT(0);
-            #endif
-
-            #define RMAT(i, j) \
-            rmat[(j) + NLEV * (i)]
-            #define CMAT(i, j) \
-            (pp->cmat[(j) + NLEV * (i)])
-
-            /* Add radiative terms to rates matrix */
-            for(size_t i = 0; i < NRAD; i++) {
-                size_t up = RAD(i)->up;
-                size_t lo = RAD(i)->lo;
-
-                /* Diagonal terms are transitions `out of' row state */
-                RMAT(up, up) -= (RAD(i)->A_ul + J_bar[i] * RAD(i)->B_ul);
-                RMAT(lo, lo) -= (J_bar[i] * RAD(i)->B_lu);
-
-                /* Off-diagonal terms are transitions `into' row state */
-                RMAT(up, lo) += (J_bar[i] * RAD(i)->B_lu);
-                RMAT(lo, up) += (RAD(i)->A_ul + J_bar[i] * RAD(i)->B_ul);
-            }
-
-            #if QR_DECOMPOSE
-            /* Add collisional terms to rates matrix */
-            for(size_t i = 0; i < NLEV; i++) {
-                for(size_t j = 0; j < NLEV; j++) {
-                    RMAT(i, j) += CMAT(i, j);
-                }
-                /* Last row is the constraint that all level densities
-                 * must sum to unity */
-                RMAT(NLEV, i) = 1.0;
-            }
-
-            /* Invert matrix with QR decomposition and solve for
-             * level populations */
-            Num_QRDecompSolve(rmat, NLEV + 1, NLEV, rhs, pp->pops_update);
-
-            #elif LU_DECOMPOSE
-            /* Add collisional terms to rates matrix */
-            for(size_t i = 0; i < NLEV-1; i++) {
-                for(size_t j = 0; j < NLEV; j++) {
-                    RMAT(i, j) += CMAT(i, j);
-                }
-            }
-            /* Last row is the constraint that all level densities
-             * must sum to unity */
-            for(size_t j = 0; j < NLEV; j++)
-                RMAT(NLEV-1, j) = 1.0;
-
-            #if 0
-            /* eigenvalue solver */
-            double eigen_value[NLEV];
-            Num_EigenSolver(rmat, NLEV, eigen_value);
-            #endif
+    /* Scratch arrays of this thread */
+    Scratch *scr = &glb.scratch[tid];
+    double *J_bar = scr->J_bar;
+    double *L_star = scr->L_star;
 
-            /* Invert matrix with QR decomposition and solve for
-             * level populations */
-            Num_LUDecompSolve(rmat, NLEV, rhs, pp->pops_update);
+    /* Calculate J_bar, the mean radiation field intensity */
+    CalcJbar(tid, pp, ds0, vfac0, intensity, tau, J_bar, L_star);
 
-            #else
-            Deb_ASSERT(0);
+    /* Reset rates matrix */
+    Mem_BZERO2(rmat, NLEV * NLEV);
 
-            #endif
-
-            #undef RMAT
-            #undef CMAT
+    #define RMAT(i, j) \
+    rmat[(j) + NLEV * (i)]
+    #define CMAT(i, j) \
+    (pp->cmat[(j) + NLEV * (i)])
 
-            for(size_t i = 0; i < NLEV; i++) {
-                /* Zero out negative/uncertain pops */
-                if(pp->pops_update[i] < 0)
-                    pp->pops_update[i] = 0.0;
-
-                /* restore the history of iteration */
-                HIST(ihist, i) = pp->pops_update[i];
+    /* Add radiative terms to rates matrix */
+    for(size_t i = 0; i < NRAD; i++) {
+        size_t up = RAD(i)->up;
+        size_t lo = RAD(i)->lo;
+        double J_eff = J_bar[i], A_eff = RAD(i)->A_ul;
+
+        /* Accelerated lambda iteration (Rybicki & Hummer 1991):
+         * split J_bar = J_eff + L_star * S_line, where S_line is
+         * evaluated with the old pops, and treat the local part
+         * implicitly. Since n_l * B_lu * S - n_u * B_ul * S = n_u * A_ul,
+         * this only reduces the spontaneous rate by (1 - L_star). */
+        if(glb.alo && L_star[i] > 0) {
+            double n_u = pp->pops_preserve[up];
+            double n_l = pp->pops_preserve[lo];
+            double denom = n_l * RAD(i)->B_lu - n_u * RAD(i)->B_ul;
+
+            if(denom > 0) {
+                J_eff -= L_star[i] * n_u * RAD(i)->A_ul / denom;
+                A_eff *= (1.0 - L_star[i]);
+                if(J_eff < 0)
+                    J_eff = 0.0;
             }
         }
-        /* Calculate relative difference */
-        //diff = CalcDiff(hist, &max_diff_lev);
-        diff = CalcDiff2(hist, &max_diff_lev);
 
-        /* Stop iterating if diff is less than MAXDIFF */
-        if(diff <= MAXDIFF)
-            break;
-    }
-
-    #undef QR_DECOMPOSE
-    #undef LU_DECOMPOSE
+        /* Diagonal terms are transitions `out of' row state */
+        RMAT(up, up) -= (A_eff + J_eff * RAD(i)->B_ul);
+        RMAT(lo, lo) -= (J_eff * RAD(i)->B_lu);
 
+        /* Off-diagonal terms are transitions `into' row state */
+        RMAT(up, lo) += (J_eff * RAD(i)->B_lu);
+        RMAT(lo, up) += (A_eff + J_eff * RAD(i)->B_ul);
+    }
 
-    /* Warn for non-convergence */
-    if(diff > MAXDIFF) {
-        Sp_PWARN( "non-convergence detected at level %lu in zone <%lu,%lu,%lu> (diff=%.3e MAXDIFF=%.3e %.3e %.3e )\n",
-                 max_diff_lev,
-                 GeVec3_X(pp->zp->index, 0),
-                 GeVec3_X(pp->zp->index, 1),
-                 GeVec3_X(pp->zp->index, 2),
-                 diff,MAXDIFF,TOLERANCE,glb.tolerance);
+    /* Add collisional terms to rates matrix */
+    for(size_t i = 0; i < NLEV-1; i++) {
+        for(size_t j = 0; j < NLEV; j++) {
+            RMAT(i, j) += CMAT(i, j);
+        }
     }
+    /* Last row is the constraint that all level densities
+     * must sum to unity */
+    for(size_t j = 0; j < NLEV; j++)
+        RMAT(NLEV-1, j) = 1.0;
 
-    /* Cleanup */
-    free(J_bar);
-    free(rmat);
-    free(rhs);
-    free(hist);
+    #undef RMAT
+    #undef CMAT
 
     return;
 }
 
 /*----------------------------------------------------------------------------*/
 
-static double CalcDiff(const double *hist, size_t *max_diff_lev,size_t izone,size_t tid)
+static double CalcDiff(const double *hist, size_t *max_diff_lev, double *max_sigma, size_t izone, size_t tid)
+/* Return the max relative deviation of the NHIST pops from their mean, and
+ * in max_sigma (if not NULL) the max relative sample standard deviation */
 {
     double max_diff = 0.0;
-    double *diffs = Mem_CALLOC(NHIST, diffs);
+    double diffs[NHIST];
 
     Zone *zp = glb.zones[izone];
     SpPhys *pp = zp->data;
@@ -1640,6 +3131,12 @@ static double CalcDiff(const double *hist, size_t *max_diff_lev,size_t izone,siz
             for(size_t j = 0; j < NHIST; j++)
                 diffs[j] = fabs(HIST(j, i) - mean) / mean;
 
+            /* Sample variance of the histories */
+            double var = 0.0;
+            for(size_t j = 0; j < NHIST; j++)
+                var += diffs[j] * diffs[j];
+            var /= (double)(NHIST - 1);
+
             /* Find max diff */
             Num_Qsort_d(diffs, NHIST);
 
@@ -1648,58 +3145,438 @@ static double CalcDiff(const double *hist, size_t *max_diff_lev,size_t izone,siz
                 if(max_diff_lev)
                     *max_diff_lev = i;
             }
+
+            if(max_sigma && sqrt(var) > *max_sigma)
+                *max_sigma = sqrt(var);
         }
     }
 
-    free(diffs);
-
     return max_diff;
 }
 
 /*----------------------------------------------------------------------------*/
 
-static double CalcDiff2(const double *hist, size_t *max_diff_lev)
+/* Bounds on the growth of nray per iteration, since sigma estimated from
+ * NHIST samples is itself uncertain */
+#define NRAY_GROWTH_MIN 2.0
+#define NRAY_GROWTH_MAX 64.0
+
+static size_t NextNray(size_t nray, double sigma)
+/* Number of rays for bringing the relative Monte Carlo noise sigma, which
+ * scales as nray^-1/2, down to 0.5 * MCNOISE in one step */
 {
-    #define NDIFF (NHIST - 1)
-    double max_diff = 0.0;
-    double *diffs = Mem_CALLOC(NDIFF, diffs);
-    double *pops = Mem_CALLOC(NHIST, pops);
+    double growth = sigma / (0.5 * MCNOISE);
 
-    /* Loop through all levels */
-    for(size_t i = 0; i < NLEV; i++) {
-        /* Load pops into array for sorting */
-        for(size_t j = 0; j < NHIST; j++) {
-            pops[j] = HIST(j, i);
+    growth = Num_MIN(Num_MAX(growth * growth, NRAY_GROWTH_MIN), NRAY_GROWTH_MAX);
+
+    return (size_t)ceil(growth * (double)nray);
+}
+
+#undef NRAY_GROWTH_MIN
+#undef NRAY_GROWTH_MAX
+
+/*----------------------------------------------------------------------------*/
+
+/*----------------------------------------------------------------------------*/
+
+static void NgPushPops(void)
+/* Append the current pops of all zones to the Ng history */
+{
+    Deb_ASSERT(glb.ng_nhist < NG_NHIST);
+
+    for(size_t izone = 0; izone < glb.nzone; izone++) {
+        SpPhys *pp = glb.zones[izone]->data;
+        Mem_MEMCPY(NG_HIST(izone, glb.ng_nhist), pp->pops_preserve, NLEV);
+    }
+    glb.ng_nhist += 1;
+
+    return;
+}
+
+/*----------------------------------------------------------------------------*/
+
+static size_t NgAccelerate(void)
+/* Replace pops of all zones by their Ng extrapolation and restart the
+ * history from the extrapolated pops. Pops are identical on all processes
+ * after SyncProcs(), so every process does the same extrapolation and no
+ * communication is needed. Returns the number of extrapolated zones. */
+{
+    size_t nacc = 0;
+
+    for(size_t izone = 0; izone < glb.nzone; izone++) {
+        SpPhys *pp = glb.zones[izone]->data;
+
+        if(!NgExtrapolate(NG_HIST(izone, 0), pp->pops_preserve))
+            nacc += 1;
+
+        /* The current pops are the first entry of the new history */
+        Mem_MEMCPY(NG_HIST(izone, 0), pp->pops_preserve, NLEV);
+    }
+    glb.ng_nhist = 1;
+
+    return nacc;
+}
+
+/*----------------------------------------------------------------------------*/
+
+static int NgExtrapolate(const double *ng_hist, double *pops)
+/* Ng (1974) extrapolation of order M = ng_order: given the iterates
+ * y_0 ... y_{M+1}, where y_{k+1} is the result of iterating on y_k, find the
+ * coefficients a_i minimizing the weighted norm of
+ * 	r_M - sum_i a_i (r_M - r_{M-i}),	r_k = y_{k+1} - y_k
+ * and set
+ * 	pops = y_{M+1} - sum_i a_i (y_{M+1} - y_{M+1-i})
+ * Levels are weighted by 1/y^2 so that relative changes are minimized (cf.
+ * Olson, Auer & Buchler 1986). Returns 1 and leaves pops untouched if the
+ * system is singular or the extrapolated pops are unphysical. */
+{
+    #define Y(k, lev) \
+    (ng_hist[(lev) + NLEV * (k)])
+    #define R(k, lev) \
+    (Y((k) + 1, lev) - Y(k, lev))
+    #define A(i, j) \
+    A[(j) + M * (i)]
+
+    size_t M = glb.ng_order;
+    double A[M * M], b[M], coef[M], weight[NLEV], newpops[NLEV];
+
+    for(size_t lev = 0; lev < NLEV; lev++) {
+        double y = Y(M + 1, lev);
+        weight[lev] = (y > glb.minpop) ? 1.0 / (y * y) : 0.0;
+    }
+
+    /* Normal equations of the least-squares problem */
+    for(size_t i = 0; i < M; i++) {
+        b[i] = 0.0;
+        for(size_t j = 0; j < M; j++)
+            A(i, j) = 0.0;
+
+        for(size_t lev = 0; lev < NLEV; lev++) {
+            double dr_i = R(M, lev) - R(M - 1 - i, lev);
+
+            b[i] += weight[lev] * dr_i * R(M, lev);
+            for(size_t j = 0; j < M; j++)
+                A(i, j) += weight[lev] * dr_i * (R(M, lev) - R(M - 1 - j, lev));
         }
-        /* Get smallest pops */
-        Num_Qsort_d(pops, NHIST);
+    }
 
-        if(pops[0] >= glb.minpop) {
-            /* Calculate difference of hist[0] between all
-             *			   other hist values */
-            for(size_t j = 0; j < NDIFF; j++) {
-                diffs[j] = fabs((HIST(j + 1, i) - HIST(0, i)) / HIST(0, i));
+    /* Gaussian elimination with partial pivoting: the system is tiny and
+     * becomes singular once the zone has converged, which must not abort */
+    for(size_t k = 0; k < M; k++) {
+        size_t piv = k;
+        for(size_t i = k + 1; i < M; i++) {
+            if(fabs(A(i, k)) > fabs(A(piv, k)))
+                piv = i;
+        }
+        if(!(fabs(A(piv, k)) > DBL_EPSILON * fabs(A(0, 0))) || fabs(A(piv, k)) < DBL_MIN)
+            return 1;
+
+        if(piv != k) {
+            for(size_t j = 0; j < M; j++) {
+                double temp = A(k, j);
+                A(k, j) = A(piv, j);
+                A(piv, j) = temp;
             }
-            /* Get smallest diff */
-            Num_Qsort_d(diffs, NDIFF);
+            double temp = b[k];
+            b[k] = b[piv];
+            b[piv] = temp;
+        }
 
-            if(diffs[NDIFF - 1] > max_diff) {
-                max_diff = diffs[NDIFF - 1];
-                if(max_diff_lev)
-                    *max_diff_lev = i;
-            }
+        for(size_t i = k + 1; i < M; i++) {
+            double fac = A(i, k) / A(k, k);
+            for(size_t j = k; j < M; j++)
+                A(i, j) -= fac * A(k, j);
+            b[i] -= fac * b[k];
         }
     }
+    for(size_t k = M; k-- > 0;) {
+        coef[k] = b[k];
+        for(size_t j = k + 1; j < M; j++)
+            coef[k] -= A(k, j) * coef[j];
+        coef[k] /= A(k, k);
+    }
 
-    #undef NDIFF
+    /* Extrapolate and reject unphysical results */
+    double sum = 0.0;
+    for(size_t lev = 0; lev < NLEV; lev++) {
+        newpops[lev] = Y(M + 1, lev);
+        for(size_t i = 0; i < M; i++)
+            newpops[lev] -= coef[i] * (Y(M + 1, lev) - Y(M - i, lev));
 
-    free(diffs);
-    free(pops);
+        if(!(newpops[lev] >= 0.0) || Num_ISNAN(newpops[lev]))
+            return 1;
+        sum += newpops[lev];
+    }
+    if(!(sum > 0.0))
+        return 1;
 
-    return max_diff;
+    /* Renormalize so that all levels sum to unity */
+    for(size_t lev = 0; lev < NLEV; lev++)
+        pops[lev] = newpops[lev] / sum;
+
+    #undef Y
+    #undef R
+    #undef A
+
+    return 0;
+}
+
+/*----------------------------------------------------------------------------*/
+
+static int CheckpointDue(size_t iter)
+/* Whether a checkpoint should be written after iteration iter: decided by
+ * the master process so that all processes take part in WriteCheckpoint() */
+{
+    int due = 0;
+
+    if(!glb.ckpt_fname)
+        return 0;
+
+    if(Sp_MPIRANK == 0) {
+        time_t t_now;
+        time(&t_now);
+
+        if(glb.ckpt_iter > 0 && (iter + 1) % glb.ckpt_iter == 0)
+            due = 1;
+        if(glb.ckpt_time > 0 && difftime(t_now, glb.t_ckpt) >= glb.ckpt_time)
+            due = 1;
+    }
+
+    #ifdef HAVE_MPI
+    if(Sp_MPISIZE > 1)
+        MPI_Bcast(&due, 1, MPI_INT, 0, MPI_COMM_WORLD);
+    #endif
+
+    return due;
+}
+
+/*----------------------------------------------------------------------------*/
+
+static size_t RngStateSize(void)
+/* Size in bytes of the state of one thread's random number generator; QMC
+ * generators only carry state through the fully random stage */
+{
+    if(glb.qmc)
+        return glb.fully_random ? gsl_qrng_size(glb.qrng[0]) : 0;
+    else
+        return gsl_rng_size(glb.rng[0]);
+}
+
+/*----------------------------------------------------------------------------*/
+
+#define CKPT_MAGIC "SPARXCKP"
+#define CKPT_VERSION ((size_t)1)
+
+static void WriteCheckpoint(size_t iter)
+/* Write everything needed to resume CalcExc() at iteration iter of the
+ * current stage. The file is first written to a temporary file and then
+ * renamed, so that an interrupted write never destroys the last good
+ * checkpoint. A failed checkpoint is not fatal to the calculation. */
+{
+    int sts = 0;
+    size_t rng_size = RngStateSize();
+    size_t nbuf = Sp_NTHREAD * rng_size;
+    char *rng_state = Mem_CALLOC(Num_MAX(1, nbuf), rng_state);
+    char *rng_all = NULL;
+
+    /* Collect RNG states of all threads */
+    for(size_t i = 0; i < Sp_NTHREAD && rng_size > 0; i++) {
+        void *state = glb.qmc ? gsl_qrng_state(glb.qrng[i]) : gsl_rng_state(glb.rng[i]);
+        Mem_MEMCPY(&rng_state[i * rng_size], (char *)state, rng_size);
+    }
+
+    /* Gather RNG states of all processes to master */
+    #ifdef HAVE_MPI
+    if(Sp_MPISIZE > 1) {
+        if(Sp_MPIRANK == 0)
+            rng_all = Mem_CALLOC(Num_MAX(1, Sp_MPISIZE * nbuf), rng_all);
+        MPI_Gather(rng_state, (int)nbuf, MPI_CHAR, rng_all, (int)nbuf, MPI_CHAR, 0, MPI_COMM_WORLD);
+    }
+    #endif
+    if(!rng_all) {
+        rng_all = rng_state;
+        rng_state = NULL;
+    }
+
+    /* Only the master process can write files */
+    if(Sp_MPIRANK == 0) {
+        char *tmpname = Mem_Sprintf("%s.tmp", glb.ckpt_fname);
+        FILE *fp = fopen(tmpname, "wb");
+        if(!fp)
+            sts = 1;
+
+        #define CKPT_WRITE(ptr, n) \
+        if(!sts && fwrite((ptr), sizeof(*(ptr)), (size_t)(n), fp) != (size_t)(n)) \
+            sts = 1;
+
+        size_t header[] = {
+            CKPT_VERSION, glb.nzone, NLEV, NRAD, Sp_MPISIZE, Sp_NTHREAD,
+            (size_t)glb.stage, iter, glb.nconv, (size_t)glb.qmc,
+            glb.ng ? NG_NHIST : 0, glb.ng_nhist, rng_size
+        };
+        CKPT_WRITE(CKPT_MAGIC, strlen(CKPT_MAGIC))
+        CKPT_WRITE(header, sizeof(header) / sizeof(header[0]))
+        CKPT_WRITE(&glb.seed, 1)
+
+        for(size_t izone = 0; izone < glb.nzone; izone++) {
+            SpPhys *pp = glb.zones[izone]->data;
+
+            CKPT_WRITE(&pp->nray, 1)
+            CKPT_WRITE(&pp->diff, 1)
+            CKPT_WRITE(&pp->ds, 1)
+            CKPT_WRITE(&glb.zone_tid[izone], 1)
+            CKPT_WRITE(&glb.zone_rank[izone], 1)
+            CKPT_WRITE(pp->pops_preserve, NLEV)
+            CKPT_WRITE(pp->tau, NRAD)
+        }
+        if(glb.ng)
+            CKPT_WRITE(glb.ng_hist, glb.nzone * NG_NHIST * NLEV)
+        CKPT_WRITE(rng_all, Sp_MPISIZE * nbuf)
+
+        #undef CKPT_WRITE
+
+        if(fp && fclose(fp))
+            sts = 1;
+        if(!sts && rename(tmpname, glb.ckpt_fname))
+            sts = 1;
+
+        if(sts)
+            Sp_PWARN("failed to write checkpoint `%s'\n", glb.ckpt_fname);
+        else
+            Sp_PRINT("Wrote checkpoint to `%s'\n", glb.ckpt_fname);
+
+        free(tmpname);
+        time(&glb.t_ckpt);
+    }
+
+    if(rng_state)
+        free(rng_state);
+    free(rng_all);
+
+    return;
+}
+
+/*----------------------------------------------------------------------------*/
+
+static int ReadCheckpoint(void)
+/* Load state written by WriteCheckpoint(). Must be called after InitModel().
+ * If the number of processes or threads has changed, the saved load
+ * balancing and RNG states are discarded and the run continues with the
+ * default zone distribution and fresh random numbers. */
+{
+    int sts = 0;
+    FILE *fp = fopen(glb.restart_fname, "rb");
+    if(!fp) {
+        PyWrErr_SetString(PyExc_Exception, "Error opening checkpoint '%s'", glb.restart_fname);
+        return 1;
+    }
+
+    #define CKPT_READ(ptr, n) \
+    if(!sts && fread((ptr), sizeof(*(ptr)), (size_t)(n), fp) != (size_t)(n)) \
+        sts = 1;
+
+    char magic[sizeof(CKPT_MAGIC)] = "";
+    size_t header[13];
+    CKPT_READ(magic, strlen(CKPT_MAGIC))
+    CKPT_READ(header, 13)
+
+    size_t version = header[0], nzone = header[1], nlev = header[2], nrad = header[3],
+           mpisize = header[4], nthread = header[5], ng_len = header[10],
+           ng_nhist = header[11], rng_size = header[12];
+    if(!sts && (strcmp(magic, CKPT_MAGIC) || version != CKPT_VERSION)) {
+        PyWrErr_SetString(PyExc_Exception, "'%s' is not a valid checkpoint file", glb.restart_fname);
+        fclose(fp);
+        return 1;
+    }
+    if(!sts && (nzone != glb.nzone || nlev != NLEV || nrad != NRAD || (int)header[9] != glb.qmc)) {
+        PyWrErr_SetString(PyExc_Exception, "Checkpoint '%s' does not match the model or the qmc setting", glb.restart_fname);
+        fclose(fp);
+        return 1;
+    }
+    int same_layout = (mpisize == Sp_MPISIZE && nthread == Sp_NTHREAD);
+
+    glb.stage = (int)header[6];
+    glb.iter0 = header[7];
+    glb.nconv = header[8];
+    CKPT_READ(&glb.seed, 1)
+
+    for(size_t izone = 0; !sts && izone < glb.nzone; izone++) {
+        SpPhys *pp = glb.zones[izone]->data;
+        size_t zone_tid, zone_rank;
+
+        CKPT_READ(&pp->nray, 1)
+        CKPT_READ(&pp->diff, 1)
+        CKPT_READ(&pp->ds, 1)
+        CKPT_READ(&zone_tid, 1)
+        CKPT_READ(&zone_rank, 1)
+        CKPT_READ(pp->pops_preserve, NLEV)
+        CKPT_READ(pp->tau, NRAD)
+
+        if(same_layout) {
+            glb.zone_tid[izone] = zone_tid;
+            glb.zone_rank[izone] = zone_rank;
+        }
+    }
+
+    /* Ng history is only usable if ng_order has not changed */
+    if(!sts && ng_len > 0) {
+        if(glb.ng && ng_len == NG_NHIST) {
+            CKPT_READ(glb.ng_hist, glb.nzone * NG_NHIST * NLEV)
+            glb.ng_nhist = ng_nhist;
+        }
+        else if(fseek(fp, (long)(glb.nzone * ng_len * NLEV * sizeof(double)), SEEK_CUR)) {
+            sts = 1;
+        }
+    }
+
+    /* Keep the RNG states of this process until CalcExc() allocates the
+     * generators of the resumed stage */
+    if(!sts && rng_size > 0) {
+        if(same_layout) {
+            size_t nbuf = Sp_NTHREAD * rng_size;
+            glb.ckpt_rng = Mem_CALLOC(nbuf, glb.ckpt_rng);
+            glb.ckpt_rng_size = rng_size;
+            if(fseek(fp, (long)(Sp_MPIRANK * nbuf), SEEK_CUR))
+                sts = 1;
+            CKPT_READ(glb.ckpt_rng, nbuf)
+        }
+        else {
+            Sp_PWARN("number of processes/threads differs from checkpoint `%s', zone distribution and random numbers are reset\n", glb.restart_fname);
+        }
+    }
+
+    #undef CKPT_READ
+
+    fclose(fp);
+
+    if(sts)
+        PyWrErr_SetString(PyExc_Exception, "Error reading checkpoint '%s'", glb.restart_fname);
+    else
+        Sp_PRINT("Resuming from checkpoint `%s' at stage %d, iteration %g\n", glb.restart_fname, glb.stage, (double)(glb.iter0 + 1));
+
+    return sts;
 }
 
+#undef CKPT_MAGIC
+#undef CKPT_VERSION
 
+/*----------------------------------------------------------------------------*/
+
+static void RestoreRngState(void)
+/* Restore RNG states loaded by ReadCheckpoint() */
+{
+    if(!glb.ckpt_rng)
+        return;
 
+    if(RngStateSize() == glb.ckpt_rng_size) {
+        for(size_t i = 0; i < Sp_NTHREAD; i++) {
+            void *state = glb.qmc ? gsl_qrng_state(glb.qrng[i]) : gsl_rng_state(glb.rng[i]);
+            Mem_MEMCPY((char *)state, &glb.ckpt_rng[i * glb.ckpt_rng_size], glb.ckpt_rng_size);
+        }
+    }
 
+    free(glb.ckpt_rng);
+    glb.ckpt_rng = NULL;
 
+    return;
+}
@@ -18,10 +18,14 @@ static struct glb {
     double lamb, freq;
 
     SpTelsim tel_parms;
+    /* Views (dist and rotate) rendered from the same model, if any */
+    size_t nview;
+    SpTelsim *views;
 
     MirImg_Axis x, y, v;
     MirFile *imgf, *StxQf, *StxUf, *tau_imgf;
     MirImg *image, *StokesQ, *StokesU, *StokesV, *sigma2, *tau_img;
+    SpImgPixels pix;
 } glb;
 
 
@@ -44,6 +48,9 @@ static void *InitModelThread(void *tid_p);
 
 static void *CalcImageThreadCont(void *tid_p);
 static void *CalcImageThreadContPolariz(void *tid_p);
+static void LOSCont(double dx, double dy, double *val, size_t tid);
+static void WriteImages(int stokes);
+static void LOSContPolariz(double dx, double dy, double *val, size_t tid);
 
 static void RadiativeXferCont(double dx, double dy, double *I_nu, double *tau_nu);
 static void RadiativeXferContPolariz(double dx, double dy, double *I_nu, double *Q_nu, double *U_nu, double *sigma2, double *tau_nu);
@@ -83,11 +90,6 @@ int SpTask_ContObs(void)
         SpPy_XDECREF(o);
     }
 
-    /* out (mandatory) */
-    if(!sts){
-        sts = SpPy_GetInput_mirxy_new("out", glb.x.n, glb.y.n, glb.v.n, &glb.imgf);
-    }
-
     /* dist */
     if(!sts) sts = SpPy_GetInput_dbl("dist", &glb.tel_parms.dist);
     glb.tel_parms.dist /= Sp_LENFAC;
@@ -117,6 +119,17 @@ int SpTask_ContObs(void)
         }
         SpPy_XDECREF(o);
     }
+    /* adaptive sub-pixel refinement */
+    if(!sts) sts = SpPy_GetInput_dbl("adaptive", &glb.tel_parms.adapt_tol);
+    if(!sts) sts = SpPy_GetInput_sizt("adaptive_depth", &glb.tel_parms.adapt_depth);
+    /* views (optional) */
+    if(!sts) sts = SpImgTrac_GetViews(&glb.views, &glb.nview);
+
+    /* out (mandatory): only the template of the view images if there are
+     * views */
+    if(!sts){
+        sts = SpImgTrac_GetInput_Image("out", glb.nview, &glb.x, &glb.y, &glb.v, &glb.imgf);
+    }
 
 
     /*    1-2 get the task-based parameters */
@@ -133,7 +146,7 @@ int SpTask_ContObs(void)
 
         /* tau (optional) */
         if(!sts && SpPy_CheckOptionalInput("tau")) {
-            sts = SpPy_GetInput_mirxy_new("tau", glb.x.n, glb.y.n, glb.v.n, &glb.tau_imgf);
+            sts = SpImgTrac_GetInput_Image("tau", glb.nview, &glb.x, &glb.y, &glb.v, &glb.tau_imgf);
         }
         PyObject *o_wavelen;
         o_wavelen = PyObject_GetAttrString(o, "wavelen");
@@ -177,6 +190,10 @@ int SpTask_ContObs(void)
         }
 
         /* Calculate image */
+        glb.pix.tel_parms = &glb.tel_parms;
+        glb.pix.x = &glb.x;
+        glb.pix.y = &glb.y;
+        glb.pix.nchan = glb.v.n;
         if (stokes){
             glb.StokesQ = MirImg_Alloc(glb.x, glb.y, glb.v);
             glb.StokesU = MirImg_Alloc(glb.x, glb.y, glb.v);
@@ -184,137 +201,61 @@ int SpTask_ContObs(void)
             glb.StokesQ->restfreq = glb.freq;
             glb.StokesU->restfreq = glb.freq;
             glb.sigma2->restfreq = glb.freq;
-            sts = SpUtil_Threads2(Sp_NTHREAD, CalcImageThreadContPolariz);
+            glb.pix.nval = 5 * glb.v.n;
+            glb.pix.los = LOSContPolariz;
         }
         else{
-            sts = SpUtil_Threads2(Sp_NTHREAD, CalcImageThreadCont);
+            glb.pix.nval = 2 * glb.v.n;
+            glb.pix.los = LOSCont;
         }
     }
 
-    /* 4. I/O : OUTPUT */
-    if(!sts){
-        // output dust emission and its polarization image
-        double scale_factor = glb.I_norm/glb.ucon;
-
-        #if Sp_MIRSUPPORT
-        MirImg_WriteXY(glb.imgf, glb.image, glb.unit->name, scale_factor);
-        Sp_PRINT("Wrote Miriad image to `%s'\n", glb.imgf->name);
-        #endif
-
-        if (stokes){
-            #if Sp_MIRSUPPORT
-            char SQFName[64],SUFName[64];
-
-            sprintf( SQFName, "stokesQ_%s", glb.imgf->name);
-            glb.StxQf = MirXY_Open_new(SQFName, glb.x.n, glb.y.n, glb.v.n);
-            MirImg_WriteXY(glb.StxQf, glb.StokesQ, glb.unit->name, scale_factor);
-            Sp_PRINT("Wrote Miriad image to `%s'\n", glb.StxQf->name);
-
-            sprintf( SUFName, "stokesU_%s", glb.imgf->name);
-            glb.StxUf = MirXY_Open_new(SUFName, glb.x.n, glb.y.n, glb.v.n);
-            MirImg_WriteXY(glb.StxUf, glb.StokesU, glb.unit->name, scale_factor);
-            Sp_PRINT("Wrote Miriad image to `%s'\n", glb.StxUf->name);
-            #endif
-
-            char filename[32];
-            sprintf(filename,"stokesIQU_%s.vtk",glb.imgf->name);
-            FILE *fp=fopen(filename,"w");
-            fprintf(fp,"# vtk DataFile Version 3.0\n");
-            fprintf(fp,"Stokes parameters\n");
-            fprintf(fp,"ASCII\n");
-            fprintf(fp,"DATASET STRUCTURED_POINTS\n");
-            fprintf(fp,"DIMENSIONS %zu %zu %d\n",glb.x.n,glb.y.n,1);
-            fprintf(fp,"ORIGIN %f %f %d\n",-glb.x.crpix,-glb.y.crpix,0);
-            fprintf(fp,"SPACING %11.4e %11.4e %d\n",glb.x.delt,glb.y.delt,1);
-            fprintf(fp,"POINT_DATA %zu\n",glb.x.n * glb.y.n);
-            fprintf(fp,"SCALARS Stokes_I float 1\n");
-            fprintf(fp,"LOOKUP_TABLE default\n");
-            for(size_t iy = 0; iy < glb.y.n; iy++)
-                for(size_t ix = 0; ix < glb.x.n; ix++)
-                    fprintf(fp,"%11.4e ",MirImg_PIXEL(*glb.image, 0, ix, iy));
-                fprintf(fp,"\n");
-            fprintf(fp,"SCALARS Stokes_Q float 1\n");
-            fprintf(fp,"LOOKUP_TABLE default\n");
-            for(size_t iy = 0; iy < glb.y.n; iy++)
-                for(size_t ix = 0; ix < glb.x.n; ix++)
-                    fprintf(fp,"%11.4e ",MirImg_PIXEL(*glb.StokesQ, 0, ix, iy));
-                fprintf(fp,"\n");
-            fprintf(fp,"SCALARS Stokes_U float 1\n");
-            fprintf(fp,"LOOKUP_TABLE default\n");
-            for(size_t iy = 0; iy < glb.y.n; iy++)
-                for(size_t ix = 0; ix < glb.x.n; ix++)
-                    fprintf(fp,"%11.4e ",MirImg_PIXEL(*glb.StokesU, 0, ix, iy));
-                fclose(fp);
-
-
-            sprintf(filename,"stokesI_%s.dat",glb.imgf->name);
-            fp=fopen(filename,"w");
-            for(size_t iy = 0; iy < glb.y.n; iy++) {
-                for(size_t ix = 0; ix < glb.x.n; ix++)
-                    fprintf(fp,"%5zu %5zu %11.4e\n",ix,iy,MirImg_PIXEL(*glb.image, 0, ix, iy));
-                fprintf(fp,"\n");
-            }
-            fclose(fp);
-            sprintf(filename,"stokesQ_%s.dat",glb.imgf->name);
-            fp=fopen(filename,"w");
-            for(size_t iy = 0; iy < glb.y.n; iy++) {
-                for(size_t ix = 0; ix < glb.x.n; ix++)
-                    fprintf(fp,"%5zu %5zu %11.4e\n",ix,iy,MirImg_PIXEL(*glb.StokesQ, 0, ix, iy));
-                fprintf(fp,"\n");
-            }
-            fclose(fp);
-            sprintf(filename,"stokesU_%s.dat",glb.imgf->name);
-            fp=fopen(filename,"w");
-            for(size_t iy = 0; iy < glb.y.n; iy++) {
-                for(size_t ix = 0; ix < glb.x.n; ix++)
-                    fprintf(fp,"%5zu %5zu %11.4e\n",ix,iy,MirImg_PIXEL(*glb.StokesU, 0, ix, iy));
-                fprintf(fp,"\n");
-            }
-            fclose(fp);
-
-            sprintf(filename,"vector_%s.dat",glb.imgf->name);
-            fp=fopen(filename,"w");
-            for(size_t iy = 0; iy < glb.y.n; iy++) {
-                for(size_t ix = 0; ix < glb.x.n; ix++) {
-                    double StxI = MirImg_PIXEL(*glb.image, 0, ix, iy);
-                    double StxQ = MirImg_PIXEL(*glb.StokesQ, 0, ix, iy);
-                    double StxU = MirImg_PIXEL(*glb.StokesU, 0, ix, iy);
-
-                    double pd = sqrt( StxQ*StxQ + StxU*StxU ) / StxI;
-
-                    double xi=atan2(StxU,StxQ); xi = 0.5 * xi;
-                    double vecx=-pd*sin(xi);
-                    double vecy=pd*cos(xi);
-
-                    fprintf(fp,"%5zu %5zu %11.4e %11.4e %11.4e %11.4e\n",ix,iy,vecx,vecy,pd,xi);
-                }
-                fprintf(fp,"\n");
-            }
-            fclose(fp);
+    /* Render all views from the same model, one after the other with all
+     * threads */
+    for(size_t iview = 0; !sts && iview < Num_MAX(glb.nview, 1); iview++) {
+        MirFile *imgf = glb.imgf, *tau_imgf = glb.tau_imgf;
 
+        if(glb.nview > 0) {
+            SpImgTrac_SetView(&glb.tel_parms, &glb.views[iview], iview, glb.nview);
+            glb.imgf = SpImgTrac_OpenViewImage(imgf, iview, &glb.x, &glb.y, &glb.v);
+            if(tau_imgf)
+                glb.tau_imgf = SpImgTrac_OpenViewImage(tau_imgf, iview, &glb.x, &glb.y, &glb.v);
         }
 
-        FITSoutput( glb.imgf, glb.image, glb.StokesQ, glb.StokesU, glb.unit->name, scale_factor, stokes);
-        Sp_PRINT("Wrote FITS image to `%s'\n", glb.imgf->name);
-
-        // output tau image
-        if(glb.tau_imgf){
-            FITSoutput( glb.tau_imgf, glb.tau_img, glb.StokesQ, glb.StokesU, "Optical depth", 1., 0);
-            Sp_PRINT("Wrote FITS image to `%s'\n", glb.tau_imgf->name);
-
+        /* Calculate image */
+        if (stokes)
+            sts = SpImgTrac_CalcImage(&glb.pix, CalcImageThreadContPolariz);
+        else
+            sts = SpImgTrac_CalcImage(&glb.pix, CalcImageThreadCont);
+
+        /* 4. I/O : OUTPUT */
+        if(!sts)
+            WriteImages(stokes);
+
+        if(glb.nview > 0) {
+            SpImgTrac_CloseViewImage(glb.imgf);
+            if(tau_imgf)
+                SpImgTrac_CloseViewImage(glb.tau_imgf);
             #if Sp_MIRSUPPORT
-            MirImg_WriteXY(glb.tau_imgf, glb.tau_img, "Optical depth", 1.0);
-            Sp_PRINT("Wrote Miriad image to `%s'\n", glb.tau_imgf->name);
-            MirXY_Close(glb.tau_imgf);
+            if(glb.StxQf)
+                MirXY_Close(glb.StxQf);
+            if(glb.StxUf)
+                MirXY_Close(glb.StxUf);
+            glb.StxQf = glb.StxUf = NULL;
             #endif
+            glb.imgf = imgf;
+            glb.tau_imgf = tau_imgf;
         }
     }
 
+
     /* 5. Cleanup */
-    #if Sp_MIRSUPPORT
     /* Miriad images must always be closed! */
     if(glb.imgf)
-        MirXY_Close(glb.imgf);
+        SpImgTrac_CloseImage(glb.imgf, glb.nview);
+    if(glb.nview > 0 && glb.tau_imgf)
+        SpImgTrac_CloseImage(glb.tau_imgf, glb.nview);
+    #if Sp_MIRSUPPORT
     if(glb.StxQf)
         MirXY_Close(glb.StxQf);
     if(glb.StxUf)
@@ -332,6 +273,8 @@ int SpTask_ContObs(void)
         MirImg_Free(glb.tau_img);
     if(glb.tel_parms.subres)
         free(glb.tel_parms.subres);
+    if(glb.views)
+        free(glb.views);
 
     SpModel_Cleanup(glb.model);
 
@@ -449,63 +392,197 @@ static void *InitModelThread(void *tid_p)
 }
 /*----------------------------------------------------------------------------*/
 
+static void WriteImages(int stokes)
+/* Write the images to glb.imgf and glb.tau_imgf, and the Stokes
+ * parameters to files named after glb.imgf */
+{
+    // output dust emission and its polarization image
+    double scale_factor = glb.I_norm/glb.ucon;
+
+    #if Sp_MIRSUPPORT
+    MirImg_WriteXY(glb.imgf, glb.image, glb.unit->name, scale_factor);
+    Sp_PRINT("Wrote Miriad image to `%s'\n", glb.imgf->name);
+    #endif
+
+    if (stokes){
+        #if Sp_MIRSUPPORT
+        char SQFName[BUFSIZ],SUFName[BUFSIZ];
+
+        sprintf( SQFName, "stokesQ_%s", glb.imgf->name);
+        glb.StxQf = MirXY_Open_new(SQFName, glb.x.n, glb.y.n, glb.v.n);
+        MirImg_WriteXY(glb.StxQf, glb.StokesQ, glb.unit->name, scale_factor);
+        Sp_PRINT("Wrote Miriad image to `%s'\n", glb.StxQf->name);
+
+        sprintf( SUFName, "stokesU_%s", glb.imgf->name);
+        glb.StxUf = MirXY_Open_new(SUFName, glb.x.n, glb.y.n, glb.v.n);
+        MirImg_WriteXY(glb.StxUf, glb.StokesU, glb.unit->name, scale_factor);
+        Sp_PRINT("Wrote Miriad image to `%s'\n", glb.StxUf->name);
+        #endif
+
+        char filename[BUFSIZ];
+        sprintf(filename,"stokesIQU_%s.vtk",glb.imgf->name);
+        FILE *fp=fopen(filename,"w");
+        fprintf(fp,"# vtk DataFile Version 3.0\n");
+        fprintf(fp,"Stokes parameters\n");
+        fprintf(fp,"ASCII\n");
+        fprintf(fp,"DATASET STRUCTURED_POINTS\n");
+        fprintf(fp,"DIMENSIONS %zu %zu %d\n",glb.x.n,glb.y.n,1);
+        fprintf(fp,"ORIGIN %f %f %d\n",-glb.x.crpix,-glb.y.crpix,0);
+        fprintf(fp,"SPACING %11.4e %11.4e %d\n",glb.x.delt,glb.y.delt,1);
+        fprintf(fp,"POINT_DATA %zu\n",glb.x.n * glb.y.n);
+        fprintf(fp,"SCALARS Stokes_I float 1\n");
+        fprintf(fp,"LOOKUP_TABLE default\n");
+        for(size_t iy = 0; iy < glb.y.n; iy++)
+            for(size_t ix = 0; ix < glb.x.n; ix++)
+                fprintf(fp,"%11.4e ",MirImg_PIXEL(*glb.image, 0, ix, iy));
+            fprintf(fp,"\n");
+        fprintf(fp,"SCALARS Stokes_Q float 1\n");
+        fprintf(fp,"LOOKUP_TABLE default\n");
+        for(size_t iy = 0; iy < glb.y.n; iy++)
+            for(size_t ix = 0; ix < glb.x.n; ix++)
+                fprintf(fp,"%11.4e ",MirImg_PIXEL(*glb.StokesQ, 0, ix, iy));
+            fprintf(fp,"\n");
+        fprintf(fp,"SCALARS Stokes_U float 1\n");
+        fprintf(fp,"LOOKUP_TABLE default\n");
+        for(size_t iy = 0; iy < glb.y.n; iy++)
+            for(size_t ix = 0; ix < glb.x.n; ix++)
+                fprintf(fp,"%11.4e ",MirImg_PIXEL(*glb.StokesU, 0, ix, iy));
+            fclose(fp);
+
+
+        sprintf(filename,"stokesI_%s.dat",glb.imgf->name);
+        fp=fopen(filename,"w");
+        for(size_t iy = 0; iy < glb.y.n; iy++) {
+            for(size_t ix = 0; ix < glb.x.n; ix++)
+                fprintf(fp,"%5zu %5zu %11.4e\n",ix,iy,MirImg_PIXEL(*glb.image, 0, ix, iy));
+            fprintf(fp,"\n");
+        }
+        fclose(fp);
+        sprintf(filename,"stokesQ_%s.dat",glb.imgf->name);
+        fp=fopen(filename,"w");
+        for(size_t iy = 0; iy < glb.y.n; iy++) {
+            for(size_t ix = 0; ix < glb.x.n; ix++)
+                fprintf(fp,"%5zu %5zu %11.4e\n",ix,iy,MirImg_PIXEL(*glb.StokesQ, 0, ix, iy));
+            fprintf(fp,"\n");
+        }
+        fclose(fp);
+        sprintf(filename,"stokesU_%s.dat",glb.imgf->name);
+        fp=fopen(filename,"w");
+        for(size_t iy = 0; iy < glb.y.n; iy++) {
+            for(size_t ix = 0; ix < glb.x.n; ix++)
+                fprintf(fp,"%5zu %5zu %11.4e\n",ix,iy,MirImg_PIXEL(*glb.StokesU, 0, ix, iy));
+            fprintf(fp,"\n");
+        }
+        fclose(fp);
+
+        sprintf(filename,"vector_%s.dat",glb.imgf->name);
+        fp=fopen(filename,"w");
+        for(size_t iy = 0; iy < glb.y.n; iy++) {
+            for(size_t ix = 0; ix < glb.x.n; ix++) {
+                double StxI = MirImg_PIXEL(*glb.image, 0, ix, iy);
+                double StxQ = MirImg_PIXEL(*glb.StokesQ, 0, ix, iy);
+                double StxU = MirImg_PIXEL(*glb.StokesU, 0, ix, iy);
+
+                double pd = sqrt( StxQ*StxQ + StxU*StxU ) / StxI;
+
+                double xi=atan2(StxU,StxQ); xi = 0.5 * xi;
+                double vecx=-pd*sin(xi);
+                double vecy=pd*cos(xi);
+
+                fprintf(fp,"%5zu %5zu %11.4e %11.4e %11.4e %11.4e\n",ix,iy,vecx,vecy,pd,xi);
+            }
+            fprintf(fp,"\n");
+        }
+        fclose(fp);
+
+    }
+
+    FITSoutput( glb.imgf, glb.image, glb.StokesQ, glb.StokesU, glb.unit->name, scale_factor, stokes);
+    Sp_PRINT("Wrote FITS image to `%s'\n", glb.imgf->name);
+
+    // output tau image
+    if(glb.tau_imgf){
+        FITSoutput( glb.tau_imgf, glb.tau_img, glb.StokesQ, glb.StokesU, "Optical depth", 1., 0);
+        Sp_PRINT("Wrote FITS image to `%s'\n", glb.tau_imgf->name);
+
+        #if Sp_MIRSUPPORT
+        MirImg_WriteXY(glb.tau_imgf, glb.tau_img, "Optical depth", 1.0);
+        Sp_PRINT("Wrote Miriad image to `%s'\n", glb.tau_imgf->name);
+        if(glb.nview == 0)
+            MirXY_Close(glb.tau_imgf);
+        #endif
+    }
+
+
+    return;
+}
+
+/*----------------------------------------------------------------------------*/
+
+static void LOSCont(double dx, double dy, double *val, size_t tid)
+/* I_nu and tau_nu of the line of sight at (dx, dy) */
+{
+    Mem_BZERO2(val, 2 * glb.v.n);
+
+    /* Calculate radiative transfer for this los */
+    RadiativeXferCont(dx, dy, val, &val[glb.v.n]);
+
+    return;
+}
+
+/*----------------------------------------------------------------------------*/
+
+static void LOSContPolariz(double dx, double dy, double *val, size_t tid)
+/* I_nu, Q_nu, U_nu, sigma2 and tau_nu of the line of sight at (dx, dy) */
+{
+    size_t nvelo = glb.v.n;
+
+    Mem_BZERO2(val, 5 * nvelo);
+
+    /* Calculate radiative transfer for this los */
+    RadiativeXferContPolariz(dx, dy, val, &val[nvelo], &val[2 * nvelo], &val[3 * nvelo], &val[4 * nvelo]);
+
+    return;
+}
+
+/*----------------------------------------------------------------------------*/
+
 static void *CalcImageThreadCont(void *tid_p)
 {
     size_t tid = *((size_t *)tid_p);
     size_t nvelo = glb.v.n;
 
-    /* pix_id is used for distributing work to threads */
-    size_t pix_id = 0;
-    for(size_t ix = 0; ix < glb.x.n; ix++) {
-        for(size_t iy = 0; iy < glb.y.n; iy++) {
-            if(pix_id % Sp_NTHREAD == tid) {
+    /* I_nu is the brightness and tau_nu the total optical depth for all
+     * channels at pixel (ix, iy) */
+    double *I_nu = Mem_CALLOC(2 * nvelo, I_nu);
+    double *tau_nu = &I_nu[nvelo];
+    /* Scratch space of SpImgTrac_CalcPixel() */
+    double *scratch = Mem_CALLOC(glb.pix.nscratch, scratch);
+
+    /* Pull tiles of pixels off the shared queue until it is empty */
+    size_t ix0, ix1, iy0, iy1;
+    while(SpImgTrac_NextTile(&glb.pix.tiles, &ix0, &ix1, &iy0, &iy1)) {
+        for(size_t ix = ix0; ix < ix1; ix++) {
+            for(size_t iy = iy0; iy < iy1; iy++) {
                 /* Check for thread termination */
                 Sp_CHECKTERMTHREAD();
-                /* check sub-sampling region */
-                size_t nsub = SpImgTrac_Init_nsub( ix, iy, &glb.tel_parms, &glb.x, &glb.y);
-
-                /* I_nu is the brightness for all channels at pixel (ix, iy) */
-                double *I_nu = Mem_CALLOC(nvelo, I_nu);
-                /* tau_nu is the total optical depth for all channels at pixel (ix, iy) */
-                double *tau_nu = Mem_CALLOC(nvelo, tau_nu);
-
-                /* Loop through sub-resolution positions */
-                for(size_t isub = 0; isub < nsub; isub++) {
-                    for(size_t jsub = 0; jsub < nsub; jsub++) {
-                        double dx, dy;
-                        /* Calculate sub-pixel position */
-                        SpImgTrac_InitSubPixel( &dx, &dy, ix, iy, isub, jsub, nsub, &glb.x, &glb.y);
-                        /* I_sub is the brightness for all channels at each sub-resolution */
-                        double *I_sub = Mem_CALLOC(nvelo, I_sub);
-                        double *tau_sub = Mem_CALLOC(nvelo, tau_sub);
-                        /* Calculate radiative transfer for this sub-los */
-                        RadiativeXferCont(dx, dy, I_sub, tau_sub);
-                        /* Add I_sub to I_nu */
-                        for(size_t iv = 0; iv < nvelo; iv++) {
-                            I_nu[iv] += I_sub[iv];
-                            tau_nu[iv] += tau_sub[iv];
-                        }
-                        /* Cleanup */
-                        free(I_sub);
-                        free(tau_sub);
-                    }
-                }
+                /* Average over sub-resolution positions */
+                SpImgTrac_CalcPixel(&glb.pix, ix, iy, I_nu, scratch, tid);
+
                 /* Save averaged I_nu to map */
-                double DnsubSquare = 1. / (double)(nsub * nsub);
                 for(size_t iv = 0; iv < nvelo; iv++) {
-                    MirImg_PIXEL(*glb.image, iv, ix, iy) = I_nu[iv] * DnsubSquare;
+                    MirImg_PIXEL(*glb.image, iv, ix, iy) = I_nu[iv];
                     if(glb.tau_img)
-                        MirImg_PIXEL(*glb.tau_img, iv, ix, iy) = tau_nu[iv] * DnsubSquare;
+                        MirImg_PIXEL(*glb.tau_img, iv, ix, iy) = tau_nu[iv];
                 }
-                /* Cleanup */
-                free(I_nu);
-                free(tau_nu);
             }
-            /* Increment pix_id */
-            pix_id += 1;
         }
     }
 
+    /* Cleanup */
+    free(I_nu);
+    free(scratch);
+
     return NULL;
 }
 /*----------------------------------------------------------------------------*/
@@ -515,77 +592,43 @@ static void *CalcImageThreadContPolariz(void *tid_p)
     size_t tid = *((size_t *)tid_p);
     size_t nvelo = glb.v.n;
 
-    /* pix_id is used for distributing work to threads */
-    size_t pix_id = 0;
-    for(size_t ix = 0; ix < glb.x.n; ix++) {
-        for(size_t iy = 0; iy < glb.y.n; iy++) {
-            if(pix_id % Sp_NTHREAD == tid) {
+    /* I_nu, Stokes Q and U, sigma2 and the total optical depth tau_nu for
+     * all channels at pixel (ix, iy) */
+    double *I_nu = Mem_CALLOC(5 * nvelo, I_nu);
+    double *Q_nu = &I_nu[nvelo];
+    double *U_nu = &I_nu[2 * nvelo];
+    double *sigma2 = &I_nu[3 * nvelo];
+    double *tau_nu = &I_nu[4 * nvelo];
+    /* Scratch space of SpImgTrac_CalcPixel() */
+    double *scratch = Mem_CALLOC(glb.pix.nscratch, scratch);
+
+    /* Pull tiles of pixels off the shared queue until it is empty */
+    size_t ix0, ix1, iy0, iy1;
+    while(SpImgTrac_NextTile(&glb.pix.tiles, &ix0, &ix1, &iy0, &iy1)) {
+        for(size_t ix = ix0; ix < ix1; ix++) {
+            for(size_t iy = iy0; iy < iy1; iy++) {
                 /* Check for thread termination */
                 Sp_CHECKTERMTHREAD();
-                /* check sub-sampling region */
-                size_t nsub = SpImgTrac_Init_nsub( ix, iy, &glb.tel_parms, &glb.x, &glb.y);
-
-                /* I_nu is the brightness for all channels at pixel (ix, iy) */
-                double *I_nu = Mem_CALLOC(nvelo, I_nu);
-                double *Q_nu = Mem_CALLOC(nvelo, Q_nu);
-                double *U_nu = Mem_CALLOC(nvelo, U_nu);
-                double *sigma2 = Mem_CALLOC(nvelo, sigma2);
-                /* tau_nu is the total optical depth for all channels at pixel (ix, iy) */
-                double *tau_nu = Mem_CALLOC(nvelo, tau_nu);
-
-                /* Loop through sub-resolution positions */
-                for(size_t isub = 0; isub < nsub; isub++) {
-                    for(size_t jsub = 0; jsub < nsub; jsub++) {
-                        double dx, dy;
-                        /* Calculate sub-pixel position */
-                        SpImgTrac_InitSubPixel( &dx, &dy, ix, iy, isub, jsub, nsub, &glb.x, &glb.y);
-                        /* I_sub is the brightness for all channels at each sub-resolution */
-                        double *I_sub = Mem_CALLOC(nvelo, I_sub);
-                        double *Q_sub = Mem_CALLOC(nvelo, Q_sub);
-                        double *U_sub = Mem_CALLOC(nvelo, U_sub);
-                        double *sigma2_sub = Mem_CALLOC(nvelo, sigma2_sub);
-                        double *tau_sub = Mem_CALLOC(nvelo, tau_sub);
-                        /* Calculate radiative transfer for this sub-los */
-                        RadiativeXferContPolariz(dx, dy, I_sub, Q_sub, U_sub, sigma2_sub, tau_sub);
-                        /* Add I_sub to I_nu */
-                        for(size_t iv = 0; iv < nvelo; iv++) {
-                            I_nu[iv] += I_sub[iv];
-                            Q_nu[iv] += Q_sub[iv];
-                            U_nu[iv] += U_sub[iv];
-                            sigma2[iv] += sigma2_sub[iv];
-                            tau_nu[iv] += tau_sub[iv];
-                        }
-                        /* Cleanup */
-                        free(I_sub);
-                        free(tau_sub);
-                        free(Q_sub);
-                        free(U_sub);
-                        free(sigma2_sub);
-                    }
-                }
-                /* Save averaged I_nu to map */
-                double DnsubSquare = 1. / (double)(nsub * nsub);
+                /* Average over sub-resolution positions */
+                SpImgTrac_CalcPixel(&glb.pix, ix, iy, I_nu, scratch, tid);
+
+                /* Save averaged values to maps */
                 for(size_t iv = 0; iv < nvelo; iv++) {
-                    MirImg_PIXEL(*glb.image, iv, ix, iy) = ( I_nu[iv] - sigma2[iv] ) * DnsubSquare;
-                    MirImg_PIXEL(*glb.StokesQ, iv, ix, iy) = Q_nu[iv] * DnsubSquare;
-                    MirImg_PIXEL(*glb.StokesU, iv, ix, iy) = U_nu[iv] * DnsubSquare;
-                    MirImg_PIXEL(*glb.sigma2, iv, ix, iy) = sigma2[iv] * DnsubSquare;
+                    MirImg_PIXEL(*glb.image, iv, ix, iy) = I_nu[iv] - sigma2[iv];
+                    MirImg_PIXEL(*glb.StokesQ, iv, ix, iy) = Q_nu[iv];
+                    MirImg_PIXEL(*glb.StokesU, iv, ix, iy) = U_nu[iv];
+                    MirImg_PIXEL(*glb.sigma2, iv, ix, iy) = sigma2[iv];
                     if(glb.tau_img)
-                        MirImg_PIXEL(*glb.tau_img, iv, ix, iy) = tau_nu[iv] * DnsubSquare;
+                        MirImg_PIXEL(*glb.tau_img, iv, ix, iy) = tau_nu[iv];
                 }
-                /* Cleanup */
-                free(I_nu);
-                free(tau_nu);
-                free(Q_nu);
-                free(U_nu);
-                free(sigma2);
-
             }
-            /* Increment pix_id */
-            pix_id += 1;
         }
     }
 
+    /* Cleanup */
+    free(I_nu);
+    free(scratch);
+
     return NULL;
 }
 
@@ -655,7 +698,7 @@ static void RadiativeXferCont(double dx, double dy, double *I_nu, double *tau_nu
         }
     }
 
-    SpImgTrac_IntensityBC( side, I_nu, tau_nu, &ray, GEOM, VN, glb.I_in, glb.I_cmb, PARMS);
+    SpImgTrac_IntensityBC( side, I_nu, tau_nu, &ray, GEOM, VN, glb.I_in, glb.I_cmb, 0, PARMS);
 
 
     return;
@@ -762,7 +805,7 @@ static void RadiativeXferContPolariz(double dx, double dy, double *I_nu, double
         }
     }
 
-    SpImgTrac_IntensityBC( side, I_nu, tau_nu, &ray, GEOM, VN, glb.I_in, glb.I_cmb, PARMS);
+    SpImgTrac_IntensityBC( side, I_nu, tau_nu, &ray, GEOM, VN, glb.I_in, glb.I_cmb, 0, PARMS);
 
 
     return;
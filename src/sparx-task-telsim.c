@@ -5,6 +5,16 @@
 /* Miriad support */
 #define Sp_MIRSUPPORT MIRSUPPORT
 
+/* Image of one line: its normalization and boundary intensities, and its
+ * output image and tau cube */
+typedef struct {
+    size_t line;
+    double lamb, freq, ucon;
+    double I_norm, I_cmb, I_in;
+    MirFile *imgf, *tau_imgf;
+    MirImg *image, *tau_img;
+} LineImage;
+
 /* Global parameter struct */
 static struct glb {
     DatINode *task;
@@ -12,19 +22,21 @@ static struct glb {
     int overlap,lte;
 
     DatINode *unit;
-    double ucon, overlap_vel;
+    double overlap_vel;
 
-    double I_norm, I_cmb, I_in;
     SpModel model;
 
-    size_t line;
-    double lamb, freq;
+    /* Lines imaged from the same rays (always one for zeeman) */
+    size_t nline;
+    LineImage *lines;
 
     SpTelsim tel_parms;
+    /* Views (dist and rotate) rendered from the same model, if any */
+    size_t nview;
+    SpTelsim *views;
 
     MirImg_Axis x, y, v;
-    MirFile *imgf, *tau_imgf;
-    MirImg *image, *tau_img;
+    SpImgPixels pix;
 } glb;
 
 
@@ -47,9 +59,12 @@ static void *InitModelThread(void *tid_p);
 static int CalcImage(void);
 static void *CalcImageThreadLine(void *tid_p);
 static void *CalcImageThreadZeeman(void *tid_p);
+static void LOSLine(double dx, double dy, double *val, size_t tid);
+static void LOSZeeman(double dx, double dy, double *val, size_t tid);
 
-static void RadiativeXferLine(double dx, double dy, double *I_nu, double *tau_nu, size_t tid);
-static void RadiativeXferOverlap(double dx, double dy, double *I_nu, double *tau_nu, size_t tid);
+static void WriteImages(LineImage *li, size_t iview);
+static void RadiativeXferLine(double dx, double dy, double *val, size_t tid);
+static void RadiativeXferOverlap(double dx, double dy, double *val, size_t tid);
 static void RadiativeXferZeeman(double dx, double dy, double *V_nu, double *tau_nu, size_t tid);
 
 
@@ -88,11 +103,6 @@ int SpTask_Telsim(void)
         SpPy_XDECREF(o);
     }
 
-    /* out (mandatory) */
-    if(!sts){
-        sts = SpPy_GetInput_mirxy_new("out", glb.x.n, glb.y.n, glb.v.n, &glb.imgf);
-    }
-
     /* dist */
     if(!sts) sts = SpPy_GetInput_dbl("dist", &glb.tel_parms.dist);
     glb.tel_parms.dist /= Sp_LENFAC;
@@ -122,6 +132,11 @@ int SpTask_Telsim(void)
         }
         SpPy_XDECREF(o);
     }
+    /* adaptive sub-pixel refinement */
+    if(!sts) sts = SpPy_GetInput_dbl("adaptive", &glb.tel_parms.adapt_tol);
+    if(!sts) sts = SpPy_GetInput_sizt("adaptive_depth", &glb.tel_parms.adapt_depth);
+    /* views (optional) */
+    if(!sts) sts = SpImgTrac_GetViews(&glb.views, &glb.nview);
 
 
     /*    1-2 get the task-based parameters */
@@ -138,17 +153,48 @@ int SpTask_Telsim(void)
                 // for task-lineobs
             case TASK_LINE:
             case TASK_ZEEMAN:
-                { // get line transition
+                if(PyObject_HasAttrString(o, "lines")) {
+                    /* get line transitions and the names of their images
+                     * (lineobs) */
+                    PyObject *o_lines, *o_outs, *o_taus;
+                    o_lines = PyObject_GetAttrString(o, "lines");
+                    o_outs = PyObject_GetAttrString(o, "outs");
+                    o_taus = PyObject_GetAttrString(o, "taus");
+                    glb.nline = (size_t)PyList_Size(o_lines);
+                    glb.lines = Mem_CALLOC(glb.nline, glb.lines);
+                    for(size_t l = 0; !sts && l < glb.nline; l++) {
+                        LineImage *li = &glb.lines[l];
+                        li->line = Sp_PYSIZE(Sp_PYLST(o_lines, l));
+                        sts = SpImgTrac_OpenImage(Sp_PYSTR(Sp_PYLST(o_outs, l)), glb.nview, &glb.x, &glb.y, &glb.v, &li->imgf);
+                        if(!sts && Sp_PYLST(o_taus, l) != Py_None)
+                            sts = SpImgTrac_OpenImage(Sp_PYSTR(Sp_PYLST(o_taus, l)), glb.nview, &glb.x, &glb.y, &glb.v, &li->tau_imgf);
+                    }
+                    SpPy_XDECREF(o_lines);
+                    SpPy_XDECREF(o_outs);
+                    SpPy_XDECREF(o_taus);
+                }
+                else {
+                    /* get line transition */
                     PyObject *o_line;
                     o_line = PyObject_GetAttrString(o, "line");
-                    glb.line = Sp_PYSIZE(o_line);
+                    glb.nline = 1;
+                    glb.lines = Mem_CALLOC(1, glb.lines);
+                    glb.lines[0].line = Sp_PYSIZE(o_line);
                     SpPy_XDECREF(o_line);
+
+                    /* out (mandatory) */
+                    if(!sts)
+                        sts = SpImgTrac_GetInput_Image("out", glb.nview, &glb.x, &glb.y, &glb.v, &glb.lines[0].imgf);
+
+                    /* tau (optional) */
+                    if(!sts && SpPy_CheckOptionalInput("tau"))
+                        sts = SpImgTrac_GetInput_Image("tau", glb.nview, &glb.x, &glb.y, &glb.v, &glb.lines[0].tau_imgf);
                 }
                 if(!sts) sts = SpPy_GetInput_bool("lte", &glb.lte);
-
-                /* tau (optional) */
-                if(!sts && SpPy_CheckOptionalInput("tau")) {
-                    sts = SpPy_GetInput_mirxy_new("tau", glb.x.n, glb.y.n, glb.v.n, &glb.tau_imgf);
+                if(!sts) {
+                    double tol;
+                    if(!(sts = SpPy_GetInput_dbl("profile_tol", &tol)))
+                        Num_SetGaussNormalTol(tol);
                 }
 
                 { // get overlap velocity
@@ -195,59 +241,49 @@ int SpTask_Telsim(void)
 
     /* 3. Synthesize image */
     if(!sts) {
-        /* Allocate image */
-        glb.image = MirImg_Alloc(glb.x, glb.y, glb.v);
-        glb.image->restfreq = glb.freq;
-        if(glb.tau_imgf){
-            glb.tau_img = MirImg_Alloc(glb.x, glb.y, glb.v);
-            glb.tau_img->restfreq = glb.freq;
+        /* Allocate images */
+        for(size_t l = 0; l < glb.nline; l++) {
+            LineImage *li = &glb.lines[l];
+            li->image = MirImg_Alloc(glb.x, glb.y, glb.v);
+            li->image->restfreq = li->freq;
+            if(li->tau_imgf){
+                li->tau_img = MirImg_Alloc(glb.x, glb.y, glb.v);
+                li->tau_img->restfreq = li->freq;
+            }
         }
+    }
+
+    /* Render all views from the same model, one after the other with all
+     * threads */
+    for(size_t iview = 0; !sts && iview < Num_MAX(glb.nview, 1); iview++) {
+        if(glb.nview > 0)
+            SpImgTrac_SetView(&glb.tel_parms, &glb.views[iview], iview, glb.nview);
+
         /* Calculate image */
         sts = CalcImage();
-    }
 
-    /* 4. I/O : OUTPUT */
-    if(!sts){
-        double scale_factor = 1.0;
-        switch(glb.task->idx){
-            // output line emission or zeeman effect (stokes V) image
-            case TASK_LINE:
-            case TASK_ZEEMAN:
-                scale_factor = glb.I_norm/glb.ucon;
-                #if Sp_MIRSUPPORT
-                MirImg_WriteXY(glb.imgf, glb.image, glb.unit->name, scale_factor);
-                Sp_PRINT("Wrote Miriad image to `%s'\n", glb.imgf->name);
-                #endif
-                break;
-            default:
-                        Deb_ASSERT(0);
-        }
-        FITSoutput( glb.imgf, glb.image, NULL, NULL, glb.unit->name, scale_factor, 0);
-        Sp_PRINT("Wrote FITS image to `%s'\n", glb.imgf->name);
-
-        // output tau image
-        if(glb.tau_imgf){
-            FITSoutput( glb.tau_imgf, glb.tau_img, NULL, NULL, "Optical depth", 1., 0);
-            Sp_PRINT("Wrote FITS image to `%s'\n", glb.tau_imgf->name);
-
-            #if Sp_MIRSUPPORT
-            MirImg_WriteXY(glb.tau_imgf, glb.tau_img, "Optical depth", 1.0);
-            Sp_PRINT("Wrote Miriad image to `%s'\n", glb.tau_imgf->name);
-            MirXY_Close(glb.tau_imgf);
-            #endif
-        }
+        /* 4. I/O : OUTPUT */
+        for(size_t l = 0; !sts && l < glb.nline; l++)
+            WriteImages(&glb.lines[l], iview);
     }
 
     /* 5. Cleanup */
-    #if Sp_MIRSUPPORT
-    /* Miriad images must always be closed! */
-    if(glb.imgf)
-        MirXY_Close(glb.imgf);
-    #endif
-    if(glb.image)
-        MirImg_Free(glb.image);
-    if(glb.tau_img)
-        MirImg_Free(glb.tau_img);
+    for(size_t l = 0; l < glb.nline; l++) {
+        LineImage *li = &glb.lines[l];
+        /* Miriad images must always be closed! */
+        if(li->imgf)
+            SpImgTrac_CloseImage(li->imgf, glb.nview);
+        if(glb.nview > 0 && li->tau_imgf)
+            SpImgTrac_CloseImage(li->tau_imgf, glb.nview);
+        if(li->image)
+            MirImg_Free(li->image);
+        if(li->tau_img)
+            MirImg_Free(li->tau_img);
+    }
+    if(glb.lines)
+        free(glb.lines);
+    if(glb.views)
+        free(glb.views);
     if(glb.tel_parms.subres)
         free(glb.tel_parms.subres);
 
@@ -266,25 +302,45 @@ static int InitModel(void)
     int sts = 0;
     int task_id = glb.task->idx;
 
-    /* initialize line profile if LINE or ZEEMAN task */
-    if( task_id == TASK_LINE || task_id == TASK_ZEEMAN ){
-        Deb_ASSERT(glb.line < parms->mol->nrad);
-        glb.freq = parms->mol->rad[glb.line]->freq;
-        glb.lamb = PHYS_CONST_MKS_LIGHTC / glb.freq;
-    }
-    /* set the reference of the intensity: glb.ucon */
-    switch (glb.unit->idx){
-        case UNIT_K:
-            glb.ucon = Phys_RayleighJeans(glb.freq, 1.0);
-            break;
-        case UNIT_JYPX:
-            glb.ucon = (PHYS_UNIT_MKS_JY / (glb.x.delt * glb.y.delt));
-            break;
-        default:
-            Deb_ASSERT(0);
+    for(size_t l = 0; l < glb.nline; l++) {
+        LineImage *li = &glb.lines[l];
+
+        /* initialize line profile if LINE or ZEEMAN task */
+        if( task_id == TASK_LINE || task_id == TASK_ZEEMAN ){
+            Deb_ASSERT(li->line < parms->mol->nrad);
+            li->freq = parms->mol->rad[li->line]->freq;
+            li->lamb = PHYS_CONST_MKS_LIGHTC / li->freq;
+        }
+        /* set the reference of the intensity: li->ucon */
+        switch (glb.unit->idx){
+            case UNIT_K:
+                li->ucon = Phys_RayleighJeans(li->freq, 1.0);
+                break;
+            case UNIT_JYPX:
+                li->ucon = (PHYS_UNIT_MKS_JY / (glb.x.delt * glb.y.delt));
+                break;
+            default:
+                Deb_ASSERT(0);
+        }
+        /* Sanity check */
+        Deb_ASSERT((li->ucon > 0) && (!Num_ISNAN(li->ucon)) && (li->ucon < HUGE_VAL));
+
+        /* Set normalization intensity to 20K -- normalization prevents rounding
+         *	   errors from creeping in when flux values are very small */
+        li->I_norm = Phys_PlanckFunc(li->freq, 10.0);
+        Deb_ASSERT(li->I_norm > 0); /* Just in case */
+
+        /* Calculate CMB intensity */
+        if(parms->T_cmb > 0) {
+            li->I_cmb = Phys_PlanckFunc(li->freq, parms->T_cmb) / li->I_norm;
+            Deb_ASSERT(li->I_cmb > 0); /* Just in case */
+        }
+        /* Calculate inner boundary intensity */
+        if(parms->T_in > 0) {
+            li->I_in = Phys_PlanckFunc(li->freq, parms->T_in) / li->I_norm;
+            Deb_ASSERT(li->I_in > 0); /* Just in case */
+        }
     }
-    /* Sanity check */
-    Deb_ASSERT((glb.ucon > 0) && (!Num_ISNAN(glb.ucon)) && (glb.ucon < HUGE_VAL));
     /* initialization : construct overlapping table */
     if(glb.overlap){
         parms->mol->OL = Mem_CALLOC(NRAD*NRAD,parms->mol->OL);
@@ -304,22 +360,7 @@ static int InitModel(void)
         }
     }
 
-    /* Set normalization intensity to 20K -- normalization prevents rounding
-     *	   errors from creeping in when flux values are very small */
-    glb.I_norm = Phys_PlanckFunc(glb.freq, 10.0);
-    Deb_ASSERT(glb.I_norm > 0); /* Just in case */
-
-    /* Calculate CMB intensity */
-    if(parms->T_cmb > 0) {
-        glb.I_cmb = Phys_PlanckFunc(glb.freq, parms->T_cmb) / glb.I_norm;
-        Deb_ASSERT(glb.I_cmb > 0); /* Just in case */
-    }
-    /* Calculate inner boundary intensity */
-    if(parms->T_in > 0) {
-        glb.I_in = Phys_PlanckFunc(glb.freq, parms->T_in) / glb.I_norm;
-        Deb_ASSERT(glb.I_in > 0); /* Just in case */
-    }
-    /* Calculate Source intensity and the dim factor */
+    /* Calculate Source intensity of every line and the dim factor */
     int nSource = parms->Outer_Source;
     if(nSource){
         for (int source_id = 0; source_id < nSource; source_id++){
@@ -327,8 +368,9 @@ static int InitModel(void)
 
             source->beta = source->radius / source->distance;
 
-            source->intensity = Mem_CALLOC( 1, source->intensity);
-            source->intensity[0] = Phys_PlanckFunc( glb.freq, source->temperature) / glb.I_norm;
+            source->intensity = Mem_CALLOC( glb.nline, source->intensity);
+            for(size_t l = 0; l < glb.nline; l++)
+                source->intensity[l] = Phys_PlanckFunc( glb.lines[l].freq, source->temperature) / glb.lines[l].I_norm;
 
             GeVec3_X(source->pt_sph,0) = source->distance;
             GeVec3_X(source->pt_sph,1) = source->theta;
@@ -429,13 +471,68 @@ static void *InitModelThread(void *tid_p)
 
 /*----------------------------------------------------------------------------*/
 
+static void WriteImages(LineImage *li, size_t iview)
+/* Write the image and tau cube of line li, to files named after the view
+ * if there are several views */
+{
+    MirFile *imgf = li->imgf, *tau_imgf = li->tau_imgf;
+
+    if(glb.nview > 0) {
+        imgf = SpImgTrac_OpenViewImage(li->imgf, iview, &glb.x, &glb.y, &glb.v);
+        if(li->tau_imgf)
+            tau_imgf = SpImgTrac_OpenViewImage(li->tau_imgf, iview, &glb.x, &glb.y, &glb.v);
+    }
+
+    // output line emission or zeeman effect (stokes V) image
+    double scale_factor = li->I_norm/li->ucon;
+    #if Sp_MIRSUPPORT
+    MirImg_WriteXY(imgf, li->image, glb.unit->name, scale_factor);
+    Sp_PRINT("Wrote Miriad image to `%s'\n", imgf->name);
+    #endif
+    FITSoutput( imgf, li->image, NULL, NULL, glb.unit->name, scale_factor, 0);
+    Sp_PRINT("Wrote FITS image to `%s'\n", imgf->name);
+
+    // output tau image
+    if(tau_imgf){
+        FITSoutput( tau_imgf, li->tau_img, NULL, NULL, "Optical depth", 1., 0);
+        Sp_PRINT("Wrote FITS image to `%s'\n", tau_imgf->name);
+
+        #if Sp_MIRSUPPORT
+        MirImg_WriteXY(tau_imgf, li->tau_img, "Optical depth", 1.0);
+        Sp_PRINT("Wrote Miriad image to `%s'\n", tau_imgf->name);
+        if(glb.nview == 0)
+            MirXY_Close(tau_imgf);
+        #endif
+    }
+
+    if(glb.nview > 0) {
+        SpImgTrac_CloseViewImage(imgf);
+        if(tau_imgf)
+            SpImgTrac_CloseViewImage(tau_imgf);
+    }
+
+    return;
+}
+
+/*----------------------------------------------------------------------------*/
+
 static int CalcImage(void)
 {
+    /* Values of a pixel: I_nu (or V_nu) and tau_nu of all channels of
+     * every line */
+    glb.pix.tel_parms = &glb.tel_parms;
+    glb.pix.x = &glb.x;
+    glb.pix.y = &glb.y;
+    glb.pix.nchan = glb.v.n;
+    glb.pix.nval = 2 * glb.v.n * glb.nline;
+
     switch(glb.task->idx){
         case TASK_ZEEMAN:
-            return SpUtil_Threads2(Sp_NTHREAD, CalcImageThreadZeeman);
+            glb.pix.los = LOSZeeman;
+            return SpImgTrac_CalcImage(&glb.pix, CalcImageThreadZeeman);
         case TASK_LINE:
-            return SpUtil_Threads2(Sp_NTHREAD, CalcImageThreadLine);
+            glb.pix.los = LOSLine;
+            return SpImgTrac_CalcImage(&glb.pix, CalcImageThreadLine);
         default:
             /* Shouldn't reach here */
             Deb_ASSERT(0);
@@ -444,71 +541,74 @@ static int CalcImage(void)
 
 /*----------------------------------------------------------------------------*/
 
+static void LOSLine(double dx, double dy, double *val, size_t tid)
+/* I_nu and tau_nu of all lines along the line of sight at (dx, dy) */
+{
+    Mem_BZERO2(val, 2 * glb.v.n * glb.nline);
+
+    /* Calculate radiative transfer for this los */
+    if(glb.overlap)
+        RadiativeXferOverlap(dx, dy, val, tid);
+    else
+        RadiativeXferLine(dx, dy, val, tid);
+
+    return;
+}
+
+/*----------------------------------------------------------------------------*/
+
+static void LOSZeeman(double dx, double dy, double *val, size_t tid)
+/* Stokes V and tau_nu of the line of sight at (dx, dy) */
+{
+    Mem_BZERO2(val, 2 * glb.v.n);
+
+    /* Calculate radiative transfer for this los (Zeeman) */
+    RadiativeXferZeeman(dx, dy, val, &val[glb.v.n], tid);
+
+    return;
+}
+
+/*----------------------------------------------------------------------------*/
+
 static void *CalcImageThreadLine(void *tid_p)
 {
     size_t tid = *((size_t *)tid_p);
 
-    /* pix_id is used for distributing work to threads */
-    size_t pix_id = 0;
-    for(size_t ix = 0; ix < glb.x.n; ix++) {
-        for(size_t iy = 0; iy < glb.y.n; iy++) {
-            if(pix_id % Sp_NTHREAD == tid) {
+    /* val holds the brightness I_nu and the total optical depth tau_nu
+     * for all channels of every line at pixel (ix, iy) */
+    double *val = Mem_CALLOC(2 * glb.v.n * glb.nline, val);
+    /* Scratch space of SpImgTrac_CalcPixel() */
+    double *scratch = Mem_CALLOC(glb.pix.nscratch, scratch);
+
+    /* Pull tiles of pixels off the shared queue until it is empty */
+    size_t ix0, ix1, iy0, iy1;
+    while(SpImgTrac_NextTile(&glb.pix.tiles, &ix0, &ix1, &iy0, &iy1)) {
+        for(size_t ix = ix0; ix < ix1; ix++) {
+            for(size_t iy = iy0; iy < iy1; iy++) {
                 /* Check for thread termination */
                 Sp_CHECKTERMTHREAD();
-                /* check sub-sampling region */
-                size_t nsub = SpImgTrac_Init_nsub( ix, iy, &glb.tel_parms, &glb.x, &glb.y);
-
-                /* I_nu is the brightness for all channels at pixel (ix, iy) */
-                double *I_nu = Mem_CALLOC(glb.v.n, I_nu);
-                /* tau_nu is the total optical depth for all channels at pixel (ix, iy) */
-                double *tau_nu = Mem_CALLOC(glb.v.n, tau_nu);
-
-                /* Loop through sub-resolution positions */
-                for(size_t isub = 0; isub < nsub; isub++) {
-                    for(size_t jsub = 0; jsub < nsub; jsub++) {
-                        double dx, dy;
-                        /* Calculate sub-pixel position */
-                        SpImgTrac_InitSubPixel( &dx, &dy, ix, iy, isub, jsub, nsub, &glb.x, &glb.y);
-
-                        /* I_sub is the brightness for all channels at each sub-resolution */
-                        double *I_sub = Mem_CALLOC(glb.v.n, I_sub);
-                        double *tau_sub = Mem_CALLOC(glb.v.n, tau_sub);
-
-                        /* Calculate radiative transfer for this sub-los */
-                        if(glb.overlap)
-                            RadiativeXferOverlap(dx, dy, I_sub, tau_sub, tid);
-                        else
-                            RadiativeXferLine(dx, dy, I_sub, tau_sub, tid);
-
-                        /* Add I_sub to I_nu */
-                        for(size_t iv = 0; iv < glb.v.n; iv++) {
-                            I_nu[iv] += I_sub[iv];
-                            tau_nu[iv] += tau_sub[iv];
-                        }
-
-                        /* Cleanup */
-                        free(I_sub);
-                        free(tau_sub);
+                /* Average over sub-resolution positions */
+                SpImgTrac_CalcPixel(&glb.pix, ix, iy, val, scratch, tid);
+
+                /* Save averaged I_nu to maps */
+                for(size_t l = 0; l < glb.nline; l++) {
+                    LineImage *li = &glb.lines[l];
+                    double *I_nu = &val[2 * glb.v.n * l];
+                    double *tau_nu = &I_nu[glb.v.n];
+                    for(size_t iv = 0; iv < glb.v.n; iv++) {
+                        MirImg_PIXEL(*li->image, iv, ix, iy) = I_nu[iv];
+                        if(li->tau_img)
+                            MirImg_PIXEL(*li->tau_img, iv, ix, iy) = tau_nu[iv];
                     }
                 }
-
-                /* Save averaged I_nu to map */
-                double DnsubSquare = 1. / (double)(nsub * nsub);
-                for(size_t iv = 0; iv < glb.v.n; iv++) {
-                    MirImg_PIXEL(*glb.image, iv, ix, iy) = I_nu[iv] * DnsubSquare;
-                    if(glb.tau_img)
-                        MirImg_PIXEL(*glb.tau_img, iv, ix, iy) = tau_nu[iv] * DnsubSquare;
-                }
-
-                /* Cleanup */
-                free(I_nu);
-                free(tau_nu);
             }
-            /* Increment pix_id */
-            pix_id += 1;
         }
     }
 
+    /* Cleanup */
+    free(val);
+    free(scratch);
+
     return NULL;
 }
 
@@ -518,62 +618,47 @@ static void *CalcImageThreadLine(void *tid_p)
 static void *CalcImageThreadZeeman(void *tid_p)
 {
     size_t tid = *((size_t *)tid_p);
-    /* pix_id is used for distributing work to threads */
-    size_t pix_id = 0;
-    for(size_t ix = 0; ix < glb.x.n; ix++) {
-        for(size_t iy = 0; iy < glb.y.n; iy++) {
-            if(pix_id % Sp_NTHREAD == tid) {
+
+    /* V_nu is Stokes V and tau_nu the total optical depth for all channels
+     * at pixel (ix, iy) */
+    double *V_nu = Mem_CALLOC(2 * glb.v.n, V_nu);
+    double *tau_nu = &V_nu[glb.v.n];
+    /* Scratch space of SpImgTrac_CalcPixel() */
+    double *scratch = Mem_CALLOC(glb.pix.nscratch, scratch);
+
+    /* Pull tiles of pixels off the shared queue until it is empty */
+    size_t ix0, ix1, iy0, iy1;
+    while(SpImgTrac_NextTile(&glb.pix.tiles, &ix0, &ix1, &iy0, &iy1)) {
+        for(size_t ix = ix0; ix < ix1; ix++) {
+            for(size_t iy = iy0; iy < iy1; iy++) {
                 /* Check for thread termination */
                 Sp_CHECKTERMTHREAD();
-                /* check sub-sampling region */
-                size_t nsub = SpImgTrac_Init_nsub( ix, iy, &glb.tel_parms, &glb.x, &glb.y);
-                /* I_nu is the brightness for all channels at pixel (ix, iy) */
-                double *V_nu = Mem_CALLOC(glb.v.n, V_nu);
-                /* tau_nu is the total optical depth for all channels at pixel (ix, iy) */
-                double *tau_nu = Mem_CALLOC(glb.v.n, tau_nu);
-                /* Loop through sub-resolution positions */
-                for(size_t isub = 0; isub < nsub; isub++) {
-                    for(size_t jsub = 0; jsub < nsub; jsub++) {
-                        double dx, dy;
-                        /* Calculate sub-pixel position */
-                        SpImgTrac_InitSubPixel( &dx, &dy, ix, iy, isub, jsub, nsub, &glb.x, &glb.y);
-                        /* V_sub is Stokes V for all channels at each sub-resolution */
-                        double *V_sub = Mem_CALLOC(glb.v.n, V_sub);
-                        double *tau_sub = Mem_CALLOC(glb.v.n, tau_sub);
-                        /* Calculate radiative transfer for this sub-los (Zeeman) */
-                        RadiativeXferZeeman(dx, dy, V_sub, tau_sub, tid);
-                        /* Add I_sub to I_nu */
-                        for(size_t iv = 0; iv < glb.v.n; iv++) {
-                            V_nu[iv] += V_sub[iv];
-                            tau_nu[iv] += tau_sub[iv];
-                        }
-                        /* Cleanup */
-                        free(V_sub);
-                        free(tau_sub);
-                    }
-                }
-                /* Save averaged I_nu to map */
-                double DnsubSquare = 1. / (double)(nsub * nsub);
+                /* Average over sub-resolution positions */
+                SpImgTrac_CalcPixel(&glb.pix, ix, iy, V_nu, scratch, tid);
+
+                /* Save averaged V_nu to map */
                 for(size_t iv = 0; iv < glb.v.n; iv++) {
-                    MirImg_PIXEL(*glb.image, iv, ix, iy) = V_nu[iv] / (double)(nsub * nsub);
-                    if(glb.tau_img)
-                        MirImg_PIXEL(*glb.tau_img, iv, ix, iy) = tau_nu[iv] * DnsubSquare;
+                    MirImg_PIXEL(*glb.lines[0].image, iv, ix, iy) = V_nu[iv];
+                    if(glb.lines[0].tau_img)
+                        MirImg_PIXEL(*glb.lines[0].tau_img, iv, ix, iy) = tau_nu[iv];
                 }
-                /* Cleanup */
-                free(V_nu);
-                free(tau_nu);
             }
-            /* Increment pix_id */
-            pix_id += 1;
         }
     }
 
+    /* Cleanup */
+    free(V_nu);
+    free(scratch);
+
     return NULL;
 }
 
 /*----------------------------------------------------------------------------*/
 
-static void RadiativeXferLine(double dx, double dy, double *I_nu, double *tau_nu, size_t tid)
+static void RadiativeXferLine(double dx, double dy, double *val, size_t tid)
+/* I_nu (val[2 * VN * l]) and tau_nu (val[2 * VN * l + VN]) of every line l
+ * along the line of sight at (dx, dy): the ray and the line profile factors
+ * are shared by all lines */
 {
     GeRay ray;
     size_t side;
@@ -583,7 +668,8 @@ static void RadiativeXferLine(double dx, double dy, double *I_nu, double *tau_nu
     SpImgTrac_InitRay(root, &dx, &dy, &ray, &glb.tel_parms);
 
     /* Reset tau for all channels */
-    Mem_BZERO2(tau_nu, glb.v.n);
+    for(size_t l = 0; l < glb.nline; l++)
+        Mem_BZERO2(&val[2 * VN * l + VN], VN);
     /* Shoot ray at model and see what happens! */
     if(GeRay_IntersectVoxel(&ray, &root->voxel, &t, &side)) {
         /* Calculate intersection */
@@ -603,81 +689,69 @@ static void RadiativeXferLine(double dx, double dy, double *I_nu, double *tau_nu
             SpPhys *pp = zp->data;
             /* Do radiative transfer only if gas is present in this zone */
             if(pp->non_empty_leaf) {
+                /* Calculate velocity line profile factors of all channels,
+                 * which are the same for all lines: the gas velocity is
+                 * sampled along the path once for the whole spectrum */
+                double vfac[glb.v.n];
+                if(pp->has_tracer)
+                    SpPhys_GetVfacN(&ray, t, -glb.v.crpix * glb.v.delt, glb.v.delt, glb.v.n, zp, vfac);
+
                 /* Do calculations on all channels at this pixel. Try to minimize the
                  * amount of operations in this loop, since everything here is repeated
                  * for ALL channels, and can significantly increase computation time.
                  */
                 for(size_t iv = 0; iv < glb.v.n; iv++) {
-                    /* Calculate velocity associated with this channel */
-                    double dv = ((double)iv - glb.v.crpix) * glb.v.delt;
-                    /* Reset emission and absorption coeffs */
-                    double j_nu = 0;
-                    double k_nu = 0;
-
-                    if(pp->has_tracer) {
-                        /* Calculate velocity line profile factor for this channel:
-                         * This version averages over the line profile in steps
-                         * of the local line width -- very time consuming! */
-                        double vfac = SpPhys_GetVfac(&ray, t, dv, zp, 0);
-                        /* Calculate molecular line emission and absorption coefficients */
-                        SpPhys_GetMoljk(pp, glb.line, vfac, &j_nu, &k_nu);
-
-                    }
+                    for(size_t l = 0; l < glb.nline; l++) {
+                        const LineImage *li = &glb.lines[l];
+                        double *I_nu = &val[2 * VN * l], *tau_nu = &I_nu[VN];
+                        /* Reset emission and absorption coeffs */
+                        double j_nu = 0;
+                        double k_nu = 0;
+
+                        if(pp->has_tracer) {
+                            /* Calculate molecular line emission and absorption coefficients */
+                            SpPhys_GetMoljk(pp, li->line, vfac[iv], &j_nu, &k_nu);
+                        }
 
-                    /* Add continuum emission/absorption */
-                    j_nu += pp->cont[glb.line].j;
-                    k_nu += pp->cont[glb.line].k;
+                        /* Add continuum emission/absorption */
+                        j_nu += pp->cont[li->line].j;
+                        k_nu += pp->cont[li->line].k;
 
-                    /* Calculate source function and optical depth if
-                     * absorption is NOT zero */
-                    double dtau_nu = k_nu * t * Sp_LENFAC;
-                    double S_nu = (fabs(k_nu) > 0.0) ?
-                    j_nu / ( k_nu * glb.I_norm ) : 0.;
+                        /* Calculate source function and optical depth if
+                         * absorption is NOT zero */
+                        double dtau_nu = k_nu * t * Sp_LENFAC;
+                        double S_nu = (fabs(k_nu) > 0.0) ?
+                        j_nu / ( k_nu * li->I_norm ) : 0.;
 
-                    /* Calculate intensity contributed by this step */
-                    //debug
-                    //I_nu[iv] += S_nu * (1.0 - exp(-dtau_nu)) * exp(-tau_nu[iv]);
-                    I_nu[iv] += S_nu * (1.0 - exp(-dtau_nu)) * exp(-tau_nu[iv]);
+                        /* Calculate intensity contributed by this step */
+                        I_nu[iv] += S_nu * (1.0 - exp(-dtau_nu)) * exp(-tau_nu[iv]);
 
-                    /* Accumulate total optical depth for this channel (must be done
-                     * AFTER calculation of intensity!) */
-                    tau_nu[iv] += dtau_nu;
+                        /* Accumulate total optical depth for this channel (must be done
+                         * AFTER calculation of intensity!) */
+                        tau_nu[iv] += dtau_nu;
+                    }
                 }
             }
-            // 			Deb_PRINT("checkpoint: non_empty_leaf\n");
             /* Calculate next position */
             ray = GeRay_Inc(&ray, t);
-            // 			Deb_PRINT("checkpoint: GeRay_Inc\n");
             /* Get next zone to traverse to */
             zp = Zone_GetNext(zp, &side, &ray);
-            #if 0
-            if(zp)
-                Deb_PRINT("zone index: %d %d %d\n",GeVec3_X(zp->index,0),GeVec3_X(zp->index,1),GeVec3_X(zp->index,2));
-            else
-                Deb_PRINT("shoot out!\n");
-            #endif
-
-            #if 0
-            if(I_nu[0] != I_nu[0] && zp ) { // check if intensity become NaN
-                Deb_PRINT("zone index: %d %d %d\n",GeVec3_X(zp->index,0),GeVec3_X(zp->index,1),GeVec3_X(zp->index,2));
-                Deb_PRINT("dnesity=%g\n",pp->n_H2);
-                if(pp->non_empty_leaf) Deb_PRINT("non empty leaf\n");
-
-        }
-        else if(zp == NULL)
-            Deb_PRINT("shoot out!\n");
-        #endif
         }
     }
 
-    SpImgTrac_IntensityBC( side, I_nu, tau_nu, &ray, GEOM, VN, glb.I_in, glb.I_cmb, PARMS);
+    for(size_t l = 0; l < glb.nline; l++) {
+        double *I_nu = &val[2 * VN * l];
+        SpImgTrac_IntensityBC( side, I_nu, &I_nu[VN], &ray, GEOM, VN, glb.lines[l].I_in, glb.lines[l].I_cmb, l, PARMS);
+    }
 
     return;
 }
 
 /*----------------------------------------------------------------------------*/
 
-static void RadiativeXferOverlap(double dx, double dy, double *I_nu, double *tau_nu, size_t tid)
+static void RadiativeXferOverlap(double dx, double dy, double *val, size_t tid)
+/* Same as RadiativeXferLine(), adding the emission and absorption of the
+ * lines overlapping each line */
 {
     GeRay ray;
     double t;
@@ -687,7 +761,8 @@ static void RadiativeXferOverlap(double dx, double dy, double *I_nu, double *tau
     SpImgTrac_InitRay(root, &dx, &dy, &ray, &glb.tel_parms);
 
     /* Reset tau for all channels */
-    Mem_BZERO2(tau_nu, glb.v.n);
+    for(size_t l = 0; l < glb.nline; l++)
+        Mem_BZERO2(&val[2 * VN * l + VN], VN);
     /* Shoot ray at model and see what happens! */
     if(GeRay_IntersectVoxel(&ray, &root->voxel, &t, &side)) {
         /* Calculate intersection */
@@ -698,64 +773,71 @@ static void RadiativeXferOverlap(double dx, double dy, double *I_nu, double *tau
         while(zp) {
             /* Calculate path to next boundary */
             GeRay_TraverseVoxel(&ray, &zp->voxel, &t, &side);
-            //              Deb_PRINT("checkpoint: GeRay_TraverseVoxel\n");
             /* Pointer to physical parameters associated with this zone */
             SpPhys *pp = zp->data;
             /* Do radiative transfer only if gas is present in this zone */
             if(pp->non_empty_leaf) {
-                /* Do calculations on all channels at this pixel. Try to minimize the
-                 * amount of operations in this loop, since everything here is repeated
-                 * for ALL channels, and can significantly increase computation time.
-                 */
-                for(size_t iv = 0; iv < glb.v.n; iv++) {
-                    /* Calculate velocity associated with this channel */
-                    double dv = ((double)iv - glb.v.crpix) * glb.v.delt;
-                    /* Reset emission and absorption coeffs */
-                    double j_nu = 0;
-                    double k_nu = 0;
+                /* Velocity of the first channel */
+                double v_0 = -glb.v.crpix * glb.v.delt;
+                /* Calculate velocity line profile factors of all channels,
+                 * which are the same for all lines: the gas velocity is
+                 * sampled along the path once for the whole spectrum */
+                double vfac[glb.v.n], vfac2[glb.v.n];
+                if(pp->has_tracer)
+                    SpPhys_GetVfacN(&ray, t, v_0, glb.v.delt, glb.v.n, zp, vfac);
+
+                for(size_t l = 0; l < glb.nline; l++) {
+                    const LineImage *li = &glb.lines[l];
+                    double *I_nu = &val[2 * VN * l], *tau_nu = &I_nu[VN];
+                    /* Emission and absorption coeffs of all channels, starting
+                     * from the continuum */
+                    double j_nu[glb.v.n], k_nu[glb.v.n];
+                    for(size_t iv = 0; iv < glb.v.n; iv++) {
+                        j_nu[iv] = pp->cont[li->line].j;
+                        k_nu[iv] = pp->cont[li->line].k;
+                    }
 
                     if(pp->has_tracer) {
-                        /* Calculate velocity line profile factor for this channel:
-                         * This version averages over the line profile in steps
-                         * of the local line width -- very time consuming! */
-                        double vfac = SpPhys_GetVfac(&ray, t, dv, zp, 0);
-                        /* Calculate molecular line emission and absorption coefficients */
-                        size_t i = glb.line;
+                        /* Add molecular line emission and absorption coefficients
+                         * of this line and of the lines overlapping it */
+                        size_t i = li->line;
                         for(size_t j = 0; j < NRAD; j++) {
                             if(OVERLAP(i,j)){
-                                double tempj_nu, tempk_nu;
-                                if(i==j){
-                                    /* Calculate molecular line emission and absorption coefficients */
-                                    SpPhys_GetMoljk(pp, j, vfac, &tempj_nu, &tempk_nu);
+                                const double *vfac_j = vfac;
+                                if(i!=j){
+                                    /* Calculate velocity line profile factors
+                                     * shifted by the relative velocity of line j */
+                                    SpPhys_GetVfacN(&ray, t, v_0-RELVEL(i,j), glb.v.delt, glb.v.n, zp, vfac2);
+                                    vfac_j = vfac2;
                                 }
-                                else{
-                                    /* Calculate velocity line profile factor */
-                                    double vfac2 = pp->has_tracer ? SpPhys_GetVfac(&ray, t, dv-RELVEL(i,j), zp, 0) : 0.0;
-                                    /* Calculate molecular line emission and absorption coefficients */
-                                    SpPhys_GetMoljk(pp, j, vfac2, &tempj_nu, &tempk_nu);
+                                for(size_t iv = 0; iv < glb.v.n; iv++) {
+                                    double tempj_nu, tempk_nu;
+                                    SpPhys_GetMoljk(pp, j, vfac_j[iv], &tempj_nu, &tempk_nu);
+                                    j_nu[iv] += tempj_nu;
+                                    k_nu[iv] += tempk_nu;
                                 }
-                                j_nu += tempj_nu;
-                                k_nu += tempk_nu;
                             }
                         }
                     }
-                    /* Add continuum emission/absorption */
-                    j_nu += pp->cont[glb.line].j;
-                    k_nu += pp->cont[glb.line].k;
-
-                    /* Calculate source function and optical depth if
-                     * absorption is NOT zero */
-                    double dtau_nu = k_nu * t * Sp_LENFAC;
-                    double S_nu = (fabs(k_nu) > 0.0) ?
-                    j_nu / ( k_nu * glb.I_norm ) : 0.;
-
-                    /* Calculate intensity contributed by this step */
-                    //debug
-                    I_nu[iv] += S_nu * (1.0 - exp(-dtau_nu))  * exp(-tau_nu[iv]);
 
-                    /* Accumulate total optical depth for this channel (must be done
-                     * AFTER calculation of intensity!) */
-                    tau_nu[iv] += dtau_nu;
+                    /* Do calculations on all channels at this pixel. Try to minimize the
+                     * amount of operations in this loop, since everything here is repeated
+                     * for ALL channels, and can significantly increase computation time.
+                     */
+                    for(size_t iv = 0; iv < glb.v.n; iv++) {
+                        /* Calculate source function and optical depth if
+                         * absorption is NOT zero */
+                        double dtau_nu = k_nu[iv] * t * Sp_LENFAC;
+                        double S_nu = (fabs(k_nu[iv]) > 0.0) ?
+                        j_nu[iv] / ( k_nu[iv] * li->I_norm ) : 0.;
+
+                        /* Calculate intensity contributed by this step */
+                        I_nu[iv] += S_nu * (1.0 - exp(-dtau_nu))  * exp(-tau_nu[iv]);
+
+                        /* Accumulate total optical depth for this channel (must be done
+                         * AFTER calculation of intensity!) */
+                        tau_nu[iv] += dtau_nu;
+                    }
                 }
             }
             /* Calculate next position */
@@ -765,7 +847,10 @@ static void RadiativeXferOverlap(double dx, double dy, double *I_nu, double *tau
         }
     }
 
-    SpImgTrac_IntensityBC( side, I_nu, tau_nu, &ray, GEOM, VN, glb.I_in, glb.I_cmb, PARMS);
+    for(size_t l = 0; l < glb.nline; l++) {
+        double *I_nu = &val[2 * VN * l];
+        SpImgTrac_IntensityBC( side, I_nu, &I_nu[VN], &ray, GEOM, VN, glb.lines[l].I_in, glb.lines[l].I_cmb, l, PARMS);
+    }
 
     return;
 }
@@ -825,22 +910,26 @@ static void RadiativeXferZeeman(double dx, double dy, double *V_nu, double *tau_
                 double dnu = Z * B_Mag;
                 #undef Z
 
-                double deltav = dnu * PHYS_CONST_MKS_LIGHTC / glb.freq;
+                double deltav = dnu * PHYS_CONST_MKS_LIGHTC / glb.lines[0].freq;
 
-                for(size_t iv = 0; iv < glb.v.n; iv++) {
-                    /* Calculate velocity associated with this channel */
-                    double dv = ((double)iv - glb.v.crpix) * glb.v.delt;
+                /* Line profile factors of the two Zeeman components for all
+                 * channels */
+                double vfac_p[glb.v.n], vfac_m[glb.v.n];
+                if(pp->has_tracer) {
+                    double v_0 = -glb.v.crpix * glb.v.delt;
+                    SpPhys_GetVfacN(&ray, t, v_0+deltav, glb.v.delt, glb.v.n, zp, vfac_p);
+                    SpPhys_GetVfacN(&ray, t, v_0-deltav, glb.v.delt, glb.v.n, zp, vfac_m);
+                }
 
+                for(size_t iv = 0; iv < glb.v.n; iv++) {
                     /* Reset emission and absorption coeffs */
                     double j_nu = 0;
                     double k_nu = 0;
 
                     if(pp->has_tracer) {
-                        double vfac = SpPhys_GetVfac(&ray, t, dv+deltav, zp, 0);
-                        double vfac2 = SpPhys_GetVfac(&ray, t, dv-deltav, zp, 0);
-                        vfac = vfac-vfac2;
+                        double vfac = vfac_p[iv]-vfac_m[iv];
                         double tempj_nu, tempk_nu;
-                        SpPhys_GetMoljk(pp, glb.line, vfac, &tempj_nu, &tempk_nu);
+                        SpPhys_GetMoljk(pp, glb.lines[0].line, vfac, &tempj_nu, &tempk_nu);
                         j_nu = 0.5 * tempj_nu;
                         k_nu += tempk_nu;
                     }
@@ -849,7 +938,7 @@ static void RadiativeXferZeeman(double dx, double dy, double *V_nu, double *tau_
                      * absorption is NOT zero */
                     double dtau_nu = k_nu * t * Sp_LENFAC;
                     double S_nu = (fabs(k_nu) > 0.0) ?
-                    j_nu / ( k_nu * glb.I_norm ) : 0.;
+                    j_nu / ( k_nu * glb.lines[0].I_norm ) : 0.;
 
                     /* Calculate intensity contributed by this step */
                     //debug
@@ -103,6 +103,11 @@ int SpTask_Visual(void)
                         SpPy_XDECREF(o_line);
                     }
                         if(!sts) sts = SpPy_GetInput_bool("lte", &glb.lte);
+                        if(!sts) {
+                            double tol;
+                            if(!(sts = SpPy_GetInput_dbl("profile_tol", &tol)))
+                                Num_SetGaussNormalTol(tol);
+                        }
 
 
                     { // get overlap velocity
@@ -1368,20 +1373,21 @@ static void CalcOpticalDepth( Zone *zp, const GeRay *ray, const double t, double
                 double dtau_dust = k_dust * t * Sp_LENFAC;
                 *tau_dust += dtau_dust;
 
+                /* Calculate velocity line profile factor for all channels:
+                * This version averages over the line profile in steps
+                * of the local line width -- very time consuming! */
+                double vfac[glb.v.n];
+                if(pp->has_tracer)
+                        SpPhys_GetVfacN(ray, t, -glb.v.crpix * glb.v.delt, glb.v.delt, glb.v.n, zp, vfac);
+
                 for(size_t iv = 0; iv < glb.v.n; iv++) {
-                        /* Calculate velocity associated with this channel */
-                        double dv = ((double)iv - glb.v.crpix) * glb.v.delt;
                         /* Reset emission and absorption coeffs */
                         double j_nu = 0.0;
                         double k_nu = 0.0;
 
                         if(pp->has_tracer) {
-                                /* Calculate velocity line profile factor for this channel:
-                                * This version averages over the line profile in steps
-                                * of the local line width -- very time consuming! */
-                                double vfac = SpPhys_GetVfac(ray, t, dv, zp, 0);
                                 /* Calculate molecular line emission and absorption coefficients */
-                                SpPhys_GetMoljk(pp, glb.line, vfac, &j_nu, &k_nu);
+                                SpPhys_GetMoljk(pp, glb.line, vfac[iv], &j_nu, &k_nu);
 
                         }
 
@@ -1425,20 +1431,21 @@ static void ContributionOfCell( Zone *zp, const GeRay *ray, const GeVec3_d *Samp
                         * exp(-(*tau_dust)) / t;
                 *tau_dust += dtau_dust;
 
+                /* Calculate velocity line profile factor for all channels:
+                * This version averages over the line profile in steps
+                * of the local line width -- very time consuming! */
+                double vfac[glb.v.n];
+                if(pp->has_tracer)
+                        SpPhys_GetVfacN(ray, t, -glb.v.crpix * glb.v.delt, glb.v.delt, glb.v.n, zp, vfac);
+
                 for(size_t iv = 0; iv < glb.v.n; iv++) {
-                        /* Calculate velocity associated with this channel */
-                        double dv = ((double)iv - glb.v.crpix) * glb.v.delt;
                         /* Reset emission and absorption coeffs */
                         double j_nu = 0.0;
                         double k_nu = 0.0;
 
                         if(pp->has_tracer) {
-                                /* Calculate velocity line profile factor for this channel:
-                                * This version averages over the line profile in steps
-                                * of the local line width -- very time consuming! */
-                                double vfac = SpPhys_GetVfac(ray, t, dv, zp, 0);
                                 /* Calculate molecular line emission and absorption coefficients */
-                                SpPhys_GetMoljk(pp, glb.line, vfac, &j_nu, &k_nu);
+                                SpPhys_GetMoljk(pp, glb.line, vfac[iv], &j_nu, &k_nu);
                         }
 
                         /* Add continuum emission/absorption */
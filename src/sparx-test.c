@@ -27,6 +27,8 @@ static int SpTest_Llst(void);
 static int SpTest_RayTracing(void);
 static int SpTest_Molec(void);
 static int SpTest_VecInterp(void);
+static int SpTest_Philox(void);
+static int SpTest_LUSolve(void);
 
 /* Task definitions */
 SpTask
@@ -50,7 +52,9 @@ SpTask
 	SpTask_t_pkeys = Sp_TASK("t_pkeys", "For debugging purposes", SpTest_Pkeys, 0),
 	SpTask_t_llst = Sp_TASK("t_llst", "For debugging purposes", SpTest_Llst, 0),
 	SpTask_t_molec = Sp_TASK("t_molec", "Test molecule access", SpTest_Molec, 0),
-	SpTask_t_vecinterp = Sp_TASK("t_vecinterp", "Test vector interpolation", SpTest_VecInterp, 0);
+	SpTask_t_vecinterp = Sp_TASK("t_vecinterp", "Test vector interpolation", SpTest_VecInterp, 0),
+	SpTask_t_philox = Sp_TASK("t_philox", "Test the Philox4x32-10 generator against known answers", SpTest_Philox, 0),
+	SpTask_t_lusolve = Sp_TASK("t_lusolve", "Test batched LU solutions against Num_LUDecompSolve()", SpTest_LUSolve, 0);
 
 
 
@@ -299,6 +303,119 @@ static int SpTest_Math(void)
 
 /*----------------------------------------------------------------------------*/
 
+static int SpTest_Philox(void)
+/* Check Num_Philox4x32() against the philox4x32_10 known-answer vectors of
+ * Salmon et al. (2011, Random123 kat_vectors), and the Num_rng_philox
+ * generator against the block function */
+{
+	static const uint32_t kat[3][10] = {
+		/* ctr[4], key[2], expected out[4] */
+		{0x00000000, 0x00000000, 0x00000000, 0x00000000, 0x00000000, 0x00000000,
+		 0x6627e8d5, 0xe169c58d, 0xbc57ac4c, 0x9b00dbd8},
+		{0xffffffff, 0xffffffff, 0xffffffff, 0xffffffff, 0xffffffff, 0xffffffff,
+		 0x408f276d, 0x41c83b0e, 0xa20bc7c6, 0x6d5451fd},
+		{0x243f6a88, 0x85a308d3, 0x13198a2e, 0x03707344, 0xa4093822, 0x299f31d0,
+		 0xd16cfe09, 0x94fdcceb, 0x5001e420, 0x24126ea1}
+	};
+	int status = 0;
+	uint32_t out[4];
+
+	for(size_t i = 0; i < 3; i++) {
+		Num_Philox4x32(&kat[i][0], &kat[i][4], out);
+		for(size_t j = 0; j < 4; j++) {
+			if(out[j] != kat[i][6 + j]) {
+				printf("philox4x32_10 vector %lu, word %lu: got %08x, expected %08x\n",
+					(unsigned long)i, (unsigned long)j, (unsigned)out[j], (unsigned)kat[i][6 + j]);
+				status = 1;
+			}
+		}
+	}
+
+	/* The generator must return the blocks of ctr = (0, s1, s2, s3), (1,
+	 * s1, s2, s3), ... under key = seed, word by word */
+	gsl_rng *rng = gsl_rng_alloc(Num_rng_philox);
+	unsigned long seed = 0x299f31d0a4093822UL;
+	uint32_t ctr[4] = {0, 0x85a308d3, 0x13198a2e, 0x03707344},
+		key[2] = {(uint32_t)seed, (uint32_t)(seed >> 32)};
+
+	Num_PhiloxSetStream(rng, seed, ctr[1], ctr[2], ctr[3]);
+	for(ctr[0] = 0; ctr[0] < 3; ctr[0]++) {
+		Num_Philox4x32(ctr, key, out);
+		for(size_t j = 0; j < 4; j++) {
+			unsigned long u = gsl_rng_get(rng);
+			if(u != out[j]) {
+				printf("Num_rng_philox block %lu, word %lu: got %08lx, expected %08x\n",
+					(unsigned long)ctr[0], (unsigned long)j, u, (unsigned)out[j]);
+				status = 1;
+			}
+		}
+	}
+	gsl_rng_free(rng);
+
+	printf(status ? "Philox4x32-10: FAILED\n" : "Philox4x32-10: passed\n");
+
+	return status;
+}
+
+/*----------------------------------------------------------------------------*/
+
+static int SpTest_LUSolve(void)
+/* Check Num_LUDecompSolveBatch() against Num_LUDecompSolve() on systems
+ * that need row exchanges (a zero leading pivot, and a zero pivot that
+ * only appears after the first elimination step), and check that a
+ * singular system in the same batch is flagged without affecting the
+ * others */
+{
+	#define N 4
+	#define NBATCH 3
+	static const double A0[NBATCH][N * N] = {
+		{0, 2, 1, 3,  1, 0, 2, 1,  3, 1, 0, 2,  2, 3, 1, 0},
+		{1, 2, 3, 4,  2, 4, 1, 3,  3, 1, 4, 2,  5, 3, 2, 1},
+		/* Row 2 = 2 * row 1 */
+		{1, 2, 3, 4,  2, 4, 6, 8,  0, 1, 0, 1,  1, 0, 1, 0}
+	};
+	static const double b0[NBATCH][N] = {
+		{1, 2, 3, 4},
+		{1, 2, 3, 4},
+		{1, 2, 3, 4}
+	};
+	double A[NBATCH * N * N], b[NBATCH * N], Ak[N * N], x[N];
+	int singular[NBATCH], status = 0;
+	size_t nsingular;
+
+	Mem_MEMCPY(A, &A0[0][0], NBATCH * N * N);
+	Mem_MEMCPY(b, &b0[0][0], NBATCH * N);
+	nsingular = Num_LUDecompSolveBatch(A, N, NBATCH, b, singular);
+
+	if(nsingular != 1 || singular[0] || singular[1] || !singular[2]) {
+		printf("Num_LUDecompSolveBatch: got %lu singular system(s) (%d, %d, %d), expected 1 (0, 0, 1)\n",
+			(unsigned long)nsingular, singular[0], singular[1], singular[2]);
+		status = 1;
+	}
+
+	for(size_t k = 0; k < 2; k++) {
+		Mem_MEMCPY(Ak, A0[k], N * N);
+		Num_LUDecompSolve(Ak, N, b0[k], x);
+
+		for(size_t i = 0; i < N; i++) {
+			if(fabs(b[k * N + i] - x[i]) > 1e-12 * (1.0 + fabs(x[i]))) {
+				printf("Num_LUDecompSolveBatch system %lu, x[%lu]: got %.17g, expected %.17g\n",
+					(unsigned long)k, (unsigned long)i, b[k * N + i], x[i]);
+				status = 1;
+			}
+		}
+	}
+
+	printf(status ? "LU batch solver: FAILED\n" : "LU batch solver: passed\n");
+
+	#undef N
+	#undef NBATCH
+
+	return status;
+}
+
+/*----------------------------------------------------------------------------*/
+
 static int SpTest_Nothing(void)
 /* This task is just for generating valgrind supressions */
 {
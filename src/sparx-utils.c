@@ -1,5 +1,6 @@
 #include "sparx.h"
 #include <signal.h>
+#include <time.h>
 
 static int SpUtil_termthread = 0; /* Flag for terminating threads */
 
@@ -144,3 +145,16 @@ int SpUtil_TermThread(void)
 	return SpUtil_termthread;
 }
 
+/*----------------------------------------------------------------------------*/
+
+double SpUtil_WallTime(void)
+/* Monotonic wall-clock time in seconds, for timing work done in threads
+ * (clock() measures the CPU time of the whole process) */
+{
+	struct timespec ts;
+
+	clock_gettime(CLOCK_MONOTONIC, &ts);
+
+	return (double)ts.tv_sec + 1.0e-9 * (double)ts.tv_nsec;
+}
+
@@ -205,8 +205,21 @@ typedef struct SpPhys {
 
     double diff;
 
+    /* Line emission and absorption coeffs per unit vfac (nrad each), see
+     * SpPhys_GetMoljkN(); for use in amc only, points to memory owned by
+     * the task */
+    double *line_j, *line_k;
+
 } SpPhys;
 
+/* Radiative transitions of a molecule packed into arrays, for loops over
+ * all lines */
+typedef struct SpLineTab {
+    size_t nrad;
+    size_t *up, *lo;
+    double *freq, *A_ul, *B_lu, *B_ul;
+} SpLineTab;
+
 
 typedef struct SourceData{
     double
@@ -240,6 +253,10 @@ typedef struct SpModel {
 
 typedef struct SpTelsim {
     double dist, rotate[3];
+    /* Adaptive sub-pixel refinement: tolerance (fraction of the image
+     * peak, 0 to disable) and max. levels of refinement */
+    double adapt_tol;
+    size_t adapt_depth;
     size_t nsubres;
     struct {
         double blc_x, blc_y, trc_x, trc_y;
@@ -247,6 +264,39 @@ typedef struct SpTelsim {
     } *subres;
 } SpTelsim;
 
+/* Work queue of the imaging threads: the image is divided into tiles of
+ * up to SpImgTrac_TILE x SpImgTrac_TILE pixels, which are handed out in
+ * order of decreasing cost (number of sub-pixel rays) */
+#define SpImgTrac_TILE 4
+
+typedef struct SpImgTiles {
+    size_t nx, ny, ntx, nty, ntile, next;
+    size_t *order;
+    pthread_mutex_t mutex;
+} SpImgTiles;
+
+/* Line of sight function of an imaging task: stores the nval values (e.g.
+ * I_nu and tau_nu of all channels) of the ray at angular offsets (dx, dy)
+ * in val */
+typedef void (*SpImgTrac_LOSFunc)(double dx, double dy, double *val, size_t tid);
+
+/* Pixel sampling of an imaging task: nval values per pixel in blocks of
+ * nchan channels. With adaptive refinement, the images are computed in two
+ * passes: the first one traces one ray per pixel into val0, and the second
+ * one refines pixels that differ from their neighbours by more than
+ * adapt_tol times the peak of the quantity (scale). Each thread allocates
+ * a scratch buffer of nscratch values once for SpImgTrac_CalcPixel() */
+typedef struct SpImgPixels {
+    SpTelsim *tel_parms;
+    MirImg_Axis *x, *y;
+    size_t nval, nchan, nscratch;
+    SpImgTrac_LOSFunc los;
+    SpImgTiles tiles;
+    int refine;
+    double *val0, *scale;
+    size_t nrefined;
+} SpImgPixels;
+
 void *SpPhys_Alloc(const Zone *zp, const void *parms_p);
 void SpPhys_Free(void *ptr);
 void SpPhys_Fprintf(SpPhys *pp, FILE *fp);
@@ -271,11 +321,17 @@ void SpPhys_AddContinuum_d(SpPhys *pp, int cont, double gas_to_dust);
 void SpPhys_AddContinuum_ff(SpPhys *pp, int cont);
 
 void SpPhys_InitCollRates(SpPhys *pp);
+size_t SpPhys_CollCoeffsSize(const Molec *mol);
+void SpPhys_GetCollCoeffs(const Molec *mol, double T_k, double *K_ul);
+void SpPhys_FillCollRates(const SpPhys *pp, const double *K_ul, double *cmat);
 double SpPhys_GetCollDens(const SpPhys *pp, int species);
 void SpPhys_ProcLamda(Molec *mol);
 double SpPhys_Zfunc(const Molec *mol, double T_k);
 double SpPhys_BoltzPops(const Molec *mol, size_t lev, double T_k);
 void SpPhys_GetMoljk(const SpPhys *pp, size_t tr, double vfac, double *j_nu, double *k_nu);
+SpLineTab *SpPhys_AllocLineTab(const Molec *mol);
+void SpPhys_FreeLineTab(SpLineTab *tab);
+void SpPhys_GetMoljkN(const SpPhys *pp, const SpLineTab *tab, double *j_coef, double *k_coef);
 GeVec3_d SpPhys_GetVgas(const GeVec3_d *pos, const Zone *zone);
 GeVec3_d SpPhys_GetBgas(const GeVec3_d *pos, const Zone *zone);
 GeVec3_d SpPhys_GetVfunc(const GeRay *ray, double dt, const Zone *zone);
@@ -283,6 +339,8 @@ GeVec3_d SpPhys_GetBfunc(const GeRay *ray, double dt, const Zone *zone);
 
 GeVec3_d SpPhys_GetBfac(const GeRay *ray, double dt, const Zone *zone, int debug);
 double SpPhys_GetVfac(const GeRay *ray, double dt, double v_los, const Zone *zone, int debug);
+void SpPhys_GetVfacN(const GeRay *ray, double dt, double v_0, double delta_v, size_t nv,
+	const Zone *zone, double *vfac);
 GeVec3_d SpPhys_GetVfac2(const GeRay *ray, double dt, const Zone *zone, int debug);
 double _SpPhys_BoltzRatio(const Molec *mol, size_t up, size_t lo, double T_k);
 #define SpPhys_BoltzRatio(mol, up, lo, T_k)\
@@ -303,6 +361,7 @@ void SpModel_GenModel_UniSphere(SpModel *model, double n_H2, double T_k, double
 void SpUtil_Threads(void *(*ThreadFunc)(void *));
 int SpUtil_Threads2(size_t nthread, void *(*ThreadFunc)(void *));
 int SpUtil_TermThread(void);
+double SpUtil_WallTime(void);
 
 #define Sp_CHECKTERMTHREAD()\
 	{if(SpUtil_TermThread()) break;}
@@ -382,7 +441,9 @@ void SpIO_SourceFromH5Record(SourceData *source, ZoneH5_Record_Source record);
 int SpIO_H5WriteGrid(hid_t h5f_id, const Zone *zone, const SpPhysParm *parms);
 int SpIO_H5ReadGrid(hid_t h5f_id, hid_t popsh5f_id, Zone **zone, SpPhysParm *parms, int *read_pops);
 int SpIO_H5WritePops(hid_t h5f_id, const Zone *zone);
+int SpIO_H5WritePopsTable(hid_t h5f_id, const double *pops, size_t nzone, size_t nlev);
 int SpIO_H5ReadPops(hid_t h5f_id, Zone *zone);
+int SpIO_H5WriteNray(hid_t h5f_id, const Zone *zone);
 int SpIO_H5WriteTau(hid_t h5f_id, const Zone *zone);
 int SpIO_H5ReadTau(hid_t h5f_id, Zone *zone);
 int SpIO_H5GetAttribute_string(hid_t h5f_id, const char *obj_name, const char *attr_name, char **attribute);
@@ -482,8 +543,20 @@ void SpImgTrac_InitSubPixel( double *dx,
                            MirImg_Axis *x, MirImg_Axis *y
 );
 void SpImgTrac_IntensityBC( size_t side, double *I_nu, double *tau_nu, GeRay *ray,
-                                   int geom, size_t vn, double I_in, double I_cmb, SpPhysParm * parms);
+                                   int geom, size_t vn, double I_in, double I_cmb, size_t iline, SpPhysParm * parms);
 void SpImgTrac_InitLOSCoord( double *dx, double *dy, GeRay *ray, GeVec3_d *z, GeVec3_d *n, GeVec3_d *e, SpTelsim * tel_parms);
+void SpImgTrac_InitTiles(SpImgTiles *tiles, SpTelsim *tel_parms, MirImg_Axis *x, MirImg_Axis *y);
+int SpImgTrac_NextTile(SpImgTiles *tiles, size_t *ix0, size_t *ix1, size_t *iy0, size_t *iy1);
+void SpImgTrac_FreeTiles(SpImgTiles *tiles);
+int SpImgTrac_CalcImage(SpImgPixels *pix, void *(*ThreadFunc)(void *tid_p));
+void SpImgTrac_CalcPixel(SpImgPixels *pix, size_t ix, size_t iy, double *val, double *scratch, size_t tid);
+int SpImgTrac_GetViews(SpTelsim **views, size_t *nview);
+void SpImgTrac_SetView(SpTelsim *tel_parms, const SpTelsim *view, size_t iview, size_t nview);
+int SpImgTrac_OpenImage(const char *name, size_t nview, MirImg_Axis *x, MirImg_Axis *y, MirImg_Axis *v, MirFile **fp);
+int SpImgTrac_GetInput_Image(const char *key, size_t nview, MirImg_Axis *x, MirImg_Axis *y, MirImg_Axis *v, MirFile **fp);
+void SpImgTrac_CloseImage(MirFile *fp, size_t nview);
+MirFile *SpImgTrac_OpenViewImage(const MirFile *base, size_t iview, MirImg_Axis *x, MirImg_Axis *y, MirImg_Axis *v);
+void SpImgTrac_CloseViewImage(MirFile *fp);
 
 
 